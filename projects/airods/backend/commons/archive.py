@@ -0,0 +1,212 @@
+"""
+Tar archive of iRODS data objects, streamed while it is built
+"""
+
+import os
+import queue
+import tarfile
+import threading
+import time
+
+from flask import Response, stream_with_context
+from irods.exception import NetworkException
+from restapi.utilities.logs import log
+
+from airods.commons.sessions import IRODS_POOL_SIZE, SESSION_ERRORS, PoolTimeout
+
+# bytes read from iRODS (and written to the response) at once
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("AIRODS_DOWNLOAD_CHUNK_SIZE", 1048576))
+# chunks read ahead of the response, possibly from the next object
+DOWNLOAD_PREFETCH = int(os.environ.get("AIRODS_DOWNLOAD_PREFETCH", 8))
+# pooled sessions the running downloads may hold at once, each for its whole
+# transfer: the others stay available to the short requests (/list, /stage...)
+DOWNLOAD_SESSIONS = int(
+    os.environ.get("AIRODS_DOWNLOAD_SESSIONS", max(1, IRODS_POOL_SIZE // 2))
+)
+
+# member listing the objects left out of the archive, if any
+ERRORS_MEMBER = "AIRODS_ERRORS.txt"
+
+_END = object()
+
+_download_slots = threading.BoundedSemaphore(DOWNLOAD_SESSIONS)
+
+
+class Member:
+    """ Start of a new archive member, followed by its data chunks """
+
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+
+    def header(self):
+        info = tarfile.TarInfo(self.name)
+        info.size = self.size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def read_objects(icom, entries, chunks, stop, chunk_size, release=None):
+    """
+    Reader thread: put a Member and then its data chunks for each
+    (name, irods_path) of entries. The bounded chunks queue lets it
+    read ahead (also into the next object) while the response drains.
+    An object that cannot be read is left out (or cut short) and listed
+    in a last ERRORS_MEMBER. release(broken), if given, hands the session
+    back once the reader is done with it, whatever ended the download
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    errors = []
+    broken = False
+    try:
+        for name, irods_path in entries:
+            try:
+                if not put_object(icom, name, irods_path, put, chunk_size):
+                    return
+            except (NetworkException, OSError) as e:
+                # the connection is gone: no other object can be read
+                log.error("Download interrupted at {}: {}", irods_path, e)
+                errors.append(f"{irods_path}: {e} (download interrupted)")
+                broken = True
+                break
+            except Exception as e:
+                # missing, not accessible...: the session is still usable
+                log.warning("Download of {} skipped: {}", irods_path, e)
+                errors.append(f"{irods_path}: {e!r}")
+
+        if errors:
+            note = ("\n".join(errors) + "\n").encode()
+            if put(Member(ERRORS_MEMBER, len(note), time.time())):
+                put(note)
+    finally:
+        # the session goes back before the archive ends
+        try:
+            if release is not None:
+                release(broken)
+        finally:
+            put(_END)
+
+
+def put_object(icom, name, irods_path, put, chunk_size):
+    """ Put the Member and the data chunks of one object, False once stopped """
+
+    obj = icom.prc.data_objects.get(irods_path)
+    mtime = obj.modify_time.timestamp() if obj.modify_time else 0
+    if not put(Member(name, obj.size, mtime)):
+        return False
+
+    with obj.open("r") as handle:
+        while True:
+            data = handle.read(chunk_size)
+            if not data:
+                return True
+            if not put(data):
+                return False
+
+
+def start_reader(icom, entries, chunk_size=DOWNLOAD_CHUNK_SIZE, release=None):
+    """ Start read_objects, returns its chunks queue and stop event """
+
+    chunks = queue.Queue(maxsize=DOWNLOAD_PREFETCH)
+    stop = threading.Event()
+    threading.Thread(
+        target=read_objects,
+        args=(icom, entries, chunks, stop, chunk_size, release),
+        name="airods-download",
+        daemon=True,
+    ).start()
+    return chunks, stop
+
+
+def archive_chunks(chunks, stop):
+    """
+    Yield the tar archive of the objects put by read_objects. It always
+    ends with the end-of-archive blocks, unless the client went away
+    """
+
+    # bytes still expected by the current member
+    remaining = 0
+    # padding of the current member up to the next tar block
+    padding = 0
+    closed = False
+    try:
+        for item in iter(chunks.get, _END):
+
+            if isinstance(item, Member):
+                # an object shrank or failed while being read: its missing
+                # bytes are zeros, the archive stays valid
+                yield b"\0" * (remaining + padding)
+                yield item.header()
+                remaining = item.size
+                padding = -item.size % tarfile.BLOCKSIZE
+                continue
+
+            data = item[:remaining]
+            remaining -= len(data)
+            yield data
+    except GeneratorExit:
+        closed = True
+        raise
+    except Exception as e:
+        log.error("Download interrupted: {}", e)
+    finally:
+        stop.set()
+        if not closed:
+            yield b"\0" * (remaining + padding)
+            # end of archive
+            yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+def tar_chunks(icom, entries, chunk_size=DOWNLOAD_CHUNK_SIZE, release=None):
+    """ Yield the tar archive of the entries objects, chunk by chunk """
+
+    yield from archive_chunks(*start_reader(icom, entries, chunk_size, release))
+
+
+def checkout_download(pool):
+    """
+    Session of a download (archive or single object) and its release(broken).
+    PoolTimeout right away when DOWNLOAD_SESSIONS downloads are running
+    """
+
+    if not _download_slots.acquire(blocking=False):
+        raise PoolTimeout(f"{DOWNLOAD_SESSIONS} downloads already running")
+    try:
+        icom = pool.checkout()
+    except BaseException:
+        _download_slots.release()
+        raise
+
+    def release(broken):
+        pool.checkin(icom, broken=broken)
+        _download_slots.release()
+
+    return icom, release
+
+
+def stream_tar(icom, entries, filename="airods.tar", release=None):
+    """
+    Response streaming the archive. The reader starts right away: a
+    response closed before being sent still stops it, and the session
+    goes back through release only once the reader has let go of it
+    """
+
+    chunks, stop = start_reader(icom, entries, release=release)
+    response = Response(
+        stream_with_context(archive_chunks(chunks, stop)),
+        mimetype="application/x-tar",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+    response.call_on_close(stop.set)
+    return response
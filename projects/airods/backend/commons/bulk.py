@@ -0,0 +1,142 @@
+"""
+Bulk selections: many bbox/time windows or NSCL tuples answered by one query
+"""
+
+import os
+
+import dateutil.parser
+from restapi.exceptions import BadRequest
+
+from airods.commons.queries import bbox_filter, file_id_pattern, nscl_filter
+
+# upper bound of the selections of a single /airods/bulk request
+BULK_MAX_SELECTIONS = int(os.environ.get("AIRODS_BULK_MAX_SELECTIONS", 1000))
+
+BBOX_KEYS = ("minlat", "minlon", "maxlat", "maxlon")
+NSCL_KEYS = ("network", "station", "location", "channel")
+
+
+def is_bbox(selection):
+    return all(selection.get(key) is not None for key in BBOX_KEYS)
+
+
+def check_selection(index, selection):
+    """ A selection is either a full bounding box or an NSCL tuple """
+
+    if is_bbox(selection):
+        return
+    if any(selection.get(key) is not None for key in BBOX_KEYS):
+        raise BadRequest(f"Selection {index}: minlat, minlon, maxlat, maxlon required")
+    if selection.get("network") is None:
+        raise BadRequest(f"Selection {index}: a bounding box or a network required")
+
+
+def selection_filter(selection):
+    """ find() filter of one selection """
+
+    if is_bbox(selection):
+        return bbox_filter(
+            selection["start"],
+            selection["end"],
+            *(selection[key] for key in BBOX_KEYS),
+        )
+
+    return nscl_filter(
+        selection["start"],
+        selection["end"],
+        selection["network"],
+        selection.get("station") or "*",
+        selection.get("channel") or "*",
+        selection.get("location") or "",
+    )
+
+
+def selection_expression(selection):
+    """
+    Aggregation expression true for the documents of the selection, to tag
+    each result. Applied after the $match: the fileId regex stands for the
+    parsed NSCL fields and the exact box for the geo condition
+    """
+
+    conditions = [
+        {"$gte": ["$dc_coverage_t_min", selection["start"]]},
+        {"$lte": ["$dc_coverage_t_max", selection["end"]]},
+    ]
+
+    if is_bbox(selection):
+        conditions += [
+            {"$gte": ["$dc_coverage_x", selection["minlat"]]},
+            {"$lte": ["$dc_coverage_x", selection["maxlat"]]},
+            {"$gte": ["$dc_coverage_y", selection["minlon"]]},
+            {"$lte": ["$dc_coverage_y", selection["maxlon"]]},
+        ]
+    else:
+        pattern = file_id_pattern(
+            selection["network"],
+            selection.get("station") or "*",
+            selection.get("location") or "",
+            selection.get("channel") or "*",
+        )
+        conditions.append(
+            {"$regexMatch": {"input": "$fileId", "regex": pattern.pattern}}
+        )
+
+    return {"$and": conditions}
+
+
+def bulk_pipeline(selections, fields):
+    """
+    One scan for all the selections: a document matched by several of them
+    comes out once, with the indexes of the selections it matched
+    """
+
+    project = {field: 1 for field in fields}
+    project["_id"] = 0
+    project["selections"] = {
+        "$concatArrays": [
+            {"$cond": [selection_expression(selection), [index], []]}
+            for index, selection in enumerate(selections)
+        ]
+    }
+
+    return [
+        {"$match": {"$or": [selection_filter(s) for s in selections]}},
+        {"$project": project},
+    ]
+
+
+def parse_fdsn_selections(text):
+    """
+    Selections of an FDSN POST body, one "NET STA LOC CHA START END" per line.
+    The key=value lines (quality=, format=, ...) and the blank ones are skipped
+    """
+
+    selections = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or "=" in line or line.startswith("#"):
+            continue
+
+        parts = line.split()
+        if len(parts) != 6:
+            raise BadRequest(f"Line {number}: expected NET STA LOC CHA START END")
+
+        network, station, location, channel, start, end = parts
+        try:
+            start = dateutil.parser.isoparse(start)
+            end = dateutil.parser.isoparse(end)
+        except ValueError:
+            raise BadRequest(f"Line {number}: invalid start or end time")
+
+        selections.append(
+            {
+                "start": start,
+                "end": end,
+                "network": network,
+                "station": station,
+                "location": location,
+                "channel": channel,
+            }
+        )
+
+    return selections
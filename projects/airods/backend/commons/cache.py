@@ -0,0 +1,239 @@
+"""
+In-process LRU/TTL cache of query results, invalidated by catalogue changes
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+from pymongo import ReadPreference
+from pymongo.errors import PyMongoError
+from restapi.utilities.logs import log
+
+CACHE_SIZE = int(os.environ.get("AIRODS_CACHE_SIZE", 256))
+CACHE_TTL = int(os.environ.get("AIRODS_CACHE_TTL", 300))
+# larger results are not cached
+CACHE_MAX_DOCS = int(os.environ.get("AIRODS_CACHE_MAX_DOCS", 50000))
+# polling period of the watermark when change streams are not available
+WATERMARK_POLL = int(os.environ.get("AIRODS_WATERMARK_POLL", 30))
+
+
+def cache_key(name, **params):
+    """ Hashable key of a query, equal for equivalent parameters """
+
+    def normalize(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, float):
+            return round(value, 6)
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+        return value
+
+    return (name,) + tuple(sorted((k, normalize(v)) for k, v in params.items()))
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache with a TTL. Each entry records the catalogue
+    version it was computed on, and is stale once the version changes
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+
+            expires, entry_version, value = entry
+            if expires < time.monotonic() or entry_version != version:
+                del self.entries[key]
+                self.counters["invalidations"] += 1
+                self.counters["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+        stats["maxsize"] = self.maxsize
+        stats["ttl"] = self.ttl
+        return stats
+
+
+# collection of the last change seen on each catalogue collection
+STATE_COLLECTION = "catalogue_state"
+
+
+def catalogue_state(collection):
+    """
+    Estimated count, newest _id and last recorded change: cheap, and equal
+    for every process. Read on the primary, a lagging secondary would give
+    another state
+    """
+
+    primary = collection.with_options(read_preference=ReadPreference.PRIMARY)
+    newest = primary.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    changes = primary.database[STATE_COLLECTION].find_one({"_id": collection.name})
+    return (
+        primary.estimated_document_count(),
+        newest and newest["_id"],
+        changes and changes.get("changed"),
+    )
+
+
+def record_change(collection, cluster_time):
+    """
+    Record the cluster time of a change of collection. Every watcher
+    records the changes it sees: $max keeps the same, last one
+    """
+
+    collection.database[STATE_COLLECTION].update_one(
+        {"_id": collection.name}, {"$max": {"changed": cluster_time}}, upsert=True
+    )
+
+
+class CatalogueWatermark:
+    """
+    Version counter of a collection, bumped on every change. Follows a change
+    stream when the deployment supports it (replica set), otherwise polls
+    every WATERMARK_POLL seconds. stamp identifies the catalogue state the
+    same way in every process: the count, last _id and the last change
+    recorded by the change stream watchers (so in-place updates move it
+    too), always read back from the database.
+    modified is the time of the last change (an upper bound, in UTC)
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.stamp = None
+        self.modified = datetime.utcnow()
+        self.source = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def bump(self, stamp):
+        with self.lock:
+            self.version += 1
+            self.stamp = stamp
+            self.modified = datetime.utcnow()
+
+    @staticmethod
+    def state_stamp(state):
+        count, newest, changed = state
+        if changed is None:
+            return f"{count:x}-{newest}"
+        return f"{count:x}-{newest}-{changed.time:x}.{changed.inc:x}"
+
+    def ensure_started(self, collection):
+        # threads do not survive a fork: one watcher per worker process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+
+        # the stamp is needed right away, the watcher only follows the changes
+        try:
+            state = catalogue_state(collection)
+        except PyMongoError as e:
+            log.warning("Cannot read the {} state: {}", collection.name, e)
+        else:
+            _, newest, changed = state
+            self.stamp = self.state_stamp(state)
+            times = [
+                moment.replace(tzinfo=None)
+                for moment in (
+                    getattr(newest, "generation_time", None),
+                    changed and changed.as_datetime(),
+                )
+                if time
+            ]
+            if times:
+                self.modified = max(times)
+
+        threading.Thread(
+            target=self.watch,
+            args=(collection,),
+            name=f"{collection.name}-watermark",
+            daemon=True,
+        ).start()
+
+    def refresh(self, collection, changed=False):
+        """ Read the stamp again, bump if it moved (or a change was seen) """
+
+        try:
+            stamp = self.state_stamp(catalogue_state(collection))
+        except PyMongoError as e:
+            log.warning("Cannot read the {} state: {}", collection.name, e)
+            # bump anyway: the cached results are stale
+            stamp = self.stamp
+        if changed or stamp != self.stamp:
+            self.bump(stamp)
+
+    def record(self, collection, cluster_time):
+        """ Record the last change of a burst, then read the stamp again """
+
+        try:
+            record_change(collection, cluster_time)
+        except PyMongoError as e:
+            log.warning("Cannot record the {} change: {}", collection.name, e)
+        self.refresh(collection, changed=True)
+
+    def watch(self, collection):
+        try:
+            with collection.watch() as stream:
+                self.source = "change stream"
+                log.info("Watching {} changes", collection.name)
+                changed = None
+                while stream.alive:
+                    # a burst of changes is read again once, when it pauses
+                    change = stream.try_next()
+                    if change is not None:
+                        changed = change["clusterTime"]
+                    elif changed is not None:
+                        self.record(collection, changed)
+                        changed = None
+        except PyMongoError as e:
+            log.info("No change stream on {} ({}), polling it", collection.name, e)
+
+        self.source = "polling"
+        while True:
+            self.refresh(collection)
+            time.sleep(WATERMARK_POLL)
+
+
+results_cache = ResultCache()
+watermark = CatalogueWatermark()
+
+
+def catalogue_version(collection):
+    watermark.ensure_started(collection)
+    return watermark.version
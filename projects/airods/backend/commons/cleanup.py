@@ -0,0 +1,153 @@
+"""
+Free the stage collections: on request (/airods/free) and once expired
+(reap_stage_collections task), with the replicas nobody references anymore
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from restapi.utilities.logs import log
+
+# seconds a stage collection is kept on the endpoint
+STAGE_TTL = int(os.environ.get("AIRODS_STAGE_TTL", 604800))
+# seconds an unreferenced replica is kept, to be reused by the next requests
+REPLICA_TTL = int(os.environ.get("AIRODS_REPLICA_TTL", 86400))
+# collections / replicas removed per reaper batch, seconds between batches
+REAP_BATCH_SIZE = int(os.environ.get("AIRODS_REAP_BATCH_SIZE", 100))
+REAP_PAUSE = float(os.environ.get("AIRODS_REAP_PAUSE", 1.0))
+# seconds between two reaper runs
+REAP_INTERVAL = int(os.environ.get("AIRODS_REAP_INTERVAL", 3600))
+# zone of the stage endpoint, its orphan trash is purged by the reaper
+# (empty: skipped)
+STAGE_TRASH_ZONE = os.environ.get("AIRODS_STAGE_TRASH_ZONE", "")
+
+
+def stage_expiry(created):
+    return created + timedelta(seconds=STAGE_TTL)
+
+
+def remove_collection(icom, path):
+    """
+    irm -rf: one recursive removal run by the server, bypassing the trash.
+    False if the collection was already gone
+    """
+
+    try:
+        icom.prc.collections.remove(path, recurse=True, force=True)
+    except CollectionDoesNotExist:
+        return False
+    return True
+
+
+def orphan_trash(zone):
+    return f"/{zone.strip('/')}/trash/orphan"
+
+
+def purge_trash(
+    icom, zone=STAGE_TRASH_ZONE, batch_size=REAP_BATCH_SIZE, pause=REAP_PAUSE
+):
+    """
+    irmtrash --orphan: remove the entries of the orphan trash of zone, left
+    by removals that went through the trash. The trash of the users is not
+    touched, nor walked: each top entry is removed by the server
+    """
+
+    if not zone:
+        return 0
+
+    try:
+        trash = icom.prc.collections.get(orphan_trash(zone))
+    except CollectionDoesNotExist:
+        return 0
+
+    purged = 0
+    for collection in trash.subcollections:
+        collection.remove(recurse=True, force=True)
+        purged += 1
+        if purged % batch_size == 0:
+            time.sleep(pause)
+    for obj in trash.data_objects:
+        obj.unlink(force=True)
+        purged += 1
+        if purged % batch_size == 0:
+            time.sleep(pause)
+    return purged
+
+
+def free_collection(icom, collections, catalogue, path):
+    """
+    Release the replicas referenced by the stage collection at path
+    and remove it from the endpoint, where only the collections staged
+    before the shared replicas exist
+    """
+
+    released = catalogue.release(path)
+    removed = remove_collection(icom, path)
+    collections.update_one({"_id": path}, {"$set": {"freed": datetime.utcnow()}})
+    log.info("Freed {} ({} replicas released)", path, released)
+    return {"removed": removed, "released_replicas": released}
+
+
+def remove_replica(icom, stage_path):
+    try:
+        icom.prc.data_objects.unlink(stage_path, force=True)
+    except DataObjectDoesNotExist:
+        return False
+    return True
+
+
+def reap(
+    icom,
+    collections,
+    catalogue,
+    batch_size=REAP_BATCH_SIZE,
+    pause=REAP_PAUSE,
+    replica_ttl=REPLICA_TTL,
+):
+    """
+    Free the expired stage collections, then remove the replicas unused
+    for replica_ttl seconds, batch_size at a time with a pause in between
+    not to flood the endpoint
+    """
+
+    counts = {"collections": 0, "replicas": 0, "trash": 0}
+
+    while True:
+        now = datetime.utcnow()
+        expired = list(
+            collections.find(
+                {"freed": None, "expires": {"$lt": now}},
+                {"_id": 1},
+                sort=[("freed", 1), ("expires", 1)],
+                limit=batch_size,
+            )
+        )
+        for collection in expired:
+            free_collection(icom, collections, catalogue, collection["_id"])
+        counts["collections"] += len(expired)
+        if len(expired) < batch_size:
+            break
+        time.sleep(pause)
+
+    before = datetime.utcnow() - timedelta(seconds=replica_ttl)
+    while True:
+        replicas = catalogue.unreferenced(before, batch_size)
+        for replica in replicas:
+            # the document goes first: a request claiming it now copies it again
+            if catalogue.forget(replica["_id"]):
+                remove_replica(icom, replica["stage_path"])
+                counts["replicas"] += 1
+        if len(replicas) < batch_size:
+            break
+        time.sleep(pause)
+
+    counts["trash"] = purge_trash(icom, batch_size=batch_size, pause=pause)
+    if any(counts.values()):
+        log.info(
+            "Stage area reaped: {collections} collections, {replicas} replicas, "
+            "{trash} trash entries",
+            **counts,
+        )
+    return counts
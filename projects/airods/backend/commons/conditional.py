@@ -0,0 +1,92 @@
+"""
+Conditional GET: ETag / Last-Modified validators from the catalogue watermark
+"""
+
+import hashlib
+from datetime import timezone
+
+from flask import Response, after_this_request, request
+from pymongo import ReadPreference
+
+from airods.commons.cache import catalogue_version, results_cache, watermark
+from airods.commons.metrics import request_timer
+
+
+def query_etag(key, stamp):
+    """ Strong ETag of a normalized query (cache_key) on a catalogue state """
+
+    digest = hashlib.blake2b(repr((key, stamp)).encode(), digest_size=16)
+    return digest.hexdigest()
+
+
+def not_modified(key, collection):
+    """
+    A 304 response if the client copy of the key query is still current,
+    checked before any query runs. Otherwise None, and the validators
+    are added to the response the view builds
+    """
+
+    watermark.ensure_started(collection)
+    if watermark.stamp is None:
+        return None
+
+    etag = query_etag(key, watermark.stamp)
+    # HTTP dates have no sub-second part
+    modified = watermark.modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+    @after_this_request
+    def validators(response):
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = modified
+        return response
+
+    # If-None-Match wins over If-Modified-Since (RFC 7232, 6)
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304)
+        return None
+
+    since = request.if_modified_since
+    if since is not None:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if modified <= since:
+            return Response(status=304)
+
+    return None
+
+
+def cached_answer(key, collection, respond=None):
+    """
+    Answer of the key query before it runs: a 304 while the client copy is
+    current, otherwise respond(result) if the result is cached on the current
+    catalogue (no lookup without respond, e.g. for streamed responses).
+    Returns the response (None to run the query) and the catalogue version
+    to cache the new result on
+    """
+
+    cached = None
+    with request_timer().phase("cache"):
+        unchanged = not_modified(key, collection)
+        version = catalogue_version(collection)
+        if unchanged is None and respond is not None:
+            cached = results_cache.get(key, version)
+
+    if unchanged is not None:
+        return unchanged, version
+    if cached is not None:
+        return respond(cached), version
+    return None, version
+
+
+def validated_reads(collection):
+    """
+    Handle to read a validated response with: the primary, where the stamp
+    is read. A lagging secondary would serve older results under the ETag
+    of a newer catalogue, and the client would keep them on a 304
+    """
+
+    if watermark.stamp is None:
+        return collection
+    return collection.with_options(read_preference=ReadPreference.PRIMARY)
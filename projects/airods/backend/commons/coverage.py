@@ -0,0 +1,248 @@
+"""
+Spatial-temporal coverage tiles: wf_do counts per day and per lat/lon cell
+"""
+
+import math
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from restapi.utilities.logs import log
+
+# side of a tile, in degrees
+TILE_DEGREES = float(os.environ.get("AIRODS_TILE_DEGREES", 1.0))
+# wf_do documents folded into the tiles by each build round
+TILE_BATCH_SIZE = int(os.environ.get("AIRODS_TILE_BATCH_SIZE", 100000))
+# seconds a build holds the tiles without completing a round before
+# another process may take them over
+TILE_LEASE = int(os.environ.get("AIRODS_TILE_LEASE", 600))
+# seconds between two builds by the celery beat
+TILE_INTERVAL = int(os.environ.get("AIRODS_TILE_INTERVAL", 900))
+
+STATE_ID = "coverage_tile"
+DAY_FORMAT = "%Y-%m-%d"
+
+
+def cell(field, degrees=TILE_DEGREES):
+    """ Aggregation expression of the south/west edge of the tile of field """
+
+    return {"$multiply": [{"$floor": {"$divide": [f"${field}", degrees]}}, degrees]}
+
+
+def tile_pipeline(id_range, tiles_name):
+    """ Fold the wf_do documents of id_range into the tiles collection """
+
+    return [
+        {
+            "$match": {
+                "_id": id_range,
+                "dc_coverage_x": {"$type": "number"},
+                "dc_coverage_y": {"$type": "number"},
+                "dc_coverage_t_min": {"$type": "date"},
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "day": {
+                        "$dateToString": {
+                            "format": DAY_FORMAT,
+                            "date": "$dc_coverage_t_min",
+                        }
+                    },
+                    "lat": cell("dc_coverage_x"),
+                    "lon": cell("dc_coverage_y"),
+                },
+                "files": {"$sum": 1},
+                "t_min": {"$min": "$dc_coverage_t_min"},
+                "t_max": {"$max": "$dc_coverage_t_max"},
+            }
+        },
+        {
+            "$project": {
+                "_id": {
+                    "$concat": [
+                        "$_id.day",
+                        ":",
+                        {"$toString": "$_id.lat"},
+                        ":",
+                        {"$toString": "$_id.lon"},
+                    ]
+                },
+                "day": "$_id.day",
+                "lat": "$_id.lat",
+                "lon": "$_id.lon",
+                "files": 1,
+                "t_min": 1,
+                "t_max": 1,
+            }
+        },
+        {
+            "$merge": {
+                "into": tiles_name,
+                "whenMatched": [
+                    {
+                        "$set": {
+                            "files": {"$add": ["$files", "$$new.files"]},
+                            "t_min": {"$min": ["$t_min", "$$new.t_min"]},
+                            "t_max": {"$max": ["$t_max", "$$new.t_max"]},
+                        }
+                    }
+                ],
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def claim_tiles(state, owner, lease=TILE_LEASE):
+    """
+    Take the build lease of the tiles for owner: only one build at a time
+    folds documents, a concurrent one would count them twice.
+    Returns the state document, None while another build holds the lease
+    """
+
+    now = datetime.utcnow()
+    try:
+        return state.find_one_and_update(
+            {
+                "_id": STATE_ID,
+                "$or": [
+                    {"owner": None},
+                    {"owner": owner},
+                    {"lease": {"$lt": now}},
+                ],
+            },
+            {"$set": {"owner": owner, "lease": now + timedelta(seconds=lease)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # the state exists and its lease is held: the upsert collided
+        return None
+
+
+def advance_tiles(state, owner, last, lease=TILE_LEASE):
+    """ Move the watermark to last and renew the lease, False if it was lost """
+
+    result = state.update_one(
+        {"_id": STATE_ID, "owner": owner},
+        {
+            "$set": {
+                "last_id": last,
+                "lease": datetime.utcnow() + timedelta(seconds=lease),
+            }
+        },
+    )
+    return result.matched_count == 1
+
+
+def build_tiles(collection, tiles, state, batch_size=TILE_BATCH_SIZE, rebuild=False):
+    """
+    Incrementally fold the wf_do documents inserted since the last build
+    (by _id order) into the tiles, in rounds of batch_size documents.
+    Updated or deleted documents are only accounted for by a rebuild.
+    Returns the rounds folded, 0 if another build is running
+    """
+
+    owner = uuid.uuid4().hex
+    watermark = claim_tiles(state, owner)
+    if watermark is None:
+        log.info("Coverage tiles are being built by another process")
+        return 0
+
+    try:
+        return fold_tiles(
+            collection, tiles, state, owner, watermark, batch_size, rebuild
+        )
+    finally:
+        state.update_one(
+            {"_id": STATE_ID, "owner": owner}, {"$set": {"owner": None, "lease": None}}
+        )
+
+
+def fold_tiles(collection, tiles, state, owner, watermark, batch_size, rebuild):
+    if rebuild:
+        tiles.delete_many({})
+        if not advance_tiles(state, owner, None):
+            return 0
+        last = None
+    else:
+        last = watermark.get("last_id")
+
+    folded = 0
+    while True:
+        after = {"$gt": last} if last is not None else {"$exists": True}
+        upper = list(
+            collection.find({"_id": after}, {"_id": 1})
+            .sort("_id", 1)
+            .skip(batch_size - 1)
+            .limit(1)
+        )
+        if upper:
+            id_range = dict(after, **{"$lte": upper[0]["_id"]})
+        else:
+            newest = list(
+                collection.find({"_id": after}, {"_id": 1}).sort("_id", -1).limit(1)
+            )
+            if not newest:
+                break
+            id_range = dict(after, **{"$lte": newest[0]["_id"]})
+
+        # renew the lease before each round: a build that lost it stops
+        # before folding a range the new owner folds as well
+        if not advance_tiles(state, owner, last):
+            log.warning("Coverage tiles lease lost after {} rounds", folded)
+            break
+        collection.aggregate(tile_pipeline(id_range, tiles.name))
+        last = id_range["$lte"]
+        advance_tiles(state, owner, last)
+        folded += 1
+
+        if not upper:
+            break
+
+    if folded:
+        log.info("Coverage tiles updated in {} rounds", folded)
+    return folded
+
+
+def tiles_filter(start, end, minlat, minlon, maxlat, maxlon, degrees=TILE_DEGREES):
+    """ Filter of the tiles intersecting a bounding box and a time window """
+
+    return {
+        "day": {"$gte": start.strftime(DAY_FORMAT), "$lte": end.strftime(DAY_FORMAT)},
+        "lat": {"$gte": math.floor(minlat / degrees) * degrees, "$lte": maxlat},
+        "lon": {"$gte": math.floor(minlon / degrees) * degrees, "$lte": maxlon},
+    }
+
+
+def tiles_per_cell(query):
+    """ Aggregation of the daily tiles of query into one entry per cell """
+
+    return [
+        {"$match": query},
+        {
+            "$group": {
+                "_id": {"lat": "$lat", "lon": "$lon"},
+                "files": {"$sum": "$files"},
+                "days": {"$sum": 1},
+                "t_min": {"$min": "$t_min"},
+                "t_max": {"$max": "$t_max"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "lat": "$_id.lat",
+                "lon": "$_id.lon",
+                "files": 1,
+                "days": 1,
+                "t_min": 1,
+                "t_max": 1,
+            }
+        },
+        {"$sort": {"lat": 1, "lon": 1}},
+    ]
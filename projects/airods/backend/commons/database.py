@@ -0,0 +1,123 @@
+"""
+Mongo connection of the airods models, configured once per process
+"""
+
+import os
+import threading
+from urllib.parse import quote_plus
+
+from pymodm.connection import connect
+from pymongo import ReadPreference
+from restapi.services.detect import detector
+from restapi.utilities.logs import log
+
+from airods.models.mongo import (
+    CoverageTile,
+    StageCollection,
+    StageJob,
+    StageReplica,
+    wf_do,
+)
+
+# read preference of the read-only endpoints: with secondaryPreferred the
+# catalogue reads are spread over the replica set secondaries
+MONGO_READ_PREFERENCE = os.environ.get(
+    "AIRODS_MONGO_READ_PREFERENCE", "secondaryPreferred"
+)
+# connections per process
+MONGO_POOL_SIZE = int(os.environ.get("AIRODS_MONGO_POOL_SIZE", 100))
+# milliseconds to find a suitable server (and to connect to it)
+MONGO_SERVER_SELECTION_TIMEOUT = int(
+    os.environ.get("AIRODS_MONGO_SERVER_SELECTION_TIMEOUT", 5000)
+)
+# milliseconds to wait for a reply before failing the operation
+MONGO_SOCKET_TIMEOUT = int(os.environ.get("AIRODS_MONGO_SOCKET_TIMEOUT", 60000))
+
+# pymodm alias of the airods connection
+MONGO_ALIAS = "airods"
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+MODELS = (wf_do, CoverageTile, StageJob, StageReplica, StageCollection)
+
+
+def mongo_uri(variables):
+    """ mongodb:// URI of the database of the mongo service variables """
+
+    credentials = ""
+    if variables.get("user"):
+        credentials = "{}:{}@".format(
+            quote_plus(variables["user"]), quote_plus(variables.get("password", ""))
+        )
+    host = variables.get("host", "localhost")
+    port = variables.get("port", 27017)
+    return f"mongodb://{credentials}{host}:{port}/{variables.get('database')}"
+
+
+class MongoCollections:
+    """
+    pymongo handles of the airods models, all on one client. The models
+    are bound to it once, by the Initializer or by the first request
+    of a process, never per request
+    """
+
+    def __init__(self, read_preference=MONGO_READ_PREFERENCE):
+        self.read_preference = READ_PREFERENCES[read_preference]
+        self.configured = False
+        self.handles = {}
+        self.lock = threading.Lock()
+
+    def configure(self, variables):
+        with self.lock:
+            if self.configured:
+                return
+
+            # connect=False: no socket is opened before the workers fork
+            connect(
+                mongo_uri(variables),
+                alias=MONGO_ALIAS,
+                connect=False,
+                maxPoolSize=MONGO_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT,
+                connectTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT,
+            )
+            for model in MODELS:
+                model._mongometa.connection_alias = MONGO_ALIAS
+            self.configured = True
+
+        log.info(
+            "Mongo {} configured: pool {}, reads {}",
+            variables.get("database"),
+            MONGO_POOL_SIZE,
+            self.read_preference.name,
+        )
+
+    def get(self, model, read_only=False):
+        """
+        Collection of model. read_only handles follow the read preference,
+        the others (and everything written) go to the primary
+        """
+
+        key = (model.__name__, read_only)
+        handle = self.handles.get(key)
+        if handle is not None:
+            return handle
+
+        if not self.configured:
+            self.configure(detector.get_service_instance("mongo").variables)
+
+        handle = model._mongometa.collection
+        if read_only:
+            handle = handle.with_options(read_preference=self.read_preference)
+        self.handles[key] = handle
+        return handle
+
+
+mongo_collections = MongoCollections()
@@ -0,0 +1,190 @@
+"""
+Compact encodings of result sets: columnar JSON, MessagePack, Arrow IPC, Parquet
+"""
+
+import os
+from datetime import datetime, timezone
+
+from flask import Response, stream_with_context
+
+from airods.commons.streaming import JSON_MIMETYPE, dumps
+
+# optional encoders: their formats are offered only when installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows per Arrow record batch / Parquet row group
+ARROW_BATCH_SIZE = int(os.environ.get("AIRODS_ARROW_BATCH_SIZE", 10000))
+
+MIMETYPES = {
+    "json": JSON_MIMETYPE,
+    "columnar": JSON_MIMETYPE,
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+DATE_FIELDS = (
+    "dc_date",
+    "dc_coverage_t_min",
+    "dc_coverage_t_max",
+    "dcterms_available",
+    "dcterms_dateAccepted",
+)
+FLOAT_FIELDS = ("dc_coverage_x", "dc_coverage_y", "dc_coverage_z")
+INTEGER_FIELDS = ("file_size", "year", "doy")
+
+
+def output_formats():
+    """ The format= values supported by the installed encoders """
+
+    formats = ["json", "columnar"]
+    if msgpack is not None:
+        formats.append("msgpack")
+    if pyarrow is not None:
+        formats += ["arrow", "parquet"]
+    return formats
+
+
+OUTPUT_FORMATS = output_formats()
+
+
+def columns(documents, fields):
+    """ One list of values per field, in the order of documents """
+
+    values = {field: [] for field in fields}
+    for document in documents:
+        for field in fields:
+            values[field].append(document.get(field))
+    return values
+
+
+def column_batches(documents, fields, batch_size=ARROW_BATCH_SIZE):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield columns(batch, fields)
+            batch = []
+    if batch:
+        yield columns(batch, fields)
+
+
+def msgpack_default(value):
+    # naive datetimes from pymongo are UTC: sent as MessagePack timestamps
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return msgpack.Timestamp.from_datetime(value)
+    return str(value)
+
+
+def columnar_body(documents, fields, output_format, next_token=None):
+    """ {"columns": {field: [values]}, "count": n, "next": token} encoded """
+
+    values = columns(documents, fields)
+    body = {
+        "columns": values,
+        "count": len(values[fields[0]]) if fields else 0,
+        "next": next_token,
+    }
+    if output_format == "msgpack":
+        return msgpack.packb(body, default=msgpack_default)
+    return dumps(body)
+
+
+def arrow_schema(fields):
+    def field_type(field):
+        if field in DATE_FIELDS:
+            return pyarrow.timestamp("ms", tz="UTC")
+        if field in FLOAT_FIELDS:
+            return pyarrow.float64()
+        if field in INTEGER_FIELDS:
+            return pyarrow.int64()
+        return pyarrow.string()
+
+    return pyarrow.schema([(field, field_type(field)) for field in fields])
+
+
+class ChunkSink:
+    """ Write-only file collecting what the Arrow writers produce """
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_chunks(documents, fields, output_format, batch_size=ARROW_BATCH_SIZE):
+    """
+    Yield an Arrow IPC stream (or a Parquet file) of the documents,
+    one record batch (row group) of batch_size documents at a time
+    """
+
+    schema = arrow_schema(fields)
+    sink = ChunkSink()
+    stream = pyarrow.PythonFile(sink, mode="w")
+    if output_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(stream, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(stream, schema)
+
+    try:
+        for values in column_batches(documents, fields, batch_size):
+            writer.write_table(pyarrow.Table.from_pydict(values, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def format_response(documents, fields, output_format, page=None):
+    """
+    Response of documents (projected on fields) in output_format.
+    page, the KeysetPage of documents if any, adds its next token
+    to the body of the JSON/MessagePack formats and as a header
+    """
+
+    fields = list(fields)
+    headers = {}
+    if page is not None:
+        # bounded by the page size: read it first to know the next token
+        documents = list(documents)
+        if page.next:
+            headers["X-Next-Token"] = page.next
+
+    mimetype = MIMETYPES[output_format]
+    if output_format in ("columnar", "msgpack"):
+        next_token = page.next if page is not None else None
+        body = columnar_body(documents, fields, output_format, next_token)
+        return Response(body, mimetype=mimetype, headers=headers)
+
+    return Response(
+        stream_with_context(arrow_chunks(documents, fields, output_format)),
+        mimetype=mimetype,
+        headers=headers,
+    )
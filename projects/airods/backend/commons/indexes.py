@@ -0,0 +1,226 @@
+"""
+Reconcile the wf_do indexes and verify that queries are index-backed
+"""
+
+import os
+
+from pymongo.errors import OperationFailure
+from restapi.utilities.logs import log
+
+from airods.commons.queries import DAY_FORMAT
+
+# documents updated by each backfill round
+BACKFILL_BATCH_SIZE = int(os.environ.get("AIRODS_BACKFILL_BATCH_SIZE", 10000))
+# seconds between two backfill runs by the celery beat (documents ingested
+# meanwhile)
+BACKFILL_INTERVAL = int(os.environ.get("AIRODS_BACKFILL_INTERVAL", 600))
+# documents spanning more days are not bucketed (days: null), see day_buckets
+DAY_BUCKETS_MAX = 31
+DAY_MS = 86400000
+
+
+class QueryPlanError(Exception):
+    """ Raised when a query that must be indexed is planned as a COLLSCAN """
+
+
+def ensure_indexes(collection, indexes):
+    """
+    Create the missing indexes and rebuild those whose keys changed.
+    Indexes not listed here (e.g. created by the ingestion) are left alone.
+    Safe to call at every startup.
+    """
+
+    existing = collection.index_information()
+    missing = []
+
+    for index in indexes:
+        document = index.document
+        name = document["name"]
+        keys = list(document["key"].items())
+
+        current = existing.get(name)
+        if current is not None:
+            if list(current["key"]) == keys:
+                continue
+            log.warning("Index {} changed, rebuilding it", name)
+            collection.drop_index(name)
+
+        missing.append(index)
+
+    if not missing:
+        log.debug("{} indexes are up to date", collection.name)
+        return []
+
+    names = [index.document["name"] for index in missing]
+    log.info("Building {} indexes: {}", collection.name, ", ".join(names))
+    try:
+        return collection.create_indexes(missing)
+    except OperationFailure as e:
+        log.error("Failed to build {} indexes: {}", collection.name, e)
+        raise
+
+
+def plan_stages(plan):
+    """ Yield every stage name of an explain() plan tree """
+
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def assert_indexed(collection, query):
+    """ Raise QueryPlanError if the winning plan of query scans the collection """
+
+    explain = collection.find(query).explain()
+    winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+
+    if "COLLSCAN" in plan_stages(winning):
+        raise QueryPlanError(
+            f"Query on {collection.name} is not index-backed (COLLSCAN): {query}"
+        )
+
+    return winning
+
+
+def backfill_points(collection):
+    """ Derive dc_coverage_point from the coordinates where it is missing """
+
+    result = collection.update_many(
+        {
+            "dc_coverage_point": {"$exists": False},
+            "dc_coverage_x": {"$type": "number"},
+            "dc_coverage_y": {"$type": "number"},
+        },
+        [
+            {
+                "$set": {
+                    "dc_coverage_point": {
+                        "type": "Point",
+                        "coordinates": ["$dc_coverage_y", "$dc_coverage_x"],
+                    }
+                }
+            }
+        ],
+    )
+    if result.modified_count:
+        log.info("Backfilled dc_coverage_point on {} documents", result.modified_count)
+    return result.modified_count
+
+
+def nscl_part(index, to_int=False):
+    """ Aggregation expression of the index-th dot separated part of fileId """
+
+    part = {"$arrayElemAt": [{"$split": ["$fileId", "."]}, index]}
+    if to_int:
+        part = {"$convert": {"input": part, "to": "int", "onError": None}}
+    return {"$ifNull": [part, None]}
+
+
+def backfill(collection, query, update, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Apply the pipeline update to the documents of query, server-side in
+    rounds of batch_size documents. The update must take them out of query
+    """
+
+    total = 0
+    while True:
+        ids = [
+            document["_id"]
+            for document in collection.find(query, {"_id": 1}, limit=batch_size)
+        ]
+        if not ids:
+            break
+        total += collection.update_many({"_id": {"$in": ids}}, update).modified_count
+        log.debug("{} backfill: {} documents updated", collection.name, total)
+    return total
+
+
+def backfill_nscl(collection, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Parse fileId (e.g. IV.ACER..HHE.D.2015.015) into network, station,
+    location, channel, year and doy, where not done yet. Runs server-side
+    in rounds of batch_size documents; unparsable fileIds get null fields
+    """
+
+    parse = [
+        {
+            "$set": {
+                "network": nscl_part(0),
+                "station": nscl_part(1),
+                "location": nscl_part(2),
+                "channel": nscl_part(3),
+                "year": nscl_part(5, to_int=True),
+                "doy": nscl_part(6, to_int=True),
+            }
+        }
+    ]
+
+    total = backfill(
+        collection,
+        {"network": {"$exists": False}, "fileId": {"$type": "string"}},
+        parse,
+        batch_size,
+    )
+    if total:
+        log.info("Backfilled NSCL fields on {} documents", total)
+    return total
+
+
+def day_buckets(max_days=DAY_BUCKETS_MAX):
+    """
+    Aggregation expression of the day keys (UTC) covered by
+    [dc_coverage_t_min, dc_coverage_t_max], null beyond max_days
+    """
+
+    t_min = {"$toLong": "$dc_coverage_t_min"}
+    t_max = {"$toLong": "$dc_coverage_t_max"}
+    # midnight of the first day, in ms
+    first = {"$subtract": [t_min, {"$mod": [t_min, DAY_MS]}]}
+    after = {"$floor": {"$divide": [{"$subtract": [t_max, "$$first"]}, DAY_MS]}}
+    count = {"$add": [after, 1]}
+    midnight = {"$toDate": {"$add": ["$$first", {"$multiply": ["$$day", DAY_MS]}]}}
+
+    keys = {
+        "$map": {
+            "input": {"$range": [0, {"$toInt": "$$count"}]},
+            "as": "day",
+            "in": {"$dateToString": {"format": DAY_FORMAT, "date": midnight}},
+        }
+    }
+    return {
+        "$let": {
+            "vars": {"first": first},
+            "in": {
+                "$let": {
+                    "vars": {"count": count},
+                    "in": {"$cond": [{"$gt": ["$$count", max_days]}, None, keys]},
+                }
+            },
+        }
+    }
+
+
+def backfill_days(collection, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Bucket the time span of the documents into the days field (the overlap
+    queries of commons/queries.py:time_filter), where not done yet
+    """
+
+    total = backfill(
+        collection,
+        {
+            "days": {"$exists": False},
+            "dc_coverage_t_min": {"$type": "date"},
+            "dc_coverage_t_max": {"$type": "date"},
+        },
+        [{"$set": {"days": day_buckets()}}],
+        batch_size,
+    )
+    if total:
+        log.info("Backfilled day buckets on {} documents", total)
+    return total
@@ -0,0 +1,417 @@
+"""
+Per-request phase timings, exported as a Server-Timing header and as
+Prometheus histograms/counters (text exposition format)
+"""
+
+import functools
+import glob
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import after_this_request, g
+from restapi.utilities.logs import log
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# requests slower than this (seconds) are candidates for the slow log
+SLOW_REQUEST_SECONDS = float(os.environ.get("AIRODS_SLOW_REQUEST_SECONDS", 5))
+# fraction of the slow requests written to the log
+SLOW_REQUEST_SAMPLE = float(os.environ.get("AIRODS_SLOW_REQUEST_SAMPLE", 0.1))
+
+# directory shared by the worker processes of a server: each one writes its
+# metrics there and /metrics answers with their sums (empty: per process
+# series, labelled with the worker pid). Empty it when the server starts
+METRICS_DIR = os.environ.get("AIRODS_METRICS_DIR", "")
+# seconds between two writes of the metrics of a worker
+METRICS_FLUSH = float(os.environ.get("AIRODS_METRICS_FLUSH", 5))
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label_string(names, values):
+    if not names:
+        return ""
+    pairs = (f'{n}="{str(v).replace(chr(34), "")}"' for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    @staticmethod
+    def combine(value, other):
+        return value + other
+
+    def render(self, values, extra=()):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        names = self.labels + tuple(name for name, _ in extra)
+        extra = tuple(value for _, value in extra)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{label_string(names, key + extra)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+    @staticmethod
+    def combine(counts, other):
+        return [count + more for count, more in zip(counts, other)]
+
+    def render(self, values, extra=()):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + tuple(name for name, _ in extra)
+        extra = tuple(value for _, value in extra)
+        for key, counts in sorted(values.items()):
+            key += extra
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = label_string(names + ("le",), key + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = label_string(names, key)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+REQUEST_SECONDS = Histogram(
+    "airods_request_seconds",
+    "Duration of the airods requests",
+    ("endpoint", "mode"),
+)
+PHASE_SECONDS = Histogram(
+    "airods_phase_seconds",
+    "Time spent in each phase of the airods requests",
+    ("endpoint", "mode", "phase"),
+)
+REQUESTS = Counter(
+    "airods_requests_total",
+    "Served airods requests",
+    ("endpoint", "mode", "status"),
+)
+PHASE_CALLS = Counter(
+    "airods_phase_calls_total",
+    "Mongo queries, iRODS rules and iCAT queries run by the airods requests",
+    ("endpoint", "mode", "phase"),
+)
+DOCUMENTS = Counter(
+    "airods_documents_total",
+    "Catalogue documents read by the airods requests",
+    ("endpoint", "mode"),
+)
+SLOW_REQUESTS = Counter(
+    "airods_slow_requests_total",
+    f"airods requests slower than {SLOW_REQUEST_SECONDS}s",
+    ("endpoint", "mode"),
+)
+
+METRICS = (
+    REQUEST_SECONDS,
+    PHASE_SECONDS,
+    REQUESTS,
+    PHASE_CALLS,
+    DOCUMENTS,
+    SLOW_REQUESTS,
+)
+
+
+class MetricsExport:
+    """
+    Metrics of the worker processes of a server: each one writes its values
+    to a file of directory every METRICS_FLUSH seconds, read back and summed
+    by the worker answering /metrics. The files of the workers gone are
+    kept, the totals never go back
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush=METRICS_FLUSH):
+        self.directory = directory
+        self.flush = flush
+        self.pid = None
+        self.path = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        # threads do not survive a fork: one writer per worker process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # a pid may be reused by a later worker
+            self.path = os.path.join(
+                self.directory, f"{self.pid}-{time.time_ns()}.json"
+            )
+
+        threading.Thread(target=self.run, name="airods-metrics", daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush)
+            self.write()
+
+    def write(self):
+        snapshot = {
+            metric.name: [
+                [list(key), value] for key, value in metric.snapshot().items()
+            ]
+            for metric in METRICS
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            partial = f"{self.path}.tmp"
+            # written by the flush thread and by /metrics
+            with self.lock:
+                with open(partial, "w") as output:
+                    json.dump(snapshot, output)
+                # readers see the previous snapshot or this one, never a part
+                os.replace(partial, self.path)
+        except OSError as e:
+            log.warning("Cannot write the metrics to {}: {}", self.directory, e)
+
+    def read(self):
+        """ Values of every metric, summed over the worker files """
+
+        totals = {metric.name: {} for metric in METRICS}
+        combine = {metric.name: metric.combine for metric in METRICS}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path) as source:
+                    snapshot = json.load(source)
+            except (OSError, ValueError) as e:
+                log.debug("Skipping the metrics of {}: {}", path, e)
+                continue
+            for name, values in snapshot.items():
+                if name not in totals:
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    current = totals[name].get(key)
+                    totals[name][key] = (
+                        value if current is None else combine[name](current, value)
+                    )
+        return totals
+
+
+metrics_export = MetricsExport() if METRICS_DIR else None
+
+
+def render_metrics():
+    """
+    Text exposition of the metrics of all the workers (METRICS_DIR), or
+    of this worker only, its series labelled with its pid
+    """
+
+    extra = ()
+    if metrics_export is not None:
+        metrics_export.ensure_started()
+        metrics_export.write()
+        totals = metrics_export.read()
+    else:
+        totals = {metric.name: metric.snapshot() for metric in METRICS}
+        extra = (("pid", os.getpid()),)
+
+    lines = [
+        line for metric in METRICS for line in metric.render(totals[metric.name], extra)
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    """
+    Phase timings of one request. Phases may run more than once
+    (e.g. one iRODS rule per batch) and from several threads:
+    their durations and calls are summed
+    """
+
+    def __init__(self, endpoint, mode="default"):
+        self.endpoint = endpoint
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.documents = 0
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds, calls=1):
+        with self.lock:
+            total, count = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (total + seconds, count + calls)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name, function):
+        """ function, recording each of its calls as a name phase """
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def iterate(self, cursor):
+        """
+        Yield the cursor documents, timing the query (up to the first
+        batch) apart from the following fetches, but not the consumer
+        """
+
+        query = fetch = 0.0
+        count = 0
+        iterator = iter(cursor)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    document = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    if count:
+                        fetch += time.perf_counter() - start
+                    else:
+                        query += time.perf_counter() - start
+                count += 1
+                yield document
+        finally:
+            self.add("mongo_query", query)
+            self.add("mongo_iterate", fetch)
+            with self.lock:
+                self.documents += count
+
+    def server_timing(self):
+        with self.lock:
+            phases = sorted(self.phases.items())
+        timings = [f"{name};dur={total * 1000:.1f}" for name, (total, _) in phases]
+        total = time.perf_counter() - self.started
+        timings.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(timings)
+
+    def finish(self, status):
+        elapsed = time.perf_counter() - self.started
+        labels = {"endpoint": self.endpoint, "mode": self.mode}
+        if metrics_export is not None:
+            metrics_export.ensure_started()
+
+        REQUEST_SECONDS.observe(elapsed, **labels)
+        REQUESTS.inc(status=status, **labels)
+        DOCUMENTS.inc(self.documents, **labels)
+        with self.lock:
+            phases = sorted(self.phases.items())
+        for name, (total, calls) in phases:
+            PHASE_SECONDS.observe(total, phase=name, **labels)
+            PHASE_CALLS.inc(calls, phase=name, **labels)
+
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            SLOW_REQUESTS.inc(**labels)
+            if random.random() < SLOW_REQUEST_SAMPLE:
+                log.warning(
+                    "Slow request {} ({}): {:.1f}s, {} documents, {}",
+                    self.endpoint,
+                    self.mode,
+                    elapsed,
+                    self.documents,
+                    self.server_timing(),
+                )
+
+
+def request_timer():
+    """ Timer of the current request (a detached one outside instrumented views) """
+
+    timer = g.get("airods_timer")
+    if timer is None:
+        timer = RequestTimer("unknown")
+    return timer
+
+
+def query_mode(mode, paged=False, overlap=False):
+    """ Metrics mode of a catalogue query: its output, then how it selects """
+
+    if paged:
+        mode += "_page"
+    if overlap:
+        mode += "_overlap"
+    return mode
+
+
+def instrumented(endpoint):
+    """
+    Time the decorated view: its phases go out in the Server-Timing header
+    and, once the response is sent (streamed bodies included), into the metrics
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            timer = g.airods_timer = RequestTimer(endpoint)
+
+            @after_this_request
+            def record(response):
+                response.headers["Server-Timing"] = timer.server_timing()
+                if not response.is_streamed:
+                    timer.finish(response.status_code)
+                    return response
+
+                # the body is produced after the headers: the whole
+                # transfer is recorded as a stream phase once it ends
+                sent = time.perf_counter()
+
+                def streamed():
+                    timer.add("stream", time.perf_counter() - sent)
+                    timer.finish(response.status_code)
+
+                response.call_on_close(streamed)
+                return response
+
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
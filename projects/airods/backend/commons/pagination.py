@@ -0,0 +1,89 @@
+"""
+Keyset pagination on (dc_coverage_t_min, _id)
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING
+from restapi.exceptions import BadRequest
+
+from airods.commons.queries import projection
+
+SORT_FIELD = "dc_coverage_t_min"
+PAGE_SORT = [(SORT_FIELD, ASCENDING), ("_id", ASCENDING)]
+
+
+def encode_token(document):
+    """ Opaque token carrying the sort key of the last document of a page """
+
+    key = {"t": document[SORT_FIELD].isoformat(), "id": str(document["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_token(token):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.fromisoformat(key["t"]), ObjectId(key["id"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise BadRequest("Invalid next token")
+
+
+def keyset_filter(query, token):
+    """ Restrict query to the documents sorted after the token """
+
+    if not token:
+        return query
+
+    last_t, last_id = decode_token(token)
+    after = {
+        "$or": [
+            {SORT_FIELD: {"$gt": last_t}},
+            {SORT_FIELD: last_t, "_id": {"$gt": last_id}},
+        ]
+    }
+    return {"$and": [query, after]}
+
+
+class KeysetPage:
+    """
+    Iterate one page of at most limit documents projected on fields.
+    Once exhausted, next holds the token of the following page (or None)
+    """
+
+    def __init__(self, collection, query, fields, limit, token=None, **kwargs):
+
+        spec = projection(fields)
+        # the sort key is needed to build the token, stripped from the output
+        spec["_id"] = 1
+        spec[SORT_FIELD] = 1
+        self.strip = {key for key in ("_id", SORT_FIELD) if key not in fields}
+
+        self.limit = limit
+        self.next = None
+        # one extra document tells whether a following page exists
+        self.cursor = collection.find(
+            keyset_filter(query, token),
+            spec,
+            sort=PAGE_SORT,
+            limit=limit + 1,
+            **kwargs,
+        )
+
+    def __iter__(self):
+        last = None
+        for count, document in enumerate(self.cursor):
+            if count == self.limit:
+                self.next = encode_token(last)
+                break
+            last = document
+            yield {k: v for k, v in document.items() if k not in self.strip}
+
+    def with_next(self):
+        """ The page documents followed by a {"next": token} trailer """
+
+        yield from self
+        yield {"next": self.next}
@@ -0,0 +1,310 @@
+"""
+Mongo query builders shared by the airods endpoints
+"""
+
+import os
+import re
+from datetime import timedelta, timezone
+
+from restapi.exceptions import BadRequest
+
+# Dublin Core fields returned by /airods/meta
+META_FIELDS = (
+    "fileId",
+    "dc_identifier",
+    "dc_coverage_x",
+    "dc_coverage_y",
+    "dc_coverage_z",
+    "dc_title",
+    "dc_subject",
+    "dc_creator",
+    "dc_contributor",
+    "dc_publisher",
+    "dc_type",
+    "dc_format",
+    "dc_date",
+    "dc_coverage_t_min",
+    "dc_coverage_t_max",
+    "dcterms_available",
+    "dcterms_dateAccepted",
+    "dc_rights",
+    "dcterms_isPartOf",
+    "irods_path",
+)
+
+# Minimal fields of the /airods/data PID list
+PID_FIELDS = ("fileId", "dc_identifier", "irods_path")
+
+# bytes assumed for the objects without a recorded file_size
+AVG_OBJECT_SIZE = int(os.environ.get("AIRODS_AVG_OBJECT_SIZE", 6000000))
+
+# Enable the optional 2dsphere point field (dc_coverage_point) in bbox filters
+GEO_INDEX = os.environ.get("AIRODS_GEO_INDEX", "0") == "1"
+
+# Outward padding (degrees) applied to the geo polygon, larger than the
+# geodesic bulge of a densified edge, so that the polygon is always a superset
+# of the planar lat/lon box. The exact box is then applied as residual filter
+GEO_PADDING = 0.01
+# Max longitude step (degrees) between two vertices of a polygon edge
+GEO_EDGE_STEP = 1.0
+
+# day bucket keys of the days field (see commons/indexes.py:backfill_days)
+DAY_FORMAT = "%Y-%m-%d"
+# overlap windows longer than this (days) fall back to the time range scan
+OVERLAP_MAX_DAYS = int(os.environ.get("AIRODS_OVERLAP_MAX_DAYS", 3660))
+
+
+def box_polygon(minlat, minlon, maxlat, maxlon):
+    """ GeoJSON polygon covering the lat/lon box, with densified parallels """
+
+    south = max(minlat - GEO_PADDING, -90.0)
+    north = min(maxlat + GEO_PADDING, 90.0)
+    west = max(minlon - GEO_PADDING, -180.0)
+    east = min(maxlon + GEO_PADDING, 180.0)
+
+    steps = max(1, int((east - west) / GEO_EDGE_STEP) + 1)
+    lons = [west + (east - west) * i / steps for i in range(steps + 1)]
+
+    ring = [[lon, south] for lon in lons]
+    ring += [[lon, north] for lon in reversed(lons)]
+    ring.append(ring[0])
+
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def day_keys(start, end):
+    """ Day bucket keys (UTC) from the day of start to the day of end """
+
+    def day(value):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.date()
+
+    first, last = day(start), day(end)
+    return [
+        (first + timedelta(days=i)).strftime(DAY_FORMAT)
+        for i in range((last - first).days + 1)
+    ]
+
+
+def time_filter(start, end, overlap=False):
+    """
+    Time window condition: documents inside the window or, with overlap,
+    documents intersecting it (t_min < end and t_max > start). The two open
+    ranges of an overlap are bounded by the days multikey index: an equality
+    match on the days of the window, the exact window as residual filter
+    """
+
+    if not overlap:
+        return {
+            "dc_coverage_t_min": {"$gte": start},
+            "dc_coverage_t_max": {"$lte": end},
+        }
+
+    query = {
+        "dc_coverage_t_min": {"$lt": end},
+        "dc_coverage_t_max": {"$gt": start},
+    }
+    days = day_keys(start, end)
+    if len(days) <= OVERLAP_MAX_DAYS:
+        # null: documents not bucketed yet, or spanning too many days
+        query["days"] = {"$in": days + [None]}
+    return query
+
+
+def bbox_filter(start, end, minlat, minlon, maxlat, maxlon, overlap=False):
+    """ Filter of wf_do documents inside a bounding box and a time window """
+
+    query = time_filter(start, end, overlap)
+    query["dc_coverage_x"] = {"$gte": minlat, "$lte": maxlat}
+    query["dc_coverage_y"] = {"$gte": minlon, "$lte": maxlon}
+
+    if GEO_INDEX:
+        query["dc_coverage_point"] = {
+            "$geoWithin": {"$geometry": box_polygon(minlat, minlon, maxlat, maxlon)}
+        }
+
+    return query
+
+
+def projection(fields):
+    """ Mongo projection returning only the given fields """
+
+    spec = {field: 1 for field in fields}
+    spec["_id"] = 0
+    return spec
+
+
+def select_fields(output_fields, allowed=META_FIELDS):
+    """ Parse the comma separated fields= parameter, None if not given """
+
+    if not output_fields:
+        return None
+
+    selected = tuple(f.strip() for f in output_fields.split(",") if f.strip())
+    unknown = [f for f in selected if f not in allowed]
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}")
+
+    return selected
+
+
+def fdsn_pattern(code, any_char=".", any_chars=".*"):
+    """ Regex source of an FDSN code, with ? and * wildcards """
+
+    return "".join(
+        any_char if c == "?" else any_chars if c == "*" else re.escape(c) for c in code
+    )
+
+
+def code_condition(codes, blank="--"):
+    """
+    Mongo condition on a parsed NSCL field from an FDSN-style code list
+    (e.g. "IV,MN", "AC*", "HH?"): exact codes and anchored regexes, so that
+    the lookup is bounded by the index. None if every code is accepted
+    """
+
+    values = []
+    for code in (c.strip() for c in codes.split(",")):
+        if code in ("", "*"):
+            return None
+        if code == blank:
+            values.append("")
+        elif not re.search(r"[*?]", code):
+            values.append(code)
+        elif re.fullmatch(r"[^*?]+\*", code):
+            # prefix: the regex is an index range scan
+            values.append(re.compile("^" + re.escape(code[:-1])))
+        else:
+            values.append(re.compile("^" + fdsn_pattern(code) + "$"))
+
+    if len(values) == 1:
+        return values[0]
+    return {"$in": values}
+
+
+def file_id_pattern(network, station, location, channel):
+    """ Anchored fileId regex (N.S.L.C.) for the documents not yet parsed """
+
+    def alternatives(codes):
+        options = []
+        for code in (c.strip() for c in codes.split(",")):
+            if code in ("", "*"):
+                return "[^.]*"
+            options.append("" if code == "--" else fdsn_pattern(code, "[^.]", "[^.]*"))
+        if len(options) == 1:
+            # a literal stays a plain anchored prefix (^IV\.ACER\.)
+            return options[0]
+        return "(?:" + "|".join(options) + ")"
+
+    parts = (network, station, location, channel)
+    return re.compile("^" + r"\.".join(alternatives(p) for p in parts) + r"\.")
+
+
+def nscl_filter(start, end, network, station, channel, location, overlap=False):
+    """ Filter of wf_do documents by network/station/channel/location codes """
+
+    codes = {
+        "network": network,
+        "station": station,
+        "location": location,
+        "channel": channel,
+    }
+    parsed = {}
+    for field, value in codes.items():
+        condition = code_condition(value or "")
+        if condition is not None:
+            parsed[field] = condition
+
+    # example of fileId "IV.ACER..HHE.D.2015.015", parsed into the NSCL fields
+    # by backfill_nscl (periodically): the documents ingested since the last
+    # run still match on fileId
+    query = time_filter(start, end, overlap)
+    query["$or"] = [
+        parsed or {"network": {"$ne": None}},
+        {
+            "network": None,
+            "fileId": file_id_pattern(network, station, location, channel),
+        },
+    ]
+    return query
+
+
+def summary_pipeline(query):
+    """
+    Aggregation counting the documents of query, their estimated bytes and
+    their histograms per day and per network/station, in a single document
+    """
+
+    return [
+        {"$match": query},
+        {
+            "$facet": {
+                "total": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "files": {"$sum": 1},
+                            "bytes": {
+                                "$sum": {"$ifNull": ["$file_size", AVG_OBJECT_SIZE]}
+                            },
+                        }
+                    }
+                ],
+                "per_day": [
+                    {
+                        "$group": {
+                            "_id": {
+                                "$dateToString": {
+                                    "format": "%Y-%m-%d",
+                                    "date": "$dc_coverage_t_min",
+                                }
+                            },
+                            "files": {"$sum": 1},
+                        }
+                    },
+                    {"$sort": {"_id": 1}},
+                ],
+                "per_station": [
+                    {
+                        "$group": {
+                            "_id": {
+                                "$concat": [
+                                    {"$ifNull": ["$network", "?"]},
+                                    ".",
+                                    {"$ifNull": ["$station", "?"]},
+                                ]
+                            },
+                            "files": {"$sum": 1},
+                        }
+                    },
+                    {"$sort": {"_id": 1}},
+                ],
+            }
+        },
+    ]
+
+
+def stage_filter(selection):
+    """ Filter of the documents to stage, from the StageInput parameters """
+
+    if selection.get("nscl"):
+        return nscl_filter(
+            selection["start"],
+            selection["end"],
+            selection["network"],
+            selection["station"],
+            selection["channel"],
+            selection["location"],
+            selection.get("overlap", False),
+        )
+
+    return bbox_filter(
+        selection["start"],
+        selection["end"],
+        selection["minlat"],
+        selection["minlon"],
+        selection["maxlat"],
+        selection["maxlon"],
+        selection.get("overlap", False),
+    )
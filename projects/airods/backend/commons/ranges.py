@@ -0,0 +1,150 @@
+"""
+Single data object download with HTTP Range support
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+
+from flask import Response, request, stream_with_context
+from werkzeug.http import http_date
+
+from airods.commons.archive import DOWNLOAD_CHUNK_SIZE
+
+# ranges larger than a part are read by concurrent iRODS reads
+RANGE_PART_SIZE = int(os.environ.get("AIRODS_RANGE_PART_SIZE", 8388608))
+RANGE_WORKERS = int(os.environ.get("AIRODS_RANGE_WORKERS", 4))
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def object_etag(obj):
+    """ Strong validator of a data object: its checksum if any """
+
+    if obj.checksum:
+        return obj.checksum
+    mtime = int(obj.modify_time.timestamp()) if obj.modify_time else 0
+    return f"{obj.size:x}-{mtime:x}"
+
+
+def utc_seconds(moment):
+    """ Epoch seconds of a naive (UTC) or aware datetime """
+
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def requested_range(size, etag, modified):
+    """
+    (start, stop) of the Range requested for an object of size bytes,
+    None for the whole object: Range missing or multiple, If-Range not
+    matching. Raise RangeNotSatisfiable if the range is out of the object
+    """
+
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (
+        modified is None or utc_seconds(modified) > utc_seconds(if_range.date)
+    ):
+        return None
+
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+        raise RangeNotSatisfiable()
+    return bounds
+
+
+def read_part(obj, offset, length, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """ length bytes of obj from offset, read on a dedicated handle """
+
+    data = []
+    with obj.open("r") as handle:
+        handle.seek(offset)
+        while length > 0:
+            chunk = handle.read(min(length, chunk_size))
+            if not chunk:
+                break
+            length -= len(chunk)
+            data.append(chunk)
+    return b"".join(data)
+
+
+def read_range(obj, start, stop, part_size=RANGE_PART_SIZE, workers=RANGE_WORKERS):
+    """ Yield the bytes [start, stop) of obj in order """
+
+    if stop - start <= part_size:
+        # sequential, chunk by chunk
+        with obj.open("r") as handle:
+            handle.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = handle.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        return
+
+    # at most workers parts are read (and held in memory) ahead of the client
+    offsets = iter(range(start, stop, part_size))
+    with ThreadPoolExecutor(workers, thread_name_prefix="airods-range") as executor:
+        pending = []
+
+        def submit():
+            offset = next(offsets, None)
+            if offset is not None:
+                length = min(part_size, stop - offset)
+                pending.append(executor.submit(read_part, obj, offset, length))
+
+        for _ in range(workers):
+            submit()
+        try:
+            while pending:
+                data = pending.pop(0).result()
+                submit()
+                yield data
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def stream_object(obj, filename):
+    """ 200/206/416 response for the iRODS data object obj """
+
+    etag = object_etag(obj)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+    if obj.modify_time:
+        headers["Last-Modified"] = http_date(obj.modify_time)
+
+    try:
+        bounds = requested_range(obj.size, etag, obj.modify_time)
+    except RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{obj.size}"
+        return Response(status=416, headers=headers)
+
+    status = 200
+    start, stop = 0, obj.size
+    if bounds is not None:
+        status = 206
+        start, stop = bounds
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{obj.size}"
+
+    headers["Content-Length"] = str(stop - start)
+    return Response(
+        stream_with_context(read_range(obj, start, stop)),
+        status=status,
+        mimetype="application/octet-stream",
+        headers=headers,
+    )
@@ -0,0 +1,284 @@
+"""
+Stage catalogue: one replica per (endpoint, irods_path, checksum) on the
+stage area, shared by every stage collection that selected that object
+"""
+
+import hashlib
+import os
+import posixpath
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from irods.column import In
+from irods.models import Collection, DataObject
+from pymongo import UpdateOne
+
+# replicas live under <stage path>/replicas/<version digest>/<irods_path>
+REPLICAS_DIR = "replicas"
+# seconds after which a replica still staging is taken over by a new request
+STAGE_CLAIM_TIMEOUT = int(os.environ.get("AIRODS_STAGE_CLAIM_TIMEOUT", 3600))
+
+# object names per iCAT query (one IN condition)
+NAMES_PER_QUERY = 50
+
+ObjectVersion = namedtuple("ObjectVersion", "checksum size")
+
+
+def object_versions(icom, irods_paths):
+    """
+    Checksum and size of each data object, with one iCAT query per
+    collection (and NAMES_PER_QUERY names). Objects without a registered
+    checksum are told apart by size and modification time. Paths missing
+    from iRODS are left out
+    """
+
+    names = defaultdict(set)
+    for irods_path in irods_paths:
+        collection, _, name = irods_path.rpartition("/")
+        names[collection].add(name)
+
+    versions = {}
+    for collection, wanted in names.items():
+        wanted = sorted(wanted)
+        for start in range(0, len(wanted), NAMES_PER_QUERY):
+            query = (
+                icom.prc.query(
+                    DataObject.name,
+                    DataObject.checksum,
+                    DataObject.size,
+                    DataObject.modify_time,
+                )
+                .filter(Collection.name == collection)
+                .filter(In(DataObject.name, wanted[start : start + NAMES_PER_QUERY]))
+            )
+
+            # one row per physical replica: the first with a checksum wins
+            for row in query:
+                irods_path = f"{collection}/{row[DataObject.name]}"
+                if irods_path in versions:
+                    continue
+                checksum = row[DataObject.checksum]
+                if not checksum:
+                    mtime = int(row[DataObject.modify_time].timestamp())
+                    checksum = f"{row[DataObject.size]}:{mtime}"
+                versions[irods_path] = ObjectVersion(checksum, row[DataObject.size])
+
+    return versions
+
+
+def replica_path(stage_root, irods_path, checksum):
+    # a new version of an object never overwrites a replica still referenced
+    digest = hashlib.sha1(checksum.encode()).hexdigest()[:12]
+    return f"{stage_root.rstrip('/')}/{REPLICAS_DIR}/{digest}{irods_path}"
+
+
+class StageCatalogue:
+    """
+    Replicas of an endpoint, see models/mongo.py:StageReplica. A stage
+    collection claims the replicas of its objects: the ones it created
+    (owner, status staging) are copied by its request, the ready ones are
+    listed as they are, the ones another request is copying as pending
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def claim(self, endpoint, stage_collection, stage_root, versions):
+        """
+        Reference the replicas of versions ({irods_path: ObjectVersion})
+        from stage_collection, creating the missing ones.
+        Returns the replica documents by irods_path
+        """
+
+        now = datetime.utcnow()
+        # its copy failed, or the request copying it died: copy it again
+        takeover = {
+            "$or": [
+                {"$eq": ["$status", "failed"]},
+                {
+                    "$and": [
+                        {"$eq": ["$status", "staging"]},
+                        {
+                            "$lt": [
+                                "$claimed",
+                                now - timedelta(seconds=STAGE_CLAIM_TIMEOUT),
+                            ]
+                        },
+                    ]
+                },
+            ]
+        }
+        requests = []
+        for irods_path, version in versions.items():
+            stage_path = replica_path(stage_root, irods_path, version.checksum)
+            requests.append(
+                UpdateOne(
+                    {
+                        "endpoint": endpoint,
+                        "irods_path": irods_path,
+                        "checksum": version.checksum,
+                    },
+                    # pipeline update: set only what a new replica lacks,
+                    # refs stays the size of collections
+                    [
+                        {
+                            "$set": {
+                                "stage_path": {"$ifNull": ["$stage_path", stage_path]},
+                                "status": {
+                                    "$cond": [
+                                        takeover,
+                                        "staging",
+                                        {"$ifNull": ["$status", "staging"]},
+                                    ]
+                                },
+                                "owner": {
+                                    "$cond": [
+                                        takeover,
+                                        stage_collection,
+                                        {"$ifNull": ["$owner", stage_collection]},
+                                    ]
+                                },
+                                "claimed": {
+                                    "$cond": [
+                                        takeover,
+                                        now,
+                                        {"$ifNull": ["$claimed", now]},
+                                    ]
+                                },
+                                "size": {"$ifNull": ["$size", version.size]},
+                                "created": {"$ifNull": ["$created", now]},
+                                "last_used": now,
+                                "collections": {
+                                    "$setUnion": [
+                                        {"$ifNull": ["$collections", []]},
+                                        [stage_collection],
+                                    ]
+                                },
+                            }
+                        },
+                        {"$set": {"refs": {"$size": "$collections"}}},
+                    ],
+                    upsert=True,
+                )
+            )
+
+        if not requests:
+            return {}
+
+        self.collection.bulk_write(requests, ordered=False)
+        return {
+            replica["irods_path"]: replica
+            for replica in self.collection.find(
+                {"endpoint": endpoint, "collections": stage_collection}
+            )
+        }
+
+    def settle(self, replicas, results):
+        """
+        Mark the replicas copied by results (StageResult) as ready, the ones
+        whose copy failed as failed and without owner: the next request
+        claiming them copies them again. They are kept, other stage
+        collections may reference them already
+        """
+
+        ready = []
+        failed = []
+        for result in results:
+            replica = replicas[result.irods_path]
+            (ready if result.ok else failed).append(replica["_id"])
+
+        if ready:
+            self.collection.update_many(
+                {"_id": {"$in": ready}}, {"$set": {"status": "ready"}}
+            )
+        if failed:
+            self.collection.update_many(
+                {"_id": {"$in": failed}, "status": "staging"},
+                {"$set": {"status": "failed", "owner": None}},
+            )
+
+    def files(self, stage_collection):
+        """ irods_path, stage_path and status of the replicas of stage_collection """
+
+        return list(
+            self.collection.find(
+                {"collections": stage_collection},
+                {"_id": 0, "irods_path": 1, "stage_path": 1, "status": 1},
+                sort=[("irods_path", 1)],
+            )
+        )
+
+    def release(self, stage_collection):
+        """ Drop the references of stage_collection, returns the replicas released """
+
+        result = self.collection.update_many(
+            {"collections": stage_collection},
+            [
+                {
+                    "$set": {
+                        "collections": {
+                            "$setDifference": ["$collections", [stage_collection]]
+                        }
+                    }
+                },
+                {"$set": {"refs": {"$size": "$collections"}}},
+            ],
+        )
+        return result.modified_count
+
+    def unreferenced(self, before, limit):
+        """ Replicas no stage collection has used since before, oldest first """
+
+        return list(
+            self.collection.find(
+                {"refs": 0, "last_used": {"$lt": before}},
+                {"stage_path": 1},
+                sort=[("refs", 1), ("last_used", 1)],
+                limit=limit,
+            )
+        )
+
+    def forget(self, replica_id):
+        """ Drop a replica, unless a request claimed it meanwhile """
+
+        return self.collection.delete_one({"_id": replica_id, "refs": 0}).deleted_count
+
+
+def stage_copies(replicas, stage_collection):
+    """ (irods_path, stage_path) of the replicas stage_collection has to copy """
+
+    return [
+        (irods_path, replica["stage_path"])
+        for irods_path, replica in replicas.items()
+        if replica["owner"] == stage_collection and replica["status"] == "staging"
+    ]
+
+
+def stage_pending(replicas, stage_collection):
+    """ irods_paths of the replicas another request is still copying """
+
+    return [
+        irods_path
+        for irods_path, replica in replicas.items()
+        if replica["owner"] != stage_collection and replica["status"] == "staging"
+    ]
+
+
+def stage_failed(replicas):
+    """
+    irods_paths of the replicas whose copy failed after they were claimed:
+    nobody copies them, the next request claiming them does
+    """
+
+    return [
+        irods_path
+        for irods_path, replica in replicas.items()
+        if replica["status"] == "failed"
+    ]
+
+
+def create_parents(icom, copies):
+    """ Create the stage area collections the copies are written to """
+
+    for parent in sorted({posixpath.dirname(path) for _, path in copies}):
+        icom.create_directory(parent, ignore_existing=True)
@@ -0,0 +1,273 @@
+"""
+Bounded pool of authenticated iRODS sessions, shared by requests and threads
+"""
+
+import functools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import Response
+from irods.exception import iRODSException
+from restapi.services.detect import detector
+from restapi.utilities.logs import log
+
+from airods.commons.streaming import JSON_MIMETYPE, dumps
+
+IRODS_POOL_SIZE = int(os.environ.get("AIRODS_IRODS_POOL_SIZE", 8))
+# seconds a request waits for a free session
+IRODS_POOL_TIMEOUT = float(os.environ.get("AIRODS_IRODS_POOL_TIMEOUT", 30))
+# idle sessions are closed after this many seconds
+IRODS_MAX_IDLE = float(os.environ.get("AIRODS_IRODS_MAX_IDLE", 300))
+# sessions are renewed after this many seconds, even if busy
+IRODS_MAX_LIFETIME = float(os.environ.get("AIRODS_IRODS_MAX_LIFETIME", 3600))
+# sessions idle for longer are checked with a round trip before reuse
+IRODS_CHECK_IDLE = float(os.environ.get("AIRODS_IRODS_CHECK_IDLE", 30))
+
+
+# errors leaving a session in an unknown state
+SESSION_ERRORS = (iRODSException, OSError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def unavailable_when_busy(view):
+    """ 503 with Retry-After, instead of a 500, when no iRODS session is free """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except PoolTimeout as e:
+            log.warning("{}", e)
+            return Response(
+                dumps(str(e)),
+                status=503,
+                mimetype=JSON_MIMETYPE,
+                headers={"Retry-After": str(max(1, int(IRODS_POOL_TIMEOUT)))},
+            )
+
+    return wrapper
+
+
+def new_irods_session():
+    # a dedicated instance: pooled sessions must never be shared
+    return detector.get_service_instance("irods", global_instance=False)
+
+
+def close_irods_session(icom):
+    icom.prc.cleanup()
+
+
+def check_irods_session(icom):
+    """ Cheap iCAT round trip, raising if the session is unusable """
+
+    icom.prc.collections.get(f"/{icom.prc.zone}")
+
+
+class SessionPool:
+    """
+    At most size sessions, created on demand. Checkouts are served in
+    arrival order (FIFO) and wait at most timeout seconds
+    """
+
+    def __init__(
+        self,
+        factory=new_irods_session,
+        close=close_irods_session,
+        check=check_irods_session,
+        size=IRODS_POOL_SIZE,
+        timeout=IRODS_POOL_TIMEOUT,
+        max_idle=IRODS_MAX_IDLE,
+        max_lifetime=IRODS_MAX_LIFETIME,
+        check_idle=IRODS_CHECK_IDLE,
+    ):
+        self.factory = factory
+        self.close = close
+        self.check = check
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+
+        self.cond = threading.Condition()
+        self.waiters = deque()
+        # idle sessions as (session, created, released), the newest on the right
+        self.idle = deque()
+        # session id -> created, of the checked out sessions
+        self.busy = {}
+        # sessions alive or being created
+        self.total = 0
+
+        self.counters = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "check_failures": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def _acquire(self, timeout):
+        """ The idle entry to reuse, or None if a new session must be created """
+
+        deadline = time.monotonic() + timeout
+        ticket = object()
+        with self.cond:
+            self.waiters.append(ticket)
+            try:
+                while True:
+                    if self.waiters[0] is ticket:
+                        if self.idle:
+                            return self.idle.pop()
+                        if self.total < self.size:
+                            self.total += 1
+                            return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # timeout 0 is a probe (checkout_free), not a timeout
+                        if timeout > 0:
+                            self.counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No iRODS session available within {timeout}s"
+                        )
+                    self.cond.wait(remaining)
+            finally:
+                self.waiters.remove(ticket)
+                self.cond.notify_all()
+
+    def _create(self):
+        try:
+            session = self.factory()
+        except BaseException:
+            with self.cond:
+                self.total -= 1
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.counters["created"] += 1
+        return session, time.monotonic()
+
+    def _discard(self, session):
+        try:
+            self.close(session)
+        except BaseException as e:
+            log.debug("Failed to close iRODS session: {}", e)
+
+    def _usable(self, entry):
+        session, created, released = entry
+        now = time.monotonic()
+        if now - created > self.max_lifetime or now - released > self.max_idle:
+            return False
+        if now - released > self.check_idle:
+            try:
+                self.check(session)
+            except BaseException as e:
+                log.warning("Dropping broken iRODS session: {}", e)
+                with self.cond:
+                    self.counters["check_failures"] += 1
+                return False
+        return True
+
+    def checkout(self, timeout=None):
+        started = time.monotonic()
+        self.reap()
+        entry = self._acquire(self.timeout if timeout is None else timeout)
+
+        if entry is not None and not self._usable(entry):
+            self._discard(entry[0])
+            with self.cond:
+                self.counters["recycled"] += 1
+            entry = None
+
+        if entry is None:
+            session, created = self._create()
+        else:
+            session, created, _ = entry
+
+        waited = time.monotonic() - started
+        with self.cond:
+            self.busy[id(session)] = created
+            self.counters["checkouts"] += 1
+            self.counters["wait_seconds_total"] += waited
+            self.counters["wait_seconds_max"] = max(
+                self.counters["wait_seconds_max"], waited
+            )
+        return session
+
+    def checkin(self, session, broken=False):
+        with self.cond:
+            created = self.busy.pop(id(session))
+            expired = time.monotonic() - created > self.max_lifetime
+            if not broken and not expired:
+                self.idle.append((session, created, time.monotonic()))
+                self.cond.notify_all()
+                return
+            self.total -= 1
+            self.cond.notify_all()
+        self._discard(session)
+
+    def checkout_free(self, count):
+        """ Up to count sessions, only those available without waiting """
+
+        sessions = []
+        try:
+            while len(sessions) < count:
+                sessions.append(self.checkout(timeout=0))
+        except PoolTimeout:
+            pass
+        return sessions
+
+    @contextmanager
+    def session(self, timeout=None):
+        icom = self.checkout(timeout)
+        try:
+            yield icom
+        except SESSION_ERRORS:
+            self.checkin(icom, broken=True)
+            raise
+        except BaseException:
+            self.checkin(icom)
+            raise
+        self.checkin(icom)
+
+    def reap(self):
+        """ Close the idle sessions past max_idle or max_lifetime """
+
+        now = time.monotonic()
+        expired = []
+        with self.cond:
+            for entry in list(self.idle):
+                _, created, released = entry
+                if now - created > self.max_lifetime or now - released > self.max_idle:
+                    self.idle.remove(entry)
+                    self.total -= 1
+                    expired.append(entry[0])
+            self.cond.notify_all()
+        for session in expired:
+            self._discard(session)
+        return len(expired)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["size"] = self.size
+            stats["open"] = self.total
+            stats["in_use"] = len(self.busy)
+            stats["idle"] = len(self.idle)
+            stats["waiting"] = len(self.waiters)
+        stats["utilisation"] = round(stats["in_use"] / self.size, 4)
+        checkouts = stats["checkouts"]
+        stats["wait_seconds_avg"] = (
+            round(stats["wait_seconds_total"] / checkouts, 6) if checkouts else None
+        )
+        return stats
+
+
+irods_pool = SessionPool()
@@ -0,0 +1,188 @@
+"""
+Concurrent staging of data objects over a bounded pool of iRODS sessions
+"""
+
+import os
+import queue
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# workers (and iRODS sessions) used by a single stage request
+STAGE_WORKERS = int(os.environ.get("AIRODS_STAGE_WORKERS", 4))
+# concurrent rule runs towards the same endpoint, over all the requests
+STAGE_ENDPOINT_LIMIT = int(os.environ.get("AIRODS_STAGE_ENDPOINT_LIMIT", 8))
+# objects replicated by a single rule run
+STAGE_BATCH_SIZE = int(os.environ.get("AIRODS_STAGE_BATCH_SIZE", 20))
+
+# separator of the path lists sent to the rule, must not appear in the paths
+PATH_SEPARATOR = "|"
+# per-object status written by the rule: AIRODS:<index>:OK|KO[:<response>]
+STATUS_PATTERN = re.compile(r"AIRODS:(\d+):(OK|KO)")
+
+StageResult = namedtuple("StageResult", "irods_path stage_path ok output")
+
+_endpoint_slots = {}
+_endpoint_slots_lock = threading.Lock()
+
+
+def endpoint_slots(endpoint, limit=STAGE_ENDPOINT_LIMIT):
+    """ Process-wide semaphore capping the replications towards endpoint """
+
+    if not endpoint:
+        return nullcontext()
+
+    with _endpoint_slots_lock:
+        if endpoint not in _endpoint_slots:
+            _endpoint_slots[endpoint] = threading.BoundedSemaphore(limit)
+        return _endpoint_slots[endpoint]
+
+
+# EUDATReplication of the pair index *i of the lists, run under errorcode():
+# a replication raising an error is reported KO and the loop goes on
+REPLICATE_PAIR = """
+            *response = "";
+            *res = false;
+            *code = errorcode(
+                *res = EUDATReplication(
+                    elem(*irods_list, *i), elem(*stage_list, *i),
+                    "false", "false", *response
+                )
+            );
+            if (*code < 0) {
+                writeLine("stdout", "AIRODS:*i:KO:error *code *response");
+            }
+            else if (*res) {
+                writeLine("stdout", "AIRODS:*i:OK");
+            }
+            else {
+                writeLine("stdout", "AIRODS:*i:KO:*response");
+            }
+"""
+
+
+def replicate_batch(icom, pairs):
+    """
+    EUDAT RULE for Replica (exploited for copy), looping server-side over
+    the (irods_path, stage_path) pairs: one rule run for the whole batch.
+    Pairs whose paths contain the separator are replicated one rule run
+    each. Returns one (ok, output) per pair
+    """
+
+    batched = []
+    statuses = [None] * len(pairs)
+    for index, pair in enumerate(pairs):
+        if any(PATH_SEPARATOR in path for path in pair):
+            statuses[index] = replicate_single(icom, *pair)
+        else:
+            batched.append(index)
+
+    if batched:
+        batch = [pairs[index] for index in batched]
+        inputs = {
+            "*irods_paths": '"%s"' % PATH_SEPARATOR.join(p[0] for p in batch),
+            "*stage_paths": '"%s"' % PATH_SEPARATOR.join(p[1] for p in batch),
+        }
+        body = """
+        *irods_list = split(*irods_paths, "{sep}");
+        *stage_list = split(*stage_paths, "{sep}");
+        *n = size(*irods_list);
+        for (*i = 0; *i < *n; *i = *i + 1) {{{pair}        }}
+    """.format(
+            sep=PATH_SEPARATOR, pair=REPLICATE_PAIR
+        )
+
+        rule_output = icom.rule("do_stage_batch", body, inputs, output=True)
+        for index, status in zip(batched, parse_batch_output(rule_output, len(batch))):
+            statuses[index] = status
+
+    return statuses
+
+
+def replicate_single(icom, irods_path, stage_path):
+    """ replicate_batch of a single pair, without splitting its paths """
+
+    inputs = {
+        "*irods_path": '"%s"' % irods_path,
+        "*stage_path": '"%s"' % stage_path,
+    }
+    body = """
+        *irods_list = list(*irods_path);
+        *stage_list = list(*stage_path);
+        *i = 0;{pair}    """.format(
+        pair=REPLICATE_PAIR
+    )
+
+    rule_output = icom.rule("do_stage_single", body, inputs, output=True)
+    return parse_batch_output(rule_output, 1)[0]
+
+
+def parse_batch_output(rule_output, size):
+    """ Per-object (ok, output) from the stdout buffer of replicate_batch """
+
+    buf = str(rule_output or "")
+    statuses = [(False, "no status in rule output")] * size
+
+    for match in STATUS_PATTERN.finditer(buf):
+        index = int(match.group(1))
+        if index < size:
+            statuses[index] = (match.group(2) == "OK", match.group(0))
+
+    return statuses
+
+
+def stage_workers(tasks_count, batch_size=STAGE_BATCH_SIZE):
+    """ Workers (and iRODS sessions) worth opening for tasks_count objects """
+
+    batches = -(-tasks_count // batch_size)
+    return max(1, min(STAGE_WORKERS, batches))
+
+
+def stage_objects(
+    copy, sessions, tasks, endpoint=None, callback=None, batch_size=STAGE_BATCH_SIZE
+):
+    """
+    Split the (irods_path, stage_path) tasks into batches and run
+    copy(session, batch) on each of them, with one worker per session:
+    a session is never shared by two running copies. copy returns one
+    (ok, output) per pair of the batch.
+    Returns one StageResult per task, in the order of tasks.
+    callback, if given, receives each StageResult as soon as its batch is done
+    """
+
+    tasks = list(tasks)
+    if not tasks:
+        return []
+
+    batches = [tasks[i : i + batch_size] for i in range(0, len(tasks), batch_size)]
+
+    idle = queue.SimpleQueue()
+    for session in sessions:
+        idle.put(session)
+    slots = endpoint_slots(endpoint)
+
+    def copy_batch(batch):
+        session = idle.get()
+        try:
+            with slots:
+                return copy(session, batch)
+        except Exception as e:
+            return [(False, str(e))] * len(batch)
+        finally:
+            idle.put(session)
+
+    def run(batch):
+        results = [
+            StageResult(irods_path, stage_path, ok, output)
+            for (irods_path, stage_path), (ok, output) in zip(batch, copy_batch(batch))
+        ]
+        if callback is not None:
+            for result in results:
+                callback(result)
+        return results
+
+    workers = min(len(sessions), len(batches))
+    with ThreadPoolExecutor(workers, thread_name_prefix="airods-stage") as executor:
+        return [result for results in executor.map(run, batches) for result in results]
@@ -0,0 +1,63 @@
+"""
+Streamed responses for large result sets
+"""
+
+import json
+import os
+from datetime import date, datetime
+
+from flask import Response, request, stream_with_context
+
+try:
+    # optional: several times faster, datetimes encoded natively
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# documents fetched from the cursor (and flushed to the client) at once
+STREAM_BATCH_SIZE = int(os.environ.get("AIRODS_STREAM_BATCH_SIZE", 1000))
+
+
+def wants_ndjson():
+    """ True if the client explicitly prefers NDJSON over plain JSON """
+
+    best = request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(value):
+    """ JSON bytes of value, with orjson when installed """
+
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default)
+    return json.dumps(value, default=json_default).encode()
+
+
+def ndjson_chunks(cursor, serialize, batch_size=STREAM_BATCH_SIZE):
+    """ Serialize one document per line, yielding a chunk every batch_size """
+
+    lines = []
+    for document in cursor:
+        lines.append(dumps(serialize(document)))
+        if len(lines) >= batch_size:
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+
+def stream_ndjson(cursor, serialize=dict, batch_size=STREAM_BATCH_SIZE):
+    return Response(
+        stream_with_context(ndjson_chunks(cursor, serialize, batch_size)),
+        mimetype=NDJSON_MIMETYPE,
+    )
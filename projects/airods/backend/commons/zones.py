@@ -0,0 +1,84 @@
+"""
+Zones (stage endpoints) read once from the iCAT and cached in memory
+"""
+
+import os
+import threading
+import time
+
+from irods.exception import iRODSException
+from irods.query import SpecificQuery
+from restapi.utilities.logs import log
+
+# seconds before the zone list is read again from the iCAT
+ZONES_TTL = int(os.environ.get("AIRODS_ZONES_TTL", 600))
+
+# registered once in the iCAT, then executed by alias
+ZONES_ALIAS = "airods_zones_v1"
+ZONES_SQL = "select zone_name, zone_conn_string, r_comment from r_zone_main"
+
+# r_comment prefix of the zones able to stage data
+STAGE_COMMENT = "stag"
+
+
+def register_queries(icom):
+    """ Register the specific queries, if not already registered """
+
+    try:
+        SpecificQuery(icom.prc, ZONES_SQL, ZONES_ALIAS).register()
+        log.info("Registered specific query {}", ZONES_ALIAS)
+    except iRODSException as e:
+        # already registered, by a previous run or another worker
+        log.debug("Specific query {} not registered: {}", ZONES_ALIAS, e)
+
+
+class ZoneCache:
+    """ Zone name -> {"Endpoint", "URL", "description"}, refreshed after ttl """
+
+    def __init__(self, ttl=ZONES_TTL):
+        self.ttl = ttl
+        self.expires = 0
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def read(self, icom):
+        rows = {}
+        for result in SpecificQuery(icom.prc, alias=ZONES_ALIAS):
+            zone = {"Endpoint": result[0]}
+            if result[1]:
+                zone["URL"] = result[1]
+            if result[2]:
+                zone["description"] = result[2]
+            rows[result[0]] = zone
+        return rows
+
+    def refresh(self, icom):
+        try:
+            rows = self.read(icom)
+        except iRODSException:
+            # e.g. the Initializer could not register it
+            register_queries(icom)
+            rows = self.read(icom)
+
+        with self.lock:
+            self.by_name = rows
+            self.expires = time.monotonic() + self.ttl
+        log.debug("Zone cache refreshed: {} zones", len(rows))
+
+    def zones(self, icom, refresh=False):
+        if refresh or time.monotonic() >= self.expires:
+            self.refresh(icom)
+        return self.by_name
+
+    def stage_zones(self, icom, refresh=False):
+        return [
+            zone
+            for zone in self.zones(icom, refresh).values()
+            if zone.get("description", "").startswith(STAGE_COMMENT)
+        ]
+
+    def zone(self, icom, name):
+        return self.zones(icom).get(name)
+
+
+zone_cache = ZoneCache()
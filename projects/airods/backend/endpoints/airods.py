@@ -5,18 +5,88 @@ EPOS-EUDAT-EOSC
 
 import os
 import uuid
+from datetime import datetime
 
 import dateutil.parser
-from irods.query import SpecificQuery
+from flask import Response
+from irods.exception import DataObjectDoesNotExist
 from restapi import decorators
-from restapi.exceptions import BadRequest, RestApiException
+from restapi.exceptions import (
+    BadRequest,
+    NotFound,
+    RestApiException,
+    ServiceUnavailable,
+)
 from restapi.models import PartialSchema, fields, validate
 from restapi.rest.definition import EndpointResource
 from restapi.utilities.logs import log
 
+from airods.commons.archive import checkout_download, stream_tar
+from airods.commons.bulk import (
+    BULK_MAX_SELECTIONS,
+    bulk_pipeline,
+    check_selection,
+    parse_fdsn_selections,
+)
+from airods.commons.cache import (
+    CACHE_MAX_DOCS,
+    cache_key,
+    results_cache,
+    watermark,
+)
+from airods.commons.cleanup import free_collection, stage_expiry
+from airods.commons.conditional import cached_answer, validated_reads
+from airods.commons.coverage import TILE_DEGREES, tiles_filter, tiles_per_cell
+from airods.commons.database import mongo_collections
+from airods.commons.formats import OUTPUT_FORMATS, format_response
+from airods.commons.metrics import (
+    METRICS_MIMETYPE,
+    instrumented,
+    query_mode,
+    render_metrics,
+    request_timer,
+)
+from airods.commons.pagination import KeysetPage
+from airods.commons.queries import (
+    META_FIELDS,
+    PID_FIELDS,
+    bbox_filter,
+    projection,
+    select_fields,
+    stage_filter,
+    summary_pipeline,
+)
+from airods.commons.ranges import stream_object
+from airods.commons.replicas import (
+    StageCatalogue,
+    create_parents,
+    object_versions,
+    stage_copies,
+    stage_failed,
+    stage_pending,
+)
+from airods.commons.sessions import (
+    SESSION_ERRORS,
+    irods_pool,
+    unavailable_when_busy,
+)
+from airods.commons.staging import replicate_batch, stage_objects, stage_workers
+from airods.commons.streaming import STREAM_BATCH_SIZE, stream_ndjson, wants_ndjson
+from airods.commons.zones import zone_cache
+from airods.models.mongo import (
+    CoverageTile,
+    StageCollection,
+    StageJob,
+    StageReplica,
+    wf_do,
+)
+
 # from irods.models import Collection, DataObject
 # from irods.models import User, UserGroup, UserAuth
 
+# upper bound of the limit parameter
+MAX_PAGE_SIZE = 10000
+
 responses = {
     200: "Successful request, results follow",
     400: "Bad request due to improper specification, unrecognised or wrong parameters",
@@ -76,32 +146,49 @@ class AirodsInput(PartialSchema):
         missing=63.30,
         # required=True,
     )
+    overlap = fields.Boolean(
+        description="Select the files intersecting the time window, instead of the files inside it",
+        missing=False,
+        required=False,
+    )
 
-    # limit, offset and output fields are not used
 
-    # limit = fields.Integer(
-    #     description='Make query limit',
-    #     missing=20,
-    #     required=False
-    # )
-    # offset = fields.Integer(
-    #     description='Make query offset',
-    #     missing=0,
-    #     required=False
-    # )
-    # output = fields.Str(
-    #     description="Specifies the output format (if is set download param).",
-    #     missing="json",
-    #     validate=validate.OneOf(["json", "xml"]),
-    #     required=False,
-    # )
+class AirodsFieldsInput(AirodsInput):
+    # "fields" would shadow the fields module in the class body
+    output_fields = fields.Str(
+        data_key="fields",
+        description="Comma separated list of the fields to return (default: all)",
+        required=False,
+    )
+    limit = fields.Integer(
+        description="Max results per page, enables keyset pagination",
+        validate=validate.Range(min=1, max=MAX_PAGE_SIZE),
+        required=False,
+    )
+    page_token = fields.Str(
+        data_key="next",
+        description="Token of the next page, as returned by the previous page",
+        required=False,
+    )
+    output_format = fields.Str(
+        data_key="format",
+        description="Output format: json (one object per row), columnar (JSON, one array per field), msgpack, arrow (IPC stream) or parquet, as installed on the server",
+        missing="json",
+        validate=validate.OneOf(OUTPUT_FORMATS),
+        required=False,
+    )
 
 
-class AirodsInputWithDownload(AirodsInput):
+class AirodsInputWithDownload(AirodsFieldsInput):
     download = fields.Boolean(
         description="Allow download data or retrieve PID / URI of digital object",
         required=True,
     )
+    summary = fields.Boolean(
+        description="Only count the selected objects: total, estimated bytes, histograms per day and network/station",
+        missing=False,
+        required=False,
+    )
 
 
 class StageInput(AirodsInput):
@@ -112,28 +199,62 @@ class StageInput(AirodsInput):
         required=True,
     )
     network = fields.Str(
-        description="Select one network codes.", missing="IV", required=False
+        description="Select network codes (FDSN style: IV,MN or wildcards ? *).",
+        missing="IV",
+        required=False,
     )
     station = fields.Str(
-        description="Select one station codes.",
+        description="Select station codes (FDSN style: list or wildcards).",
         # missing="ACER",
         missing="*",
         required=False,
     )
     channel = fields.Str(
-        description="Select one channel codes.",
+        description="Select channel codes (FDSN style: list or wildcards).",
         # missing="HHE",
         missing="*",
         required=False,
     )
     location = fields.Str(
-        description="Select one location codes.", missing="", required=False
+        description="Select location codes (FDSN style, -- for blank, empty for any).",
+        missing="",
+        required=False,
     )
     endpoint = fields.Str(
         description="Select target endpoint to stage data (see /list).",
         missing="TARGET",
         # required=True,
     )
+    background = fields.Boolean(
+        description="Stage in a background job, poll its progress on /stage/<job_id>",
+        missing=False,
+        required=False,
+    )
+
+
+class CoverageInput(AirodsInput):
+    daily = fields.Boolean(
+        description="One entry per tile and day, instead of one per tile",
+        missing=False,
+        required=False,
+    )
+
+
+class ListInput(PartialSchema):
+    refresh = fields.Boolean(
+        description="Read the endpoints again from the iCAT instead of the cache",
+        missing=False,
+        required=False,
+    )
+
+
+class ObjectInput(PartialSchema):
+    file_id = fields.Str(
+        data_key="fileId",
+        description="File ID of the data object (e.g. IV.ACER..HHE.D.2015.015)",
+        required=False,
+    )
+    pid = fields.Str(description="PID of the data object", required=False)
 
 
 class AirodsFreeInput(PartialSchema):
@@ -143,6 +264,46 @@ class AirodsFreeInput(PartialSchema):
     )
 
 
+class SelectionInput(PartialSchema):
+    start = fields.DateTime(
+        description="Start time of the selection (ISO 8601)", required=True
+    )
+    end = fields.DateTime(
+        description="End time of the selection (ISO 8601)", required=True
+    )
+    minlat = fields.Float(description="Bounding box: min latitude", required=False)
+    minlon = fields.Float(description="Bounding box: min longitude", required=False)
+    maxlat = fields.Float(description="Bounding box: max latitude", required=False)
+    maxlon = fields.Float(description="Bounding box: max longitude", required=False)
+    network = fields.Str(
+        description="NSCL: network codes (FDSN style: IV,MN or wildcards ? *)",
+        required=False,
+    )
+    station = fields.Str(description="NSCL: station codes", required=False)
+    location = fields.Str(
+        description="NSCL: location codes (-- for blank)", required=False
+    )
+    channel = fields.Str(description="NSCL: channel codes", required=False)
+
+
+class BulkInput(PartialSchema):
+    selections = fields.List(
+        fields.Nested(SelectionInput),
+        description="Bounding box + time window or NSCL + time window selections",
+        validate=validate.Length(max=BULK_MAX_SELECTIONS),
+        required=False,
+    )
+    fdsn = fields.Str(
+        description="FDSN POST selection lines: NET STA LOC CHA START END",
+        required=False,
+    )
+    output_fields = fields.Str(
+        data_key="fields",
+        description="Comma separated list of the fields to return (default: all)",
+        required=False,
+    )
+
+
 class Airods(EndpointResource):
 
     labels = ["airods"]
@@ -155,79 +316,253 @@ class Airods(EndpointResource):
         summary="Get data from irods-b2safe via boundingbox-timewindow (epos ecosystem)",
         responses=responses,
     )
-    def get(self, start, end, minlat, minlon, maxlat, maxlon, download):
+    @instrumented("data")
+    @unavailable_when_busy
+    def get(
+        self,
+        start,
+        end,
+        minlat,
+        minlon,
+        maxlat,
+        maxlon,
+        download,
+        summary=False,
+        output_fields=None,
+        limit=None,
+        page_token=None,
+        output_format="json",
+        overlap=False,
+    ):
         # # --> important into mongo collections we must have:
         # #     "_cls" : "airods.models.mongo.wf_do"
 
-        mongohd = self.get_service_instance("mongo")
+        documentResult1 = []
 
-        db = mongohd.variables.get("database")
+        selected = select_fields(output_fields)
+
+        log.debug("start = {} ({})", start, type(start))
+        log.debug("end = {} ({})", end, type(end))
+        log.debug("minlat = {} ({})", minlat, type(minlat))
+        log.debug("minlon = {} ({})", minlon, type(minlon))
+        log.debug("maxlat = {} ({})", maxlat, type(maxlat))
+        log.debug("maxlon = {} ({})", maxlon, type(maxlon))
+        log.debug("download = {} ({})", download, type(download))
+
+        timer = request_timer()
+        # columnar/binary PID lists (the summary and the archive keep their format)
+        compact = output_format != "json" and not (summary or download)
+        mode = "summary" if summary else "download" if download else "pid"
+        timer.mode = query_mode(
+            output_format if compact else mode, limit and not summary, overlap
+        )
 
-        mongohd.wf_do._mongometa.connection_alias = db
+        collection = mongo_collections.get(wf_do, read_only=True)
+
+        # Pid list / summary :: 304 (harvesters polling the same window) or served
+        # from the cache while the catalogue is unchanged, before any query runs
+        if summary or not download:
+            key = cache_key(
+                "data",
+                summary=summary,
+                start=start,
+                end=end,
+                minlat=minlat,
+                minlon=minlon,
+                maxlat=maxlat,
+                maxlon=maxlon,
+                fields=selected,
+                limit=limit,
+                next=page_token,
+                format=output_format,
+                overlap=overlap,
+            )
+            answer, version = cached_answer(
+                key, collection, None if compact else self.response
+            )
+            if answer is not None:
+                return answer
+            collection = validated_reads(collection)
 
-        documentResult1 = []
-        myLine = {}
-        mycollection = mongohd.wf_do
+        query = bbox_filter(start, end, minlat, minlon, maxlat, maxlon, overlap)
+
+        # Summary :: counted by mongo, nothing is listed
+        if summary:
+            try:
+                with timer.phase("mongo_query"):
+                    facets = next(collection.aggregate(summary_pipeline(query)))
+            except BaseException as e:
+                raise RestApiException(e)
 
-        log.critical("start = {} ({})", start, type(start))
-        log.critical("end = {} ({})", end, type(end))
-        log.critical("minlat = {} ({})", minlat, type(minlat))
-        log.critical("minlon = {} ({})", minlon, type(minlon))
-        log.critical("maxlat = {} ({})", maxlat, type(maxlat))
-        log.critical("maxlon = {} ({})", maxlon, type(maxlon))
-        log.critical("download = {} ({})", download, type(download))
+            total = facets["total"][0] if facets["total"] else {}
+            response = {
+                "total_files": total.get("files", 0),
+                "estimated_bytes": total.get("bytes", 0),
+                "per_day": {h["_id"]: h["files"] for h in facets["per_day"]},
+                "per_station": {h["_id"]: h["files"] for h in facets["per_station"]},
+            }
+            results_cache.put(key, version, response)
+            return self.response(response)
 
         try:
 
-            myfirstvalue = mycollection.objects.raw(
-                {
-                    "dc_coverage_x": {"$gte": minlat, "$lte": maxlat},
-                    "dc_coverage_y": {"$gte": minlon, "$lte": maxlon},
-                    "dc_coverage_t_max": {"$lte": end},
-                    "dc_coverage_t_min": {"$gte": start},
-                }
-            )
+            # only the requested keys travel from mongo (covered by the index
+            # on the PID list and download paths)
+            keys = PID_FIELDS if download else selected or PID_FIELDS
+            if limit:
+                myfirstvalue = KeysetPage(collection, query, keys, limit, page_token)
+            else:
+                myfirstvalue = collection.find(
+                    query, projection(keys), batch_size=STREAM_BATCH_SIZE
+                )
 
         except BaseException as e:
             raise RestApiException(e)
 
-        for document in myfirstvalue:
-            myLine["File_ID"] = document.fileId
-            myLine["PID"] = document.dc_identifier
-            myLine["iPath"] = document.irods_path
-
-            documentResult1.append(myLine)
+        # Pid list :: catalogue field names, one array per field or Arrow
+        if compact:
+            page = myfirstvalue if limit else None
+            return format_response(
+                timer.iterate(myfirstvalue), keys, output_format, page
+            )
 
-        # Download :: to check w/ irods
+        # Download :: tar archive streamed from irods
         if download:
 
-            # icom = self.get_service_instance('irods')
+            icom, release = checkout_download(irods_pool)
 
-            # @TODO: have to implement the TOTAL download not only the first
-            # myobj = myfirstvalue[0].irods_path
+            # read by the archive reader thread, while the response drains
+            entries = (
+                (document["fileId"], document["irods_path"])
+                for document in timer.iterate(myfirstvalue)
+            )
 
-            try:
-                # for time being ... @TODO: allow multi files download
-                # return icom.read_in_streaming(myfirstvalue[0].irods_path)
+            # the archive reader hands the session back once it stops reading
+            return stream_tar(icom, entries, release=release)
 
-                for document in myfirstvalue:
-                    pass
-                #    log.debug(document.irods_path)
-                #    icom.read_in_streaming(document.irods_path)
+        # Pid list :: OK
+        else:
 
-                # test only
-                return self.response("TEST download Ok")
+            for document in timer.iterate(myfirstvalue):
+                if selected:
+                    documentResult1.append(document)
+                    continue
+
+                documentResult1.append(
+                    {
+                        "File_ID": document.get("fileId"),
+                        "PID": document.get("dc_identifier"),
+                        "iPath": document.get("irods_path"),
+                    }
+                )
 
-            except BaseException as e:
-                raise RestApiException(e)
+            num_files = len(documentResult1)
+            response = [f"total files to download: {num_files}", documentResult1]
+            if limit:
+                response.append({"next": myfirstvalue.next})
 
-        # Pid list :: OK
+            if num_files <= CACHE_MAX_DOCS:
+                results_cache.put(key, version, response)
+
+            with timer.phase("serialize"):
+                return self.response(response)
+
+
+###########################
+# REST CLASS AirodsCoverage
+#
+# AIRODS - COVERAGE
+# =================
+# (data availability overview, from the precomputed coverage tiles)
+#
+class AirodsCoverage(EndpointResource):
+
+    labels = ["airods"]
+
+    @decorators.use_kwargs(CoverageInput, location="query")
+    @decorators.endpoint(
+        path="/airods/coverage",
+        summary="Get data availability per lat/lon tile via boundingbox-timewindow (epos ecosystem)",
+        responses=responses,
+    )
+    @instrumented("coverage")
+    def get(self, start, end, minlat, minlon, maxlat, maxlon, daily, overlap=False):
+
+        tiles = mongo_collections.get(CoverageTile, read_only=True)
+        # tiles are per day: a window selects the days it touches in both modes
+        query = tiles_filter(start, end, minlat, minlon, maxlat, maxlon)
+
+        timer = request_timer()
+        timer.mode = "daily" if daily else "cells"
+
+        if daily:
+            cursor = tiles.find(query, {"_id": 0}, sort=[("day", 1)])
         else:
+            cursor = tiles.aggregate(tiles_per_cell(query))
 
-            num_files = len(documentResult1)
-            return self.response(
-                [f"total files to download: {num_files}", documentResult1]
-            )
+        response = {"tile_degrees": TILE_DEGREES, "tiles": list(timer.iterate(cursor))}
+        with timer.phase("serialize"):
+            return self.response(response)
+
+
+#########################
+# REST CLASS AirodsObject
+#
+# AIRODS - OBJECT
+# ===============
+# (download a single data object, resumable via HTTP Range)
+#
+class AirodsObject(EndpointResource):
+
+    labels = ["airods"]
+
+    @decorators.use_kwargs(ObjectInput, location="query")
+    @decorators.endpoint(
+        path="/airods/object",
+        summary="Download a single data object by fileId or PID, honouring Range (epos ecosystem)",
+        responses={
+            200: "The whole data object follows",
+            206: "The requested range of the data object follows",
+            404: "Data object not found",
+            416: "Requested range not satisfiable",
+        },
+    )
+    @instrumented("object")
+    @unavailable_when_busy
+    def get(self, file_id=None, pid=None):
+
+        if bool(file_id) == bool(pid):
+            raise BadRequest("Specify either fileId or pid")
+
+        collection = mongo_collections.get(wf_do, read_only=True)
+
+        timer = request_timer()
+        timer.mode = "fileId" if file_id else "pid"
+
+        query = {"fileId": file_id} if file_id else {"dc_identifier": pid}
+        with timer.phase("mongo_query"):
+            document = collection.find_one(query, projection(("fileId", "irods_path")))
+        if document is None:
+            raise NotFound("Data object not found")
+
+        # a download slot, like the archives: 503 once they are all streaming
+        icom, release = checkout_download(irods_pool)
+
+        try:
+            with timer.phase("irods"):
+                obj = icom.prc.data_objects.get(document["irods_path"])
+            response = stream_object(obj, document["fileId"])
+        except DataObjectDoesNotExist:
+            # catalogued but missing from iRODS: the session is fine
+            release(False)
+            raise NotFound("Data object not found in iRODS")
+        except BaseException as e:
+            release(isinstance(e, SESSION_ERRORS))
+            raise RestApiException(e)
+
+        # the session and the slot go back once the object is sent
+        response.call_on_close(lambda: release(False))
+        return response
 
 
 #######################
@@ -241,67 +576,111 @@ class AirodsMeta(EndpointResource):
 
     labels = ["airods"]
 
-    @decorators.use_kwargs(AirodsInput, location="query")
+    @decorators.use_kwargs(AirodsFieldsInput, location="query")
     @decorators.endpoint(
         path="/airods/meta",
         summary="Get metadata from irods-b2safe via boundingbox-timewindow (epos ecosystem)",
         responses=responses,
     )
-    def get(self, start, end, minlat, minlon, maxlat, maxlon):
+    @instrumented("meta")
+    def get(
+        self,
+        start,
+        end,
+        minlat,
+        minlon,
+        maxlat,
+        maxlon,
+        output_fields=None,
+        limit=None,
+        page_token=None,
+        output_format="json",
+        overlap=False,
+    ):
 
         # # --> important! into mongo collections we must have:
         # #     "_cls" : "airods.models.mongo.wf_do"
 
-        mongohd = self.get_service_instance("mongo")
+        selected = select_fields(output_fields) or META_FIELDS
+
+        collection = mongo_collections.get(wf_do, read_only=True)
+        query = bbox_filter(start, end, minlat, minlon, maxlat, maxlon, overlap)
+
+        # 304 while the catalogue is unchanged, JSON results served from the cache
+        ndjson = wants_ndjson()
+        timer = request_timer()
+        compact = output_format != "json"
+        mode = output_format if compact else "ndjson" if ndjson else "json"
+        timer.mode = query_mode(mode, limit, overlap)
+        key = cache_key(
+            "meta",
+            start=start,
+            end=end,
+            minlat=minlat,
+            minlon=minlon,
+            maxlat=maxlat,
+            maxlon=maxlon,
+            fields=selected,
+            limit=limit,
+            next=page_token,
+            ndjson=ndjson,
+            format=output_format,
+            overlap=overlap,
+        )
+        answer, version = cached_answer(
+            key, collection, None if ndjson or compact else self.response
+        )
+        if answer is not None:
+            return answer
+        collection = validated_reads(collection)
+
+        if limit:
+            page = KeysetPage(
+                collection,
+                query,
+                selected,
+                limit,
+                page_token,
+                batch_size=min(limit + 1, STREAM_BATCH_SIZE),
+            )
 
-        db = mongohd.variables.get("database")
+            if compact:
+                return format_response(
+                    timer.iterate(page), selected, output_format, page
+                )
 
-        mongohd.wf_do._mongometa.connection_alias = db
+            # the next token is the trailing line of the stream
+            if ndjson:
+                return stream_ndjson(timer.iterate(page.with_next()))
 
-        documentResult1 = []
+            response = [list(timer.iterate(page)), {"next": page.next}]
+            results_cache.put(key, version, response)
+            with timer.phase("serialize"):
+                return self.response(response)
 
-        mycollection = mongohd.wf_do
-
-        myfirstvalue = mycollection.objects.raw(
-            {
-                "dc_coverage_x": {"$gte": minlat, "$lte": maxlat},
-                "dc_coverage_y": {"$gte": minlon, "$lte": maxlon},
-                "dc_coverage_t_max": {"$lte": end},
-                "dc_coverage_t_min": {"$gte": start},
-            }
+        cursor = collection.find(
+            query, projection(selected), batch_size=STREAM_BATCH_SIZE
         )
-        # myfirstvalue = mongohd.wf_do.objects.all()
-
-        for document in myfirstvalue:
-            myLine = {
-                "fileId": document.fileId,
-                "dc_identifier": document.dc_identifier,
-                "dc_coverage_x": document.dc_coverage_x,
-                "dc_coverage_y": document.dc_coverage_y,
-                "dc_coverage_z": document.dc_coverage_z,
-                "dc_title": document.dc_title,
-                "dc_subject": document.dc_subject,
-                "dc_creator": document.dc_creator,
-                "dc_contributor": document.dc_contributor,
-                "dc_publisher": document.dc_publisher,
-                "dc_type": document.dc_type,
-                "dc_format": document.dc_format,
-                "dc_date": document.dc_date,
-                "dc_coverage_t_min": document.dc_coverage_t_min,
-                "dc_coverage_t_max": document.dc_coverage_t_max,
-                "dcterms_available": document.dcterms_available,
-                "dcterms_dateAccepted": document.dcterms_dateAccepted,
-                "dc_rights": document.dc_rights,
-                "dcterms_isPartOf": document.dcterms_isPartOf,
-                "irods_path": document.irods_path,
-            }
-            documentResult1.append(myLine)
+
+        # format=columnar/msgpack/arrow/parquet :: no per-row JSON objects
+        if compact:
+            return format_response(timer.iterate(cursor), selected, output_format)
+
+        # Accept: application/x-ndjson :: stream the cursor, bounded memory
+        if ndjson:
+            return stream_ndjson(timer.iterate(cursor))
+
+        documentResult1 = list(timer.iterate(cursor))
 
         if documentResult1:
             log.info("result - OK")
         # log.info (documentResult1)
 
-        return self.response([documentResult1])
+        if len(documentResult1) <= CACHE_MAX_DOCS:
+            results_cache.put(key, version, [documentResult1])
+
+        with timer.phase("serialize"):
+            return self.response([documentResult1])
 
         """
         # Write server logs, on different levels:
@@ -324,47 +703,145 @@ class AirodsMeta(EndpointResource):
 
 
 #######################
-# REST CLASS AirodsList
+# REST CLASS AirodsBulk
 #
-# AIRODS - LIST
+# AIRODS - BULK
 # =============
-# (list of endpoints to stage data)
+# (metadata of many selections: bbox/time windows or NSCL tuples, one scan)
 #
-class AirodsList(EndpointResource):
+class AirodsBulk(EndpointResource):
 
     labels = ["airods"]
 
+    @decorators.use_kwargs(BulkInput)
     @decorators.endpoint(
-        path="/airods/list",
-        summary="Get list of endpoint to stage data (epos ecosystem)",
+        path="/airods/bulk",
+        summary="Get metadata of many boundingbox-timewindow or NSCL selections at once",
+        responses=responses,
+    )
+    @instrumented("bulk")
+    def post(self, selections=None, fdsn=None, output_fields=None):
+
+        selections = list(selections or [])
+        if fdsn:
+            selections += parse_fdsn_selections(fdsn)
+        if not selections:
+            raise BadRequest("No selections given")
+        if len(selections) > BULK_MAX_SELECTIONS:
+            raise BadRequest(f"At most {BULK_MAX_SELECTIONS} selections per request")
+        for index, selection in enumerate(selections):
+            check_selection(index, selection)
+
+        collection = mongo_collections.get(wf_do, read_only=True)
+
+        selected = select_fields(output_fields) or META_FIELDS
+
+        # one document per line, with the indexes of the selections it matched
+        timer = request_timer()
+        cursor = collection.aggregate(
+            bulk_pipeline(selections, selected), batchSize=STREAM_BATCH_SIZE
+        )
+        return stream_ndjson(timer.iterate(cursor))
+
+
+########################
+# REST CLASS AirodsCache
+#
+# AIRODS - CACHE
+# ==============
+# (result cache counters, to tune its size and TTL)
+#
+class AirodsCache(EndpointResource):
+
+    labels = ["airods"]
+
+    @decorators.endpoint(
+        path="/airods/cache",
+        summary="Get the hit/miss counters of the query result cache",
+        responses=responses,
+    )
+    def get(self):
+
+        stats = results_cache.stats()
+        stats["catalogue_version"] = watermark.version
+        stats["watermark_source"] = watermark.source
+        stats["catalogue_stamp"] = watermark.stamp
+        stats["catalogue_modified"] = watermark.modified
+
+        return self.response(stats)
+
+
+#######################
+# REST CLASS AirodsPool
+#
+# AIRODS - POOL
+# =============
+# (iRODS session pool usage, to size it against the server limits)
+#
+class AirodsPool(EndpointResource):
+
+    labels = ["airods"]
+
+    @decorators.endpoint(
+        path="/airods/pool",
+        summary="Get the usage of the iRODS session pool (waits, utilisation)",
         responses=responses,
     )
     def get(self):
 
-        icom = self.get_service_instance("irods")
+        return self.response(irods_pool.stats())
 
-        # where zone_type_name = 'remote'"
-        sql = "select zone_name, zone_conn_string, r_comment from r_zone_main where r_comment LIKE 'stag%'"
 
-        queryResponse = {}
-        # optional, if we want to get results by key
-        # columns = [DataObject.zone_id, DataObject.zone_name]
-        query = SpecificQuery(icom.prc, sql)
-        # register specific query in iCAT
-        _ = query.register()
+##########################
+# REST CLASS AirodsMetrics
+#
+# AIRODS - METRICS
+# ================
+# (request and phase timings, in the Prometheus text format)
+#
+class AirodsMetrics(EndpointResource):
 
-        for result in query:
+    labels = ["airods"]
 
-            queryResponse["Endpoint"] = result[0]
-            if result[1]:
-                queryResponse["URL"] = result[1]
+    @decorators.endpoint(
+        path="/airods/metrics",
+        summary="Get the airods request metrics in the Prometheus text format",
+        responses=responses,
+    )
+    def get(self):
 
-            if result[2]:
-                queryResponse["description"] = result[2]
+        return Response(render_metrics(), mimetype=METRICS_MIMETYPE)
 
-        query.remove()
 
-        return self.response([queryResponse])
+#######################
+# REST CLASS AirodsList
+#
+# AIRODS - LIST
+# =============
+# (list of endpoints to stage data)
+#
+class AirodsList(EndpointResource):
+
+    labels = ["airods"]
+
+    @decorators.use_kwargs(ListInput, location="query")
+    @decorators.endpoint(
+        path="/airods/list",
+        summary="Get list of endpoint to stage data (epos ecosystem)",
+        responses=responses,
+    )
+    @instrumented("list")
+    @unavailable_when_busy
+    def get(self, refresh):
+
+        timer = request_timer()
+        timer.mode = "refresh" if refresh else "cached"
+
+        with irods_pool.session() as icom:
+            with timer.phase("icat"):
+                zones = zone_cache.stage_zones(icom, refresh=refresh)
+
+        return self.response(zones)
 
 
 ########################
@@ -385,68 +862,62 @@ class AirodsStage(EndpointResource):
         summary="Get data from irods-b2safe via boundingbox-timewindow and stage data to endpoint (epos ecosystem)",
         responses=responses,
     )
+    @instrumented("stage")
+    @unavailable_when_busy
     def get(
-        self, start, end, minlat, minlon, maxlat, maxlon,
+        self,
+        start,
+        end,
+        minlat,
+        minlon,
+        maxlat,
+        maxlon,
+        nscl,
+        network,
+        station,
+        channel,
+        location,
+        endpoint,
+        background=False,
+        overlap=False,
     ):
-        mongohd = self.get_service_instance("mongo")
-
-        nscl = ""
-        network = ""
-        station = ""
-        channel = ""
-        location = ""
-        endpoint = ""
-        db = mongohd.variables.get("database")
+        timer = request_timer()
+        timer.mode = "background" if background else "nscl" if nscl else "bbox"
 
-        mongohd.wf_do._mongometa.connection_alias = db
-
-        # MONGO
+        # MONGO (the models are bound to the connection with the first handle)
+        collection = mongo_collections.get(wf_do, read_only=True)
 
         # init
         documentResult1 = []
         myLine = {}
 
-        mycollection = mongohd.wf_do
-
         log.info(nscl)
 
-        # NSCL or BBOX
-        if nscl:
-
-            if not network:
-                raise BadRequest("Missing network")
-
-            # example of fileId "IV.ACER..HHE.D.2015.015"
-            myfirstvalue = mycollection.objects.raw(
-                {
-                    "fileId": {
-                        "$regex": f".*{network}.{station}.{channel}.{location}.*"
-                    },
-                    "dc_coverage_t_min": {"$gte": start},
-                    "dc_coverage_t_max": {"$lte": end},
-                }
-            )
-
-        else:
+        selection = {
+            "start": start,
+            "end": end,
+            "minlat": minlat,
+            "minlon": minlon,
+            "maxlat": maxlat,
+            "maxlon": maxlon,
+            "nscl": nscl,
+            "network": network,
+            "station": station,
+            "channel": channel,
+            "location": location,
+            "overlap": overlap,
+        }
 
-            myfirstvalue = mycollection.objects.raw(
-                {
-                    "dc_coverage_x": {"$gte": minlat, "$lte": maxlat},
-                    "dc_coverage_y": {"$gte": minlon, "$lte": maxlon},
-                    "dc_coverage_t_max": {"$lte": end},
-                    "dc_coverage_t_min": {"$gte": start},
-                }
-            )
+        # NSCL or BBOX
+        if nscl and not network:
+            raise BadRequest("Missing network")
 
         # debug
         # for document in myfirstvalue:
-        #    print  (document.irods_path)
+        #    print  (document["irods_path"])
 
         # return self.response(['total files staged che no: '])
 
-        # IRODS
-        icom = self.get_service_instance("irods")
-
         ephemeralDir = str(uuid.uuid4())
         #
         # @TODO:  multi endpoint managment
@@ -466,69 +937,153 @@ class AirodsStage(EndpointResource):
             dest_path += "/"
         dest_path += ephemeralDir
 
-        ipath = icom.create_directory(dest_path)
+        # registered first: only registered collections can be freed, and expire
+        created = datetime.utcnow()
+        StageCollection(
+            path=dest_path,
+            stage_id=ephemeralDir,
+            endpoint=endpoint,
+            created=created,
+            expires=stage_expiry(created),
+        ).save()
+
+        # JOB :: the worker selects and stages the data, poll /stage/<job_id>
+        if background:
+
+            job = StageJob(
+                job_id=ephemeralDir,
+                endpoint=endpoint,
+                remote_collection_ID=dest_path,
+                selection=selection,
+                created=created,
+            ).save()
 
-        if ipath is None:
-            raise RestApiException(f"Failed to create {dest_path}")
+            try:
+                celery = self.get_service_instance("celery")
+                celery.stage_job.apply_async(args=[job.job_id])
+            except BaseException as e:
+                # never queued: the job fails and its stage collection is freed
+                log.error("Stage job {} not queued: {}", job.job_id, e)
+                now = datetime.utcnow()
+                try:
+                    mongo_collections.get(StageJob).update_one(
+                        {"_id": job.job_id},
+                        {
+                            "$set": {
+                                "status": "failed",
+                                "error": str(e),
+                                "finished": now,
+                            }
+                        },
+                    )
+                    mongo_collections.get(StageCollection).update_one(
+                        {"_id": dest_path}, {"$set": {"freed": now}}
+                    )
+                    catalogue = StageCatalogue(mongo_collections.get(StageReplica))
+                    catalogue.release(dest_path)
+                except BaseException as cleanup_error:
+                    log.error("Stage job {} left over: {}", job.job_id, cleanup_error)
+                raise ServiceUnavailable("Stage jobs cannot be queued, retry later")
 
-        log.info("Created irods collection: {}", dest_path)
+            return self.response(
+                {
+                    "job_id": job.job_id,
+                    "status": job.status,
+                    "remote_collection_ID": dest_path,
+                },
+                code=202,
+            )
 
-        # STAGE
-        if ipath:
+        catalogue = StageCatalogue(mongo_collections.get(StageReplica))
 
-            # my counter
-            i = 0
-            for document in myfirstvalue:
+        # lean dicts straight from pymongo, no pymodm hydration
+        myfirstvalue = collection.find(
+            stage_filter(selection),
+            projection(PID_FIELDS),
+            batch_size=STREAM_BATCH_SIZE,
+        )
+
+        # IRODS :: dest_path is not created, it identifies the request: the
+        # objects are copied once to the shared replicas, see stage_path
+        with irods_pool.session() as icom:
 
-                stageOk = self.icopy(
-                    icom, document.irods_path, dest_path + "/" + document.fileId
+            documents = list(timer.iterate(myfirstvalue))
+
+            # only the objects not yet on the endpoint are copied,
+            # the replicas staged by earlier requests are listed
+            with timer.phase("icat"):
+                versions = object_versions(icom, [d["irods_path"] for d in documents])
+            replicas = catalogue.claim(endpoint, dest_path, stagePath, versions)
+            copies = stage_copies(replicas, dest_path)
+            with timer.phase("irods"):
+                create_parents(icom, copies)
+
+            # one iRODS session per worker: icom plus the ones free right now
+            workers = stage_workers(len(copies))
+            sessions = [icom]
+            if workers > 1:
+                sessions += irods_pool.checkout_free(workers - 1)
+
+            try:
+                results = stage_objects(
+                    timer.timed("irods_rule", replicate_batch),
+                    sessions,
+                    copies,
+                    endpoint=endpoint,
                 )
+            finally:
+                for session in sessions[1:]:
+                    irods_pool.checkin(session)
 
-                if stageOk:
+            catalogue.settle(replicas, results)
+            copied = {result.irods_path: result.ok for result in results}
+            pending = set(stage_pending(replicas, dest_path))
+            failed = set(stage_failed(replicas))
 
-                    myLine["file_ID"] = str(document.fileId)
-                    myLine["PID"] = str(document.dc_identifier)
+            # my counter
+            i = 0
+            for document in documents:
+
+                replica = replicas.get(document["irods_path"])
+                if replica and document["irods_path"] in pending:
+
+                    # not there yet: being copied by another request
+                    myLine = {
+                        "file_ID": str(document["fileId"]),
+                        "PID": str(document["dc_identifier"]),
+                        "stage_path": replica["stage_path"],
+                        "pending": True,
+                    }
+                    documentResult1.append(myLine)
+                elif (
+                    replica
+                    and document["irods_path"] not in failed
+                    and copied.get(document["irods_path"], True)
+                ):
+
+                    myLine = {
+                        "file_ID": str(document["fileId"]),
+                        "PID": str(document["dc_identifier"]),
+                        "stage_path": replica["stage_path"],
+                        "reused": document["irods_path"] not in copied,
+                    }
                     i += 1
                     documentResult1.append(myLine)
                 else:
 
-                    myLine["DO-NOT-OK"] = "stage DO " + document.fileId + ": NOT OK"
+                    myLine = {
+                        "DO-NOT-OK": "stage DO " + document["fileId"] + ": NOT OK"
+                    }
                     documentResult1.append(myLine)
 
-        else:
+            myLine = {}
 
-            myLine["DIR-NOT-OK"] = "stage dir:" + dest_path + " NOT OK"
-            documentResult1.append(myLine)
-        myLine = {}
-
-        myLine["remote_info"] = self.queryIcat(icom, endpoint, dest_path)
-        documentResult1.insert(0, myLine)
+            with timer.phase("icat"):
+                myLine["remote_info"] = self.queryIcat(icom, endpoint, dest_path)
+            documentResult1.insert(0, myLine)
 
         return self.response([f"total files staged: {i}", documentResult1])
 
-    # DO a COPY on Remote endpoint via irule
-    def icopy(self, icom, irods_path, dest_path):
-        """ EUDAT RULE for Replica (exploited for copy) """
-
-        outvar = "response"
-        inputs = {"*irods_path": '"%s"' % irods_path, "*stage_path": '"%s"' % dest_path}
-        body = """
-            *res = EUDATReplication(*irods_path, *stage_path, "false", "false", *{});
-            if (*res) {{
-                writeLine("stdout", "Object  replicated to stage area !");
-
-            }}
-            else {{
-                writeLine("stdout", "Replication failed: *{}");
-            }}
-        """.format(
-            outvar, outvar
-        )
-
-        rule_output = icom.rule("do_stage", body, inputs, output=True)
-
-        return [rule_output]
-
     # Exec a Rule
     """
     def rule(self, icom, name, body, inputs, output=False):
@@ -585,41 +1140,76 @@ class AirodsStage(EndpointResource):
             return self.response(raw_out)
         """
 
-    # Exec a Query
+    # Zone info of the remote endpoint, from the zone cache
     def queryIcat(self, icom, zone_name, dest_path):
 
-        sql = (
-            "select zone_name, zone_conn_string, r_comment   from r_zone_main where zone_name = '"
-            + zone_name
-            + "'"
-        )
-        log.debug(sql)
+        queryResponse = {"remote_collection_ID": dest_path}
+        queryResponse.update(zone_cache.zone(icom, zone_name) or {})
 
-        # alias = 'list_zone_max'
-        queryResponse = {}
-        # optional, if we want to get results by key
-        # columns = [DataObject.zone_id, DataObject.zone_name]
-        query = SpecificQuery(icom.prc, sql)
-        # register specific query in iCAT
-        _ = query.register()
+        return queryResponse
 
-        queryResponse["remote_collection_ID"] = dest_path
-        for result in query:
 
-            # log.debug('Endpoint: {}', result[0])
-            queryResponse["Endpoint"] = result[0]
-            if result[1]:
-                # log.debug('URL: {}', result[1])
-                queryResponse["URL"] = result[1]
-            if result[2]:
-                # log.debug('description: {}', result[2])
-                queryResponse["description"] = result[2]
+##########################
+# REST CLASS AirodsStageJob
+#
+# AIRODS - STAGE JOB
+# ==================
+# (progress of a background stage job)
+#
+class AirodsStageJob(EndpointResource):
 
-            # log.info('{} {}', result[zone_id], result[zone_name])
+    labels = ["airods"]
 
-        query.remove()
+    @decorators.endpoint(
+        path="/airods/stage/<job_id>",
+        summary="Get the progress of a background stage job (epos ecosystem)",
+        responses=responses,
+    )
+    def get(self, job_id):
 
-        return self.response(queryResponse)
+        # from the primary: the worker is updating it
+        job = mongo_collections.get(StageJob).find_one(
+            {"_id": job_id}, {"failed": 0, "pending": 0}
+        )
+        if job is None:
+            raise NotFound(f"Stage job {job_id} not found")
+
+        processed = job.get("files_done", 0) + job.get("files_failed", 0)
+        # the pending files are copied by other requests, at their pace
+        remaining = job.get("files_total", 0) - processed - job.get("files_pending", 0)
+
+        # ETA from the average rate since the job started
+        eta = None
+        if job["status"] == "running" and processed and job.get("started"):
+            elapsed = (datetime.utcnow() - job["started"]).total_seconds()
+            eta = round(elapsed / processed * remaining)
+
+        # the files are on the shared replicas, once the job is over
+        files = None
+        if job["status"] in ("done", "failed"):
+            catalogue = StageCatalogue(mongo_collections.get(StageReplica))
+            files = catalogue.files(job.get("remote_collection_ID"))
+
+        return self.response(
+            {
+                "job_id": job["_id"],
+                "status": job["status"],
+                "endpoint": job.get("endpoint"),
+                "remote_collection_ID": job.get("remote_collection_ID"),
+                "files_total": job.get("files_total", 0),
+                "files_done": job.get("files_done", 0),
+                "files_failed": job.get("files_failed", 0),
+                "files_reused": job.get("files_reused", 0),
+                "files_pending": job.get("files_pending", 0),
+                "bytes_done": job.get("bytes_done", 0),
+                "eta_seconds": eta,
+                "created": job.get("created"),
+                "started": job.get("started"),
+                "finished": job.get("finished"),
+                "error": job.get("error"),
+                "files": files,
+            }
+        )
 
 
 #################
@@ -627,7 +1217,8 @@ class AirodsStage(EndpointResource):
 #
 # AIRODS - FREE
 # =============
-# (free up space on the remote endpoints)  --> probably will  not be used
+# (free up space on the remote endpoints, expired collections are freed
+# by the reap_stage_collections task)
 #
 class AirodsFree(EndpointResource):
 
@@ -639,19 +1230,24 @@ class AirodsFree(EndpointResource):
         summary="Free/delete temporary remote collection (epos ecosystem)",
         responses=responses,
     )
+    @instrumented("free")
+    @unavailable_when_busy
     def get(self, remote_coll_id):
-        # documentResult = []
 
-        log.warning("@todo: delete remote collection!")
-        log.warning("@todo: empty trash remote !")
-        """
-        we need two rules:
-        1)
-        irm -r remote_coll_id
+        collections = mongo_collections.get(StageCollection)
 
-        2)
-        irmtrash -rV --orphan /BINGV/trash/home/rods#INGV/trash
+        # the remote_collection_ID returned by /stage, or its last part
+        stage = collections.find_one(
+            {"$or": [{"_id": remote_coll_id}, {"stage_id": remote_coll_id}]}
+        )
+        if stage is None:
+            raise NotFound(f"Stage collection {remote_coll_id} not found")
+        if stage.get("freed"):
+            raise NotFound(f"Stage collection {remote_coll_id} already freed")
 
-        """
+        catalogue = StageCatalogue(mongo_collections.get(StageReplica))
+        with irods_pool.session() as icom:
+            response = free_collection(icom, collections, catalogue, stage["_id"])
 
-        return self.response("ciao")
+        response["remote_collection_ID"] = stage["_id"]
+        return self.response(response)
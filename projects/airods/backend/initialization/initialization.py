@@ -1,6 +1,35 @@
+import threading
+
+import dateutil.parser
+from restapi.connectors.celery import CeleryExt
 from restapi.customizer import BaseCustomizer
+from restapi.utilities.logs import log
 
-# from restapi.utilities.logs import log
+from airods.commons.cleanup import REAP_INTERVAL
+from airods.commons.coverage import TILE_INTERVAL, build_tiles
+from airods.commons.database import mongo_collections
+from airods.commons.indexes import (
+    BACKFILL_INTERVAL,
+    QueryPlanError,
+    assert_indexed,
+    backfill_days,
+    backfill_nscl,
+    backfill_points,
+    ensure_indexes,
+)
+from airods.commons.queries import GEO_INDEX, bbox_filter
+from airods.commons.zones import register_queries
+from airods.models.mongo import (
+    COVERAGE_TILE_INDEXES,
+    STAGE_COLLECTION_INDEXES,
+    STAGE_REPLICA_INDEXES,
+    WF_DO_GEO_INDEXES,
+    WF_DO_INDEXES,
+    CoverageTile,
+    StageCollection,
+    StageReplica,
+    wf_do,
+)
 
 
 class Initializer:
@@ -11,7 +40,122 @@ class Initializer:
 
     def __init__(self, services, app=None):
         # c = services['{{auth_service}}']
-        pass
+
+        icom = services.get("irods")
+        if icom is not None:
+            register_queries(icom)
+
+        mongohd = services.get("mongo")
+        if mongohd is None:
+            log.warning("Mongo is not available, skipping wf_do indexes")
+            return
+
+        # once per process: the requests only pick up the ready handles
+        mongo_collections.configure(mongohd.variables)
+        collection = mongo_collections.get(wf_do)
+        tiles = mongo_collections.get(CoverageTile)
+
+        try:
+            ensure_indexes(mongo_collections.get(StageReplica), STAGE_REPLICA_INDEXES)
+            ensure_indexes(
+                mongo_collections.get(StageCollection), STAGE_COLLECTION_INDEXES
+            )
+        except BaseException as e:
+            log.error("Stage catalogue indexes not reconciled: {}", e)
+
+        # expired stage collections, freed by the celery beat
+        try:
+            CeleryExt.create_periodic_task(
+                name="reap_stage_collections",
+                task="airods.tasks.airods.reap_stage_collections",
+                every=REAP_INTERVAL,
+            )
+        except BaseException as e:
+            log.warning("Stage collections reaper not scheduled: {}", e)
+
+        # documents ingested since the last build, folded into the tiles
+        try:
+            CeleryExt.create_periodic_task(
+                name="build_coverage_tiles",
+                task="airods.tasks.airods.build_coverage_tiles",
+                every=TILE_INTERVAL,
+            )
+        except BaseException as e:
+            log.warning("Coverage tiles build not scheduled: {}", e)
+
+        # the NSCL fields of the documents ingested since the startup backfill
+        try:
+            CeleryExt.create_periodic_task(
+                name="backfill_nscl_fields",
+                task="airods.tasks.airods.backfill_nscl_fields",
+                every=BACKFILL_INTERVAL,
+            )
+        except BaseException as e:
+            log.warning("NSCL fields backfill not scheduled: {}", e)
+
+        # the day buckets of the documents ingested since the startup backfill
+        try:
+            CeleryExt.create_periodic_task(
+                name="backfill_day_buckets",
+                task="airods.tasks.airods.backfill_day_buckets",
+                every=BACKFILL_INTERVAL,
+            )
+        except BaseException as e:
+            log.warning("Day buckets backfill not scheduled: {}", e)
+
+        # index builds on a large catalogue take long: do not block the startup
+        threading.Thread(
+            target=self.reconcile_indexes,
+            args=(collection, tiles),
+            name="wf_do-indexes",
+            daemon=True,
+        ).start()
+
+    @staticmethod
+    def reconcile_indexes(collection, tiles):
+
+        indexes = list(WF_DO_INDEXES)
+        if GEO_INDEX:
+            backfill_points(collection)
+            indexes += WF_DO_GEO_INDEXES
+
+        try:
+            ensure_indexes(collection, indexes)
+        except BaseException as e:
+            log.critical("wf_do indexes not reconciled: {}", e)
+            return
+
+        try:
+            backfill_nscl(collection)
+        except BaseException as e:
+            log.error("NSCL backfill failed: {}", e)
+
+        try:
+            backfill_days(collection)
+        except BaseException as e:
+            log.error("Day buckets backfill failed: {}", e)
+
+        # sample bbox query, any window has the same plan shape
+        sample = bbox_filter(
+            dateutil.parser.parse("2015-01-03T00:00:00Z"),
+            dateutil.parser.parse("2015-01-24T00:00:00Z"),
+            35.30,
+            6.30,
+            46.30,
+            63.30,
+        )
+        try:
+            assert_indexed(collection, sample)
+        except QueryPlanError as e:
+            log.critical("{}", e)
+        else:
+            log.info("wf_do bbox queries are index-backed")
+
+        try:
+            ensure_indexes(tiles, COVERAGE_TILE_INDEXES)
+            build_tiles(collection, tiles, tiles.database["coverage_state"])
+        except BaseException as e:
+            log.error("Coverage tiles not updated: {}", e)
 
 
 class Customizer(BaseCustomizer):
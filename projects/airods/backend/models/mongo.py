@@ -2,6 +2,7 @@
 
 # from pymongo.write_concern import WriteConcern
 from pymodm import MongoModel, fields
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
 
 
 class Testing(MongoModel):
@@ -37,9 +38,193 @@ class wf_do(MongoModel):
     dcterms_isPartOf = fields.CharField()
     fileId = fields.CharField()
     irods_path = fields.CharField()
+    # bytes of the data object, if recorded by the ingestion
+    file_size = fields.BigIntegerField(blank=True)
+    # parsed from fileId (N.S.L.C.TYPE.YEAR.DOY) by backfill_nscl
+    network = fields.CharField(blank=True)
+    station = fields.CharField(blank=True)
+    location = fields.CharField(blank=True)
+    channel = fields.CharField(blank=True)
+    year = fields.IntegerField(blank=True)
+    doy = fields.IntegerField(blank=True)
+    # days (YYYY-MM-DD) spanned by t_min..t_max, for the overlap queries,
+    # by backfill_days: null when spanning more than DAY_BUCKETS_MAX days
+    days = fields.ListField(fields.CharField(), blank=True)
+    # GeoJSON point [dc_coverage_y, dc_coverage_x], only used with AIRODS_GEO_INDEX
+    dc_coverage_point = fields.PointField(blank=True)
 
     # class Meta:
     #    write_concern = WriteConcern(j=True)
 
 
 #    connection_alias = MYDB
+
+
+class StageJob(MongoModel):
+    """ Background stage request, see tasks/airods.py """
+
+    job_id = fields.CharField(primary_key=True)
+    status = fields.CharField(
+        choices=("queued", "running", "done", "failed"), default="queued"
+    )
+    endpoint = fields.CharField()
+    remote_collection_ID = fields.CharField()
+    # StageInput parameters, the documents are selected by the worker
+    selection = fields.DictField()
+    files_total = fields.IntegerField(default=0)
+    files_done = fields.IntegerField(default=0)
+    files_failed = fields.IntegerField(default=0)
+    # already on the endpoint, listed from the stage catalogue
+    files_reused = fields.IntegerField(default=0)
+    # being copied by another stage request
+    files_pending = fields.IntegerField(default=0)
+    pending = fields.ListField(fields.CharField(), blank=True)
+    bytes_done = fields.BigIntegerField(default=0)
+    failed = fields.ListField(fields.CharField(), blank=True)
+    error = fields.CharField(blank=True)
+    created = fields.DateTimeField()
+    started = fields.DateTimeField(blank=True)
+    finished = fields.DateTimeField(blank=True)
+
+    class Meta:
+        collection_name = "stage_job"
+
+
+class StageCollection(MongoModel):
+    """
+    Remote collection created by a stage request: only the registered ones
+    can be freed, and they expire (see commons/cleanup.py)
+    """
+
+    path = fields.CharField(primary_key=True)
+    stage_id = fields.CharField()
+    endpoint = fields.CharField()
+    created = fields.DateTimeField()
+    expires = fields.DateTimeField()
+    freed = fields.DateTimeField(blank=True)
+
+    class Meta:
+        collection_name = "stage_collection"
+
+
+class StageReplica(MongoModel):
+    """
+    Stage catalogue: the replica of one version (checksum) of a data object
+    on an endpoint, shared by the stage collections listed in collections
+    (refs is their count), see commons/replicas.py
+    """
+
+    endpoint = fields.CharField()
+    irods_path = fields.CharField()
+    checksum = fields.CharField()
+    stage_path = fields.CharField()
+    status = fields.CharField(choices=("staging", "ready", "failed"), default="staging")
+    # stage collection copying it (since claimed), while staging
+    owner = fields.CharField()
+    claimed = fields.DateTimeField()
+    collections = fields.ListField(fields.CharField(), blank=True)
+    refs = fields.IntegerField(default=0)
+    size = fields.BigIntegerField(blank=True)
+    created = fields.DateTimeField()
+    last_used = fields.DateTimeField()
+
+    class Meta:
+        collection_name = "stage_replica"
+
+
+class CoverageTile(MongoModel):
+    """ wf_do documents of one day in one lat/lon cell, see commons/coverage.py """
+
+    # "<day>:<lat>:<lon>"
+    tile_id = fields.CharField(primary_key=True)
+    day = fields.CharField()
+    lat = fields.FloatField()
+    lon = fields.FloatField()
+    files = fields.IntegerField()
+    t_min = fields.DateTimeField()
+    t_max = fields.DateTimeField()
+
+    class Meta:
+        collection_name = "coverage_tile"
+
+
+# wf_do indexes are reconciled once at startup by the Initializer,
+# they are not declared in Meta to keep index builds out of the request path
+WF_DO_INDEXES = [
+    # bbox + time-window queries (Airods, AirodsMeta, AirodsStage)
+    IndexModel(
+        [
+            ("dc_coverage_t_min", ASCENDING),
+            ("dc_coverage_t_max", ASCENDING),
+            ("dc_coverage_x", ASCENDING),
+            ("dc_coverage_y", ASCENDING),
+            # covers the PID list projection (no document fetch)
+            ("fileId", ASCENDING),
+            ("dc_identifier", ASCENDING),
+            ("irods_path", ASCENDING),
+        ],
+        name="wf_do_time_bbox",
+    ),
+    # keyset pagination sort order (see commons/pagination.py)
+    IndexModel(
+        [("dc_coverage_t_min", ASCENDING), ("_id", ASCENDING)], name="wf_do_page"
+    ),
+    # NSCL queries (AirodsStage), see commons/queries.py:nscl_filter
+    IndexModel(
+        [
+            ("network", ASCENDING),
+            ("station", ASCENDING),
+            ("channel", ASCENDING),
+            ("location", ASCENDING),
+            ("dc_coverage_t_min", ASCENDING),
+        ],
+        name="wf_do_nscl_time",
+    ),
+    # overlap queries (overlap=true): multikey, one key per spanned day
+    IndexModel(
+        [
+            ("days", ASCENDING),
+            ("dc_coverage_x", ASCENDING),
+            ("dc_coverage_y", ASCENDING),
+        ],
+        name="wf_do_days_bbox",
+    ),
+    IndexModel([("fileId", ASCENDING)], name="wf_do_fileId"),
+    IndexModel([("dc_identifier", ASCENDING)], name="wf_do_pid"),
+]
+
+WF_DO_GEO_INDEXES = [
+    IndexModel(
+        [("dc_coverage_point", GEOSPHERE), ("dc_coverage_t_min", ASCENDING)],
+        name="wf_do_point_time",
+    ),
+]
+
+COVERAGE_TILE_INDEXES = [
+    IndexModel(
+        [("day", ASCENDING), ("lat", ASCENDING), ("lon", ASCENDING)],
+        name="coverage_tile_day_cell",
+    ),
+]
+
+STAGE_COLLECTION_INDEXES = [
+    IndexModel([("stage_id", ASCENDING)], name="stage_collection_id"),
+    # collections still on the endpoint, by expiry
+    IndexModel(
+        [("freed", ASCENDING), ("expires", ASCENDING)], name="stage_collection_expiry"
+    ),
+]
+
+STAGE_REPLICA_INDEXES = [
+    IndexModel(
+        [("endpoint", ASCENDING), ("irods_path", ASCENDING), ("checksum", ASCENDING)],
+        name="stage_replica_object",
+        unique=True,
+    ),
+    # replicas referenced by a stage collection
+    IndexModel([("collections", ASCENDING)], name="stage_replica_collections"),
+    # unreferenced replicas, oldest first
+    IndexModel(
+        [("refs", ASCENDING), ("last_used", ASCENDING)], name="stage_replica_refs"
+    ),
+]
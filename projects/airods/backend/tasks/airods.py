@@ -0,0 +1,202 @@
+"""
+Background stage jobs, enqueued by /airods/stage?background=true
+and polled via /airods/stage/<job_id>, and catalogue maintenance tasks
+"""
+
+import posixpath
+from datetime import datetime
+
+from restapi.connectors.celery import CeleryExt
+from restapi.utilities.logs import log
+
+from airods.commons.cleanup import reap
+from airods.commons.coverage import build_tiles
+from airods.commons.database import mongo_collections
+from airods.commons.indexes import backfill_days, backfill_nscl
+from airods.commons.queries import projection, stage_filter
+from airods.commons.replicas import (
+    StageCatalogue,
+    create_parents,
+    object_versions,
+    stage_copies,
+    stage_failed,
+    stage_pending,
+)
+from airods.commons.sessions import irods_pool
+from airods.commons.staging import replicate_batch, stage_objects, stage_workers
+from airods.models.mongo import (
+    CoverageTile,
+    StageCollection,
+    StageJob,
+    StageReplica,
+    wf_do,
+)
+
+celery_app = CeleryExt.celery_app
+
+
+@celery_app.task(bind=True)
+def stage_job(self, job_id):
+
+    with celery_app.app.app_context():
+
+        jobs = mongo_collections.get(StageJob)
+        catalogue = StageCatalogue(mongo_collections.get(StageReplica))
+        job = jobs.find_one({"_id": job_id})
+        if job is None:
+            log.error("Stage job {} not found", job_id)
+            return
+
+        documents = list(
+            mongo_collections.get(wf_do, read_only=True).find(
+                stage_filter(job["selection"]), projection(("fileId", "irods_path"))
+            )
+        )
+        jobs.update_one(
+            {"_id": job_id},
+            {
+                "$set": {
+                    "status": "running",
+                    "started": datetime.utcnow(),
+                    "files_total": len(documents),
+                }
+            },
+        )
+        log.info("Stage job {}: {} files", job_id, len(documents))
+
+        versions = {}
+
+        def progress(result):
+            if result.ok:
+                size = versions[result.irods_path].size or 0
+                update = {"$inc": {"files_done": 1, "bytes_done": size}}
+            else:
+                update = {
+                    "$inc": {"files_failed": 1},
+                    "$push": {"failed": result.irods_path},
+                }
+            jobs.update_one({"_id": job_id}, update)
+
+        endpoint = job["endpoint"]
+        dest_path = job["remote_collection_ID"]
+        sessions = []
+        try:
+            sessions.append(irods_pool.checkout())
+
+            # only the objects not yet on the endpoint are copied, to the
+            # shared replicas (dest_path identifies the job, it is not created)
+            irods_paths = [d["irods_path"] for d in documents]
+            versions.update(object_versions(sessions[0], irods_paths))
+            replicas = catalogue.claim(
+                endpoint, dest_path, posixpath.dirname(dest_path), versions
+            )
+            copies = stage_copies(replicas, dest_path)
+            create_parents(sessions[0], copies)
+
+            # the replicas another request is still copying are not done
+            pending = stage_pending(replicas, dest_path)
+            # failed meanwhile by another request: copied by the next one
+            failed = stage_failed(replicas)
+            reused = len(replicas) - len(copies) - len(pending) - len(failed)
+            missing = [path for path in irods_paths if path not in replicas]
+            missing += failed
+            jobs.update_one(
+                {"_id": job_id},
+                {
+                    "$inc": {
+                        "files_done": reused,
+                        "files_reused": reused,
+                        "files_pending": len(pending),
+                        "files_failed": len(missing),
+                    },
+                    "$push": {
+                        "failed": {"$each": missing},
+                        "pending": {"$each": pending},
+                    },
+                },
+            )
+            log.info(
+                "Stage job {}: {} files already staged, {} pending",
+                job_id,
+                reused,
+                len(pending),
+            )
+
+            workers = stage_workers(len(copies))
+            if workers > 1:
+                sessions += irods_pool.checkout_free(workers - 1)
+
+            results = stage_objects(
+                replicate_batch,
+                sessions,
+                copies,
+                endpoint=endpoint,
+                callback=progress,
+            )
+            catalogue.settle(replicas, results)
+        except BaseException as e:
+            log.error("Stage job {} failed: {}", job_id, e)
+            jobs.update_one(
+                {"_id": job_id},
+                {
+                    "$set": {
+                        "status": "failed",
+                        "error": str(e),
+                        "finished": datetime.utcnow(),
+                    }
+                },
+            )
+            raise
+        finally:
+            for session in sessions:
+                irods_pool.checkin(session)
+
+        jobs.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "done", "finished": datetime.utcnow()}},
+        )
+        log.info("Stage job {} completed", job_id)
+
+
+@celery_app.task(bind=True)
+def backfill_nscl_fields(self):
+    """ Parse the NSCL fields of the wf_do documents ingested since the last run """
+
+    with celery_app.app.app_context():
+
+        return backfill_nscl(mongo_collections.get(wf_do))
+
+
+@celery_app.task(bind=True)
+def backfill_day_buckets(self):
+    """ Bucket into days the wf_do documents ingested since the last run """
+
+    with celery_app.app.app_context():
+
+        return backfill_days(mongo_collections.get(wf_do))
+
+
+@celery_app.task(bind=True)
+def build_coverage_tiles(self, rebuild=False):
+    """ Fold the wf_do documents ingested since the last build into the tiles """
+
+    with celery_app.app.app_context():
+
+        tiles = mongo_collections.get(CoverageTile)
+        return build_tiles(
+            mongo_collections.get(wf_do),
+            tiles,
+            tiles.database["coverage_state"],
+            rebuild=rebuild,
+        )
+
+
+@celery_app.task(bind=True)
+def reap_stage_collections(self):
+    """ Free the expired stage collections and the replicas unused since long """
+
+    with celery_app.app.app_context():
+
+        catalogue = StageCatalogue(mongo_collections.get(StageReplica))
+        with irods_pool.session() as icom:
+            return reap(icom, mongo_collections.get(StageCollection), catalogue)
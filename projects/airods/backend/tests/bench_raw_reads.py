@@ -0,0 +1,75 @@
+"""
+Documents/second of the pymodm (hydrated models) and raw pymongo read paths
+
+    python bench_raw_reads.py --uri mongodb://localhost:27017/airods_bench --docs 100000
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from pymodm.connection import connect
+
+from airods.commons.queries import META_FIELDS, PID_FIELDS, bbox_filter, projection
+from airods.models.mongo import wf_do
+from airods.tests.synthetic import populate
+
+ALIAS = "bench"
+
+
+def hydrated(query, fields):
+    """ The former read path: pymodm models copied back into dicts """
+
+    return [
+        {field: getattr(document, field) for field in fields}
+        for document in wf_do.objects.raw(query)
+    ]
+
+
+def raw(collection, batch_size):
+    def read(query, fields):
+        return list(collection.find(query, projection(fields), batch_size=batch_size))
+
+    return read
+
+
+def bench(read, query, fields, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(read(query, fields))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, count / best if best else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--uri", default="mongodb://localhost:27017/airods_bench")
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    connect(args.uri, alias=ALIAS)
+    wf_do._mongometa.connection_alias = ALIAS
+    collection = wf_do._mongometa.collection
+    populate(collection, args.docs)
+
+    query = bbox_filter(
+        datetime(2015, 1, 1), datetime(2016, 1, 1), 35.0, 6.0, 47.0, 19.0
+    )
+
+    print(f"{args.docs} documents, batch size {args.batch_size}")
+    print("fields  path      docs    docs/s")
+    for name, fields in (("pid", PID_FIELDS), ("meta", META_FIELDS)):
+        for path, read in (
+            ("pymodm", hydrated),
+            ("raw", raw(collection, args.batch_size)),
+        ):
+            count, rate = bench(read, query, fields, args.repeat)
+            print(f"{name:6s}  {path:6s}  {count:8d}  {rate:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Stage pool throughput against a fake EUDATReplication rule executor
+
+    python bench_stage_pool.py --files 200 --workers 1,2,4,8,16 --batch 1,20
+"""
+
+import argparse
+import time
+
+from airods.commons.staging import STAGE_ENDPOINT_LIMIT, replicate_batch, stage_objects
+from airods.tests.fakes import FakeIrods
+
+
+def bench(files, latency, per_object, workers, batch_size):
+    tasks = [
+        (f"/INGV/home/IV.ACER..HHE.D.2015.{i:03d}", f"/stage/{i:03d}")
+        for i in range(files)
+    ]
+    sessions = [FakeIrods(latency, per_object) for _ in range(workers)]
+
+    start = time.perf_counter()
+    results = stage_objects(
+        replicate_batch, sessions, tasks, endpoint="BENCH", batch_size=batch_size
+    )
+    elapsed = time.perf_counter() - start
+
+    assert all(r.ok for r in results)
+    assert [r.irods_path for r in results] == [t[0] for t in tasks]
+
+    return elapsed, files / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--per-object", type=float, default=0.005)
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    parser.add_argument("--batch", default="1,20")
+    args = parser.parse_args()
+
+    print(
+        f"{args.files} files, {args.latency * 1000:.0f} ms per rule"
+        f" + {args.per_object * 1000:.0f} ms per object"
+    )
+    print(f"endpoint limit: {STAGE_ENDPOINT_LIMIT}")
+    print("batch  workers  elapsed(s)  files/s  speedup")
+    baseline = None
+    for batch_size in (int(b) for b in args.batch.split(",")):
+        for workers in (int(w) for w in args.workers.split(",")):
+            elapsed, rate = bench(
+                args.files, args.latency, args.per_object, workers, batch_size
+            )
+            baseline = baseline or rate
+            print(
+                f"{batch_size:5d}  {workers:7d}  {elapsed:10.2f}"
+                f"  {rate:7.1f}  {rate / baseline:6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
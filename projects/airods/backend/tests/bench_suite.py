@@ -0,0 +1,466 @@
+"""
+Offline benchmark suite of the airods endpoints, without a live B2SAFE:
+the views are requested through a Flask test client, on a synthetic wf_do
+catalogue (local mongod or mongomock) and a fake iRODS service simulating
+rule latency and read throughput. Run it where the backend runs (restapi
+installed), the mongo, irods and authentication services are not needed.
+Latency percentiles, docs/s and peak memory of each endpoint and mode
+are written to a JSON file, to be compared across commits
+
+    python bench_suite.py --docs 100000 --output before.json
+    python bench_suite.py --docs 100000 --output after.json --baseline before.json
+"""
+
+import argparse
+import functools
+import json
+import math
+import os
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+from flask import Flask
+from flask_restful import Api
+from pymodm.connection import _CONNECTIONS, ConnectionInfo
+from restapi.confs import API_URL
+from restapi.rest.definition import EndpointResource
+
+from airods.commons.cache import results_cache, watermark
+from airods.commons.coverage import build_tiles
+from airods.commons.database import MODELS, MONGO_ALIAS, mongo_collections
+from airods.commons.indexes import ensure_indexes
+from airods.commons.metrics import DOCUMENTS
+from airods.commons.sessions import irods_pool
+from airods.commons.zones import zone_cache
+from airods.endpoints.airods import (
+    Airods,
+    AirodsBulk,
+    AirodsCoverage,
+    AirodsMeta,
+    AirodsStage,
+)
+from airods.models.mongo import (
+    COVERAGE_TILE_INDEXES,
+    WF_DO_INDEXES,
+    StageCollection,
+    StageReplica,
+)
+from airods.tests.fakes import FakeIrods
+from airods.tests.synthetic import populate
+
+# (start, end, minlat, minlon, maxlat, maxlon) of the benchmarked selections
+WINDOWS = {
+    "week": (datetime(2015, 3, 1), datetime(2015, 3, 8), 41.0, 12.0, 44.0, 15.0),
+    "year": (datetime(2015, 1, 1), datetime(2016, 1, 1), 35.0, 6.0, 47.0, 19.0),
+}
+
+VIEWS = (Airods, AirodsMeta, AirodsBulk, AirodsCoverage, AirodsStage)
+
+# endpoint of the stage requests, its stage area
+STAGE_ZONE = "INGV"
+STAGE_PATH = f"/{STAGE_ZONE}/home/rods/stage"
+
+
+def bench_client(db, irods):
+    """
+    Test client of a Flask app serving the airods views as restapi maps
+    them (flask-restful resources, use_kwargs parsing, instrumented), with
+    the fakes in place of the services: the models and the collection
+    handles on db, every pooled iRODS session made by irods()
+    """
+
+    _CONNECTIONS[MONGO_ALIAS] = ConnectionInfo(None, None, db)
+    for model in MODELS:
+        model._mongometa.connection_alias = MONGO_ALIAS
+    mongo_collections.handles.clear()
+    mongo_collections.configured = True
+
+    irods_pool.factory = irods
+    irods_pool.close = irods_pool.check = lambda icom: None
+    zone_cache.by_name = {STAGE_ZONE: {"Endpoint": STAGE_ZONE}}
+    zone_cache.expires = math.inf
+    os.environ.setdefault("AIRODS_STAGE_PATH_1", STAGE_PATH)
+
+    # every run queries mongo: no result cache, the catalogue does not change
+    results_cache.maxsize = 0
+    watermark.pid = os.getpid()
+
+    # no authentication service: the views are public
+    EndpointResource.load_authentication = staticmethod(lambda: None)
+
+    app = Flask("airods_bench")
+    # errors reach the suite (and its results) instead of a 500
+    app.testing = True
+    api = Api()
+    for view in VIEWS:
+        uris = [
+            API_URL + uri
+            for method in ("get", "post")
+            for uri in getattr(getattr(view, method, None), "uris", [])
+        ]
+        api.add_resource(view, *uris)
+    api.init_app(app)
+    return app.test_client()
+
+
+def documents_read():
+    """ wf_do documents read so far by the instrumented views """
+
+    with DOCUMENTS.lock:
+        return sum(DOCUMENTS.values.values())
+
+
+def request(ctx, path, json_body=None, headers=None, keep=True, **params):
+    """
+    Run a request and drain its body as a client would (streamed
+    responses included). Returns the response and its body
+    (only its size without keep: archives are not held in memory)
+    """
+
+    if json_body is None:
+        response = ctx.client.get(
+            f"{API_URL}/airods/{path}", query_string=params, headers=headers
+        )
+    else:
+        response = ctx.client.post(
+            f"{API_URL}/airods/{path}", json=json_body, headers=headers
+        )
+    chunks = []
+    size = 0
+    try:
+        for chunk in response.iter_encoded():
+            size += len(chunk)
+            if keep or response.status_code != 200:
+                chunks.append(chunk)
+    finally:
+        # runs the on-close callbacks: metrics, download sessions back
+        response.close()
+
+    body = b"".join(chunks)
+    if response.status_code != 200:
+        raise RuntimeError(f"{path}: {response.status_code} {body[:200]!r}")
+    return response, body if keep else size
+
+
+def served(ctx, path, **kwargs):
+    """ wf_do documents read by the view to answer the request """
+
+    before = documents_read()
+    request(ctx, path, keep=False, **kwargs)
+    return documents_read() - before
+
+
+def window_params(window):
+    start, end, minlat, minlon, maxlat, maxlon = window
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "minlat": minlat,
+        "minlon": minlon,
+        "maxlat": maxlat,
+        "maxlon": maxlon,
+    }
+
+
+def data_pid(ctx, window):
+    return served(ctx, "data", download="false", **window_params(window))
+
+
+def data_page(ctx, window):
+    params = window_params(window)
+    return served(ctx, "data", download="false", limit=ctx.page_size, **params)
+
+
+def data_summary(ctx, window):
+    params = window_params(window)
+    _, body = request(ctx, "data", download="false", summary="true", **params)
+    # counted by mongo: no document is read
+    return json.loads(body)["total_files"]
+
+
+def data_download(ctx, window):
+    params = window_params(window)
+    return served(ctx, "data", download="true", limit=ctx.download_files, **params)
+
+
+def meta_json(ctx, window):
+    return served(ctx, "meta", **window_params(window))
+
+
+def meta_overlap(ctx, window):
+    return served(ctx, "meta", overlap="true", **window_params(window))
+
+
+def meta_ndjson(ctx, window):
+    headers = {"Accept": "application/x-ndjson"}
+    return served(ctx, "meta", headers=headers, **window_params(window))
+
+
+def meta_format(output_format):
+    """ /airods/meta?format=..., encoded without the per-row JSON objects """
+
+    def run(ctx, window):
+        return served(ctx, "meta", format=output_format, **window_params(window))
+
+    return run
+
+
+def meta_pages(ctx, window):
+    """ Walk every page of the selection, as a client following next would """
+
+    params = window_params(window)
+    params["limit"] = ctx.page_size
+    before = documents_read()
+    while True:
+        _, body = request(ctx, "meta", **params)
+        token = json.loads(body)[-1]["next"]
+        if token is None:
+            return documents_read() - before
+        params["next"] = token
+
+
+def meta_bulk(ctx, window):
+    """ /airods/bulk with ctx.bulk_selections overlapping slices of the window """
+
+    start, end = window[:2]
+    step = (end - start) / ctx.bulk_selections
+    selections = []
+    for i in range(ctx.bulk_selections):
+        selection = window_params(
+            (start + step * i, start + step * i + 2 * step) + window[2:]
+        )
+        selections.append(selection)
+    return served(ctx, "bulk", json_body={"selections": selections})
+
+
+def coverage_tiles(ctx, window):
+    return served(ctx, "coverage", **window_params(window))
+
+
+def clear_stage(ctx):
+    """ Every stage run copies its objects: no replica left by the previous one """
+
+    mongo_collections.get(StageReplica).delete_many({})
+    mongo_collections.get(StageCollection).delete_many({})
+
+
+def stage_bbox(ctx, window):
+    params = window_params(window)
+    return served(ctx, "stage", nscl="false", endpoint=STAGE_ZONE, **params)
+
+
+def stage_nscl(ctx, window):
+    params = window_params(window)
+    params.update(network="IV", station="S00*", channel="HH?", location="--")
+    return served(ctx, "stage", nscl="true", endpoint=STAGE_ZONE, **params)
+
+
+SCENARIOS = [
+    ("data", "pid", data_pid, None),
+    ("data", "page", data_page, None),
+    ("data", "summary", data_summary, None),
+    ("data", "download", data_download, None),
+    ("meta", "json", meta_json, None),
+    ("meta", "overlap", meta_overlap, None),
+    ("meta", "ndjson", meta_ndjson, None),
+    ("meta", "columnar", meta_format("columnar"), None),
+    ("meta", "msgpack", meta_format("msgpack"), None),
+    ("meta", "arrow", meta_format("arrow"), None),
+    ("meta", "parquet", meta_format("parquet"), None),
+    ("meta", "pages", meta_pages, None),
+    ("meta", "bulk", meta_bulk, None),
+    ("coverage", "tiles", coverage_tiles, None),
+    ("stage", "bbox", stage_bbox, clear_stage),
+    ("stage", "nscl", stage_nscl, clear_stage),
+]
+
+
+class Context:
+    def __init__(self, client, args):
+        self.client = client
+        self.page_size = args.page_size
+        self.download_files = args.download_files
+        self.bulk_selections = args.bulk_selections
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of the sorted values """
+
+    index = max(0, min(len(values) - 1, round(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def measure(run, prepare, ctx, window, repeat):
+    """
+    Time repeat runs, then one more under tracemalloc for the peak memory.
+    prepare, if given, runs untimed before each of them
+    """
+
+    latencies = []
+    for _ in range(repeat):
+        if prepare:
+            prepare(ctx)
+        start = time.perf_counter()
+        docs = run(ctx, window)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    if prepare:
+        prepare(ctx)
+    tracemalloc.start()
+    try:
+        run(ctx, window)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    mean = sum(latencies) / len(latencies)
+    return {
+        "docs": docs,
+        "runs": repeat,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "mean": mean,
+        "docs_per_sec": docs / mean if mean else 0,
+        "peak_memory": peak,
+    }
+
+
+def connect(args):
+    if args.mongomock:
+        # optional: only needed to run without a mongod
+        import mongomock
+
+        return mongomock.MongoClient()[args.database]
+
+    from pymongo import MongoClient
+
+    return MongoClient(args.uri)[args.database]
+
+
+def commit():
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+def compare(results, baseline):
+    """ Print the p50 and peak memory ratios against a previous run """
+
+    with open(baseline) as f:
+        previous = {
+            (r["endpoint"], r["mode"], r["window"]): r for r in json.load(f)["results"]
+        }
+
+    print(f"\nagainst {baseline}")
+    print("endpoint  mode      window   p50 x   memory x")
+    for result in results:
+        key = (result["endpoint"], result["mode"], result["window"])
+        before = previous.get(key)
+        if before is None or "error" in result or "error" in before:
+            continue
+        p50 = before["p50"] and result["p50"] / before["p50"]
+        memory = before["peak_memory"] and result["peak_memory"] / before["peak_memory"]
+        print(f"{key[0]:8s}  {key[1]:8s}  {key[2]:6s}  {p50:6.2f}  {memory:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="airods_bench")
+    parser.add_argument(
+        "--mongomock", action="store_true", help="in-memory mongomock, no mongod"
+    )
+    parser.add_argument("--docs", type=int, default=10000, help="1k to 10M")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--download-files", type=int, default=20)
+    parser.add_argument("--bulk-selections", type=int, default=50)
+    parser.add_argument("--rule-latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--per-object", type=float, default=0.002, help="seconds")
+    parser.add_argument("--read-throughput", type=float, default=100, help="MB/s")
+    parser.add_argument("--object-size", type=int, default=6000000, help="bytes")
+    parser.add_argument(
+        "--only", help="comma separated endpoint or endpoint/mode, e.g. meta,data/pid"
+    )
+    parser.add_argument("--output", default=None, help="bench-<commit>.json")
+    parser.add_argument("--baseline", help="previous output to compare with")
+    args = parser.parse_args()
+
+    db = connect(args)
+    collection = db["wf_do"]
+    tiles = db["coverage_tile"]
+    if populate(collection, args.docs):
+        print(f"Generated {args.docs} synthetic documents")
+        try:
+            ensure_indexes(collection, WF_DO_INDEXES)
+            ensure_indexes(tiles, COVERAGE_TILE_INDEXES)
+            build_tiles(collection, tiles, db["coverage_state"], rebuild=True)
+        except Exception as e:
+            print(f"Indexes or coverage tiles not built: {e}")
+
+    irods = functools.partial(
+        FakeIrods,
+        latency=args.rule_latency,
+        per_object=args.per_object,
+        throughput=args.read_throughput * 1000000,
+        object_size=args.object_size,
+        catalogue=collection,
+    )
+    ctx = Context(bench_client(db, irods), args)
+
+    only = set(args.only.split(",")) if args.only else None
+    results = []
+    print("endpoint  mode      window      docs    p50 s    p99 s    docs/s   peak MB")
+    for endpoint, mode, run, prepare in SCENARIOS:
+        if only and endpoint not in only and f"{endpoint}/{mode}" not in only:
+            continue
+        for name, window in WINDOWS.items():
+            result = {"endpoint": endpoint, "mode": mode, "window": name}
+            try:
+                result.update(measure(run, prepare, ctx, window, args.repeat))
+            except Exception as e:
+                # e.g. aggregation stages that mongomock does not implement,
+                # or a format the server has no library for
+                result["error"] = str(e)
+                print(f"{endpoint:8s}  {mode:8s}  {name:6s}  {e}")
+                results.append(result)
+                continue
+            results.append(result)
+            print(
+                f"{endpoint:8s}  {mode:8s}  {name:6s}  {result['docs']:8d}  "
+                f"{result['p50']:7.3f}  {result['p99']:7.3f}  "
+                f"{result['docs_per_sec']:8.0f}  {result['peak_memory'] / 1e6:8.1f}"
+            )
+
+    revision = commit()
+    output = args.output or f"bench-{revision or 'local'}.json"
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": revision,
+                "created": datetime.now().isoformat(),
+                "mongo": "mongomock" if args.mongomock else args.uri,
+                "params": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+iRODS stand-ins for the benchmarks: rule latency and read throughput
+"""
+
+import re
+import time
+from datetime import datetime
+
+from irods.models import DataObject
+
+from airods.commons.staging import PATH_SEPARATOR
+
+
+class FakeHandle:
+    """ Data object handle producing size zero bytes at throughput bytes/s """
+
+    def __init__(self, size, throughput):
+        self.size = size
+        self.throughput = throughput
+        self.position = 0
+
+    def seek(self, offset):
+        self.position = offset
+
+    def read(self, length):
+        length = max(0, min(length, self.size - self.position))
+        self.position += length
+        if self.throughput:
+            time.sleep(length / self.throughput)
+        return bytes(length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeDataObject:
+    def __init__(self, path, size, throughput):
+        self.path = path
+        self.size = size
+        self.throughput = throughput
+        self.checksum = None
+        self.modify_time = datetime(2016, 1, 1)
+
+    def open(self, mode="r"):
+        return FakeHandle(self.size, self.throughput)
+
+
+class FakeDataObjects:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, path):
+        time.sleep(self.service.latency)
+        return FakeDataObject(path, self.service.object_size, self.service.throughput)
+
+
+class FakeQuery:
+    """ iCAT query of the data objects of one collection, from the catalogue """
+
+    def __init__(self, service):
+        self.service = service
+        self.collection = None
+        self.names = None
+
+    def filter(self, criterion):
+        if criterion.op == "in":
+            self.names = set(criterion.value)
+        else:
+            self.collection = criterion.value
+        return self
+
+    def __iter__(self):
+        time.sleep(self.service.latency)
+        if self.service.catalogue is None:
+            return
+        pattern = f"^{re.escape(self.collection)}/[^/]+$"
+        for document in self.service.catalogue.find(
+            {"irods_path": {"$regex": pattern}}, {"irods_path": 1, "file_size": 1}
+        ):
+            name = document["irods_path"].rpartition("/")[2]
+            if self.names is not None and name not in self.names:
+                continue
+            yield {
+                DataObject.name: name,
+                DataObject.checksum: None,
+                DataObject.size: document.get("file_size", self.service.object_size),
+                DataObject.modify_time: datetime(2016, 1, 1),
+            }
+
+
+class FakeSession:
+    def __init__(self, service):
+        self.service = service
+        self.data_objects = FakeDataObjects(service)
+        self.zone = "INGV"
+        self.username = "rods"
+
+    def query(self, *columns):
+        return FakeQuery(self.service)
+
+
+class FakeIrods:
+    """
+    Stands in for the irods service: each rule run costs latency seconds
+    (round trip, parsing) plus per_object seconds for each replicated
+    object, reads go at throughput bytes/s (0: unthrottled).
+    The iCAT queries list the data objects of catalogue (a wf_do collection)
+    """
+
+    def __init__(
+        self,
+        latency=0.02,
+        per_object=0.002,
+        throughput=0,
+        object_size=0,
+        catalogue=None,
+    ):
+        self.latency = latency
+        self.per_object = per_object
+        self.throughput = throughput
+        self.object_size = object_size
+        self.catalogue = catalogue
+        self.prc = FakeSession(self)
+
+    def rule(self, name, body, inputs, output=False):
+        # do_stage_single: one object, whatever its path contains
+        paths = inputs.get("*irods_paths")
+        objects = paths.count(PATH_SEPARATOR) + 1 if paths is not None else 1
+        time.sleep(self.latency + self.per_object * objects)
+        return "".join(f"AIRODS:{i}:OK" for i in range(objects))
+
+    def create_directory(self, path, ignore_existing=False):
+        time.sleep(self.latency)
+        return path
@@ -0,0 +1,80 @@
+"""
+Synthetic wf_do catalogue for the benchmarks
+"""
+
+import random
+from datetime import datetime, timedelta
+
+ORIGIN = datetime(2015, 1, 1)
+NETWORKS = ("IV", "MN", "GU", "OX")
+CHANNELS = ("HHE", "HHN", "HHZ")
+
+
+def synthetic_documents(count, days=365, seed=0):
+    """
+    count daily miniSEED-like wf_do documents: stations scattered over
+    Italy, one file per station, channel and day, spread over days days
+    """
+
+    rng = random.Random(seed)
+    stations = {}
+    for i in range(count):
+        day = ORIGIN + timedelta(days=i % days)
+        channel = CHANNELS[i // days % len(CHANNELS)]
+        index = i // (days * len(CHANNELS))
+        network = NETWORKS[index % len(NETWORKS)]
+        station = f"S{index:04d}"
+        if station not in stations:
+            stations[station] = (rng.uniform(36.0, 47.0), rng.uniform(6.5, 18.5))
+        lat, lon = stations[station]
+        doy = day.timetuple().tm_yday
+        file_id = f"{network}.{station}..{channel}.D.{day.year}.{doy:03d}"
+        yield {
+            "_cls": "airods.models.mongo.wf_do",
+            "fileId": file_id,
+            "network": network,
+            "station": station,
+            "location": "",
+            "channel": channel,
+            "year": day.year,
+            "doy": doy,
+            "dc_identifier": f"11099/{i:012d}",
+            "dc_title": "INGV_Repository",
+            "dc_subject": "mSEED, waveform, quality",
+            "dc_creator": "EIDA NODE (INGV)",
+            "dc_contributor": "network operator",
+            "dc_publisher": "EIDA NODE (INGV)",
+            "dc_type": "seismic waveform",
+            "dc_format": "MSEED",
+            "dc_date": day,
+            "dc_coverage_x": lat,
+            "dc_coverage_y": lon,
+            "dc_coverage_z": rng.uniform(0.0, 2000.0),
+            "dc_coverage_t_min": day,
+            "dc_coverage_t_max": day + timedelta(hours=23, minutes=59, seconds=59),
+            "days": [day.strftime("%Y-%m-%d")],
+            "dcterms_available": day + timedelta(days=1),
+            "dcterms_dateAccepted": day + timedelta(days=1),
+            "dc_rights": "open access",
+            "dcterms_isPartOf": "wfmetadata_catalog",
+            "irods_path": f"/INGV/home/rods/{network}/{station}/{channel}.D/{file_id}",
+            "file_size": rng.randint(2000000, 9000000),
+        }
+
+
+def populate(collection, count, batch_size=10000):
+    """ Fill collection with count synthetic documents, unless already there """
+
+    if collection.estimated_document_count() == count:
+        return False
+
+    collection.delete_many({})
+    batch = []
+    for document in synthetic_documents(count):
+        batch.append(document)
+        if len(batch) == batch_size:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    return True
@@ -0,0 +1,61 @@
+"""
+Tar streaming of commons/archive.py
+"""
+
+import io
+import tarfile
+
+from irods.exception import DataObjectDoesNotExist, NetworkException
+
+from airods.commons.archive import ERRORS_MEMBER, tar_chunks
+from airods.tests.fakes import FakeDataObjects, FakeIrods
+
+ENTRIES = [("a/1", "/zone/a/1"), ("a/2", "/zone/a/2"), ("a/3", "/zone/a/3")]
+
+
+class FailingObjects(FakeDataObjects):
+    """ Raises error for the data object at path """
+
+    def __init__(self, service, path, error):
+        super().__init__(service)
+        self.path = path
+        self.error = error
+
+    def get(self, path):
+        if path == self.path:
+            raise self.error
+        return super().get(path)
+
+
+def download(path, error):
+    irods = FakeIrods(latency=0, object_size=1000)
+    irods.prc.data_objects = FailingObjects(irods, path, error)
+    released = []
+    data = b"".join(tar_chunks(irods, ENTRIES, chunk_size=300, release=released.append))
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        members = {m.name: archive.extractfile(m).read() for m in archive}
+    return members, released
+
+
+def test_missing_object_is_skipped():
+    members, released = download("/zone/a/2", DataObjectDoesNotExist())
+
+    assert list(members) == ["a/1", "a/3", ERRORS_MEMBER]
+    assert members["a/1"] == bytes(1000)
+    assert b"/zone/a/2" in members[ERRORS_MEMBER]
+    assert released == [False]
+
+
+def test_lost_connection_ends_the_archive():
+    members, released = download("/zone/a/2", NetworkException("reset"))
+
+    assert list(members) == ["a/1", ERRORS_MEMBER]
+    assert b"download interrupted" in members[ERRORS_MEMBER]
+    assert released == [True]
+
+
+def test_complete_archive_has_no_errors_member():
+    members, released = download(None, None)
+
+    assert list(members) == [name for name, _ in ENTRIES]
+    assert released == [False]
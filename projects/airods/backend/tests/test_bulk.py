@@ -0,0 +1,70 @@
+"""
+Selections of /airods/bulk, commons/bulk.py
+"""
+
+from datetime import datetime
+
+import pytest
+from restapi.exceptions import BadRequest
+
+from airods.commons.bulk import bulk_pipeline, check_selection, parse_fdsn_selections
+
+FDSN_BODY = """
+quality=B
+minimumlength=0.0
+IV ACER -- HH? 2015-01-01T00:00:00 2015-01-02T00:00:00
+MN * * BH* 2015-01-01 2015-01-01T12:00:00Z
+"""
+
+
+def test_parse_fdsn_selections():
+    first, second = parse_fdsn_selections(FDSN_BODY)
+
+    assert first == {
+        "start": datetime(2015, 1, 1),
+        "end": datetime(2015, 1, 2),
+        "network": "IV",
+        "station": "ACER",
+        "location": "--",
+        "channel": "HH?",
+    }
+    assert second["network"] == "MN"
+    assert second["end"].hour == 12
+
+
+@pytest.mark.parametrize(
+    "body, message",
+    [
+        ("IV ACER -- HHE 2015-01-01", "Line 1: expected"),
+        ("\nIV ACER -- HHE yesterday today", "Line 2: invalid"),
+    ],
+)
+def test_parse_fdsn_selections_errors(body, message):
+    with pytest.raises(BadRequest, match=message):
+        parse_fdsn_selections(body)
+
+
+def test_check_selection():
+    window = {"start": datetime(2015, 1, 1), "end": datetime(2015, 1, 2)}
+    check_selection(0, dict(window, minlat=1, minlon=2, maxlat=3, maxlon=4))
+    check_selection(1, dict(window, network="IV"))
+
+    with pytest.raises(BadRequest, match="Selection 2"):
+        check_selection(2, dict(window, minlat=1))
+    with pytest.raises(BadRequest, match="Selection 3"):
+        check_selection(3, window)
+
+
+def test_bulk_pipeline_tags_each_selection():
+    window = {"start": datetime(2015, 1, 1), "end": datetime(2015, 1, 2)}
+    selections = [
+        dict(window, minlat=1, minlon=2, maxlat=3, maxlon=4),
+        dict(window, network="IV", station="ACER"),
+    ]
+    match, project = bulk_pipeline(selections, ("fileId",))
+
+    assert len(match["$match"]["$or"]) == 2
+    tags = project["$project"]["selections"]["$concatArrays"]
+    assert [tag["$cond"][1] for tag in tags] == [[0], [1]]
+    regex = tags[1]["$cond"][0]["$and"][-1]["$regexMatch"]["regex"]
+    assert regex.startswith(r"^IV\.ACER\.")
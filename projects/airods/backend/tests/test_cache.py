@@ -0,0 +1,58 @@
+"""
+Catalogue watermark of commons/cache.py
+"""
+
+import pytest
+from bson import Timestamp
+
+from airods.commons.cache import CatalogueWatermark
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.wf_do
+
+
+def test_stamp_is_the_same_in_every_process(collection):
+    collection.insert_one({"fileId": "IV.ACER..HHE.D.2015.001"})
+    first, second = CatalogueWatermark(), CatalogueWatermark()
+
+    first.refresh(collection)
+    # a change stream event seen by one process only
+    second.refresh(collection, changed=True)
+    assert first.stamp == second.stamp
+
+
+def test_refresh_bumps_on_changes(collection):
+    watermark = CatalogueWatermark()
+    watermark.refresh(collection)
+    version, stamp = watermark.version, watermark.stamp
+
+    watermark.refresh(collection)
+    assert watermark.version == version
+
+    collection.insert_one({"fileId": "IV.ACER..HHE.D.2015.001"})
+    watermark.refresh(collection)
+    assert watermark.version == version + 1
+    assert watermark.stamp != stamp
+
+    # an in-place update, seen by the change stream: the stamp moves too
+    stamp = watermark.stamp
+    collection.update_one({}, {"$set": {"days": ["2015-01-01"]}})
+    watermark.record(collection, Timestamp(1420070400, 1))
+    assert watermark.version == version + 2
+    assert watermark.stamp != stamp
+
+
+def test_every_watcher_records_the_same_change(collection):
+    collection.insert_one({"fileId": "IV.ACER..HHE.D.2015.001"})
+    first, second = CatalogueWatermark(), CatalogueWatermark()
+
+    first.record(collection, Timestamp(1420070400, 2))
+    # the other process sees the changes later, the older one last
+    second.record(collection, Timestamp(1420070400, 2))
+    second.record(collection, Timestamp(1420070400, 1))
+    assert first.stamp == second.stamp
+    assert first.stamp.endswith("-54a48e00.2")
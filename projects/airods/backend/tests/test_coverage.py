@@ -0,0 +1,58 @@
+"""
+Build lease of the coverage tiles, commons/coverage.py
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from airods.commons.coverage import (
+    STATE_ID,
+    advance_tiles,
+    build_tiles,
+    claim_tiles,
+)
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient().db
+
+
+def test_claim_is_exclusive(database):
+    state = database.coverage_state
+
+    assert claim_tiles(state, "first")["owner"] == "first"
+    assert claim_tiles(state, "second") is None
+    # the holder renews it
+    assert claim_tiles(state, "first") is not None
+
+
+def test_expired_lease_is_taken_over(database):
+    state = database.coverage_state
+    claim_tiles(state, "first")
+    state.update_one(
+        {"_id": STATE_ID}, {"$set": {"lease": datetime.utcnow() - timedelta(1)}}
+    )
+
+    assert claim_tiles(state, "second")["owner"] == "second"
+    assert advance_tiles(state, "first", "x") is False
+    assert advance_tiles(state, "second", "x") is True
+    assert state.find_one({"_id": STATE_ID})["last_id"] == "x"
+
+
+def test_build_skipped_while_leased(database):
+    claim_tiles(database.coverage_state, "other")
+    database.wf_do.insert_one({"fileId": "IV.ACER..HHE.D.2015.001"})
+
+    assert build_tiles(database.wf_do, database.tiles, database.coverage_state) == 0
+    assert database.coverage_state.find_one({"_id": STATE_ID})["owner"] == "other"
+
+
+def test_build_releases_the_lease(database):
+    assert build_tiles(database.wf_do, database.tiles, database.coverage_state) == 0
+    state = database.coverage_state.find_one({"_id": STATE_ID})
+    assert state["owner"] is None
+    assert claim_tiles(database.coverage_state, "next") is not None
@@ -0,0 +1,80 @@
+"""
+Server-side backfills of commons/indexes.py, against a live mongod
+(AIRODS_TEST_MONGO_URI, e.g. mongodb://localhost:27017): the aggregation
+operators they use are not implemented by mongomock
+"""
+
+import os
+from datetime import datetime
+
+import pytest
+
+from airods.commons.indexes import DAY_BUCKETS_MAX, backfill_days, backfill_nscl
+
+MONGO_URI = os.environ.get("AIRODS_TEST_MONGO_URI")
+
+pytestmark = pytest.mark.skipif(not MONGO_URI, reason="AIRODS_TEST_MONGO_URI not set")
+
+
+@pytest.fixture
+def collection():
+    from pymongo import MongoClient
+
+    client = MongoClient(MONGO_URI)
+    collection = client["airods_test"]["wf_do"]
+    collection.drop()
+    yield collection
+    collection.drop()
+    client.close()
+
+
+def test_backfill_days(collection):
+    collection.insert_many(
+        [
+            {
+                "_id": "day",
+                "dc_coverage_t_min": datetime(2015, 1, 1),
+                "dc_coverage_t_max": datetime(2015, 1, 1, 23, 59, 59),
+            },
+            {
+                "_id": "midnight",
+                "dc_coverage_t_min": datetime(2015, 1, 31, 22),
+                "dc_coverage_t_max": datetime(2015, 2, 1, 2),
+            },
+            {
+                "_id": "long",
+                "dc_coverage_t_min": datetime(2015, 1, 1),
+                "dc_coverage_t_max": datetime(2015, 1, 1 + DAY_BUCKETS_MAX),
+            },
+            {"_id": "untimed"},
+        ]
+    )
+
+    assert backfill_days(collection, batch_size=2) == 3
+    days = {d["_id"]: d.get("days", "missing") for d in collection.find()}
+    assert days == {
+        "day": ["2015-01-01"],
+        "midnight": ["2015-01-31", "2015-02-01"],
+        "long": None,
+        "untimed": "missing",
+    }
+    assert backfill_days(collection) == 0
+
+
+def test_backfill_nscl(collection):
+    collection.insert_many(
+        [
+            {"_id": 1, "fileId": "IV.ACER..HHE.D.2015.015"},
+            {"_id": 2, "fileId": "garbage"},
+        ]
+    )
+
+    assert backfill_nscl(collection) == 2
+    parsed = collection.find_one({"_id": 1})
+    assert (parsed["network"], parsed["station"], parsed["location"]) == (
+        "IV",
+        "ACER",
+        "",
+    )
+    assert (parsed["channel"], parsed["year"], parsed["doy"]) == ("HHE", 2015, 15)
+    assert collection.find_one({"_id": 2})["station"] is None
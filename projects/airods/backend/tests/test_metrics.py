@@ -0,0 +1,41 @@
+"""
+Metrics of the worker processes, commons/metrics.py
+"""
+
+import json
+import os
+
+from airods.commons import metrics
+from airods.commons.metrics import REQUESTS, MetricsExport
+
+
+def series(text, name):
+    return [line for line in text.splitlines() if line.startswith(name + "{")]
+
+
+def test_workers_are_summed(tmp_path):
+    REQUESTS.inc(endpoint="test_export", mode="json", status=200)
+    own = REQUESTS.snapshot()[("test_export", "json", 200)]
+
+    # another worker, and one gone since
+    for worker, count in (("1-1", 2), ("2-2", 5)):
+        with open(tmp_path / f"{worker}.json", "w") as output:
+            json.dump({REQUESTS.name: [[["test_export", "json", 200], count]]}, output)
+
+    export = MetricsExport(str(tmp_path))
+    export.ensure_started()
+    export.write()
+    assert os.path.exists(export.path)
+
+    totals = export.read()
+    assert totals[REQUESTS.name][("test_export", "json", 200)] == own + 7
+
+
+def test_worker_series_are_labelled_with_the_pid():
+    REQUESTS.inc(endpoint="test_pid", mode="json", status=200)
+
+    text = metrics.render_metrics()
+    assert (
+        f'{REQUESTS.name}{{endpoint="test_pid",mode="json",status="200",'
+        f'pid="{os.getpid()}"}} 1' in series(text, REQUESTS.name)
+    )
@@ -0,0 +1,87 @@
+"""
+Keyset pagination tokens and pages of commons/pagination.py
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from restapi.exceptions import BadRequest
+
+from airods.commons.pagination import (
+    SORT_FIELD,
+    KeysetPage,
+    decode_token,
+    encode_token,
+    keyset_filter,
+)
+
+
+def test_token_round_trip():
+    document = {SORT_FIELD: datetime(2015, 1, 3, 12, 30), "_id": ObjectId()}
+    assert decode_token(encode_token(document)) == (
+        document[SORT_FIELD],
+        document["_id"],
+    )
+
+
+@pytest.mark.parametrize("token", ["garbage", "e30=", "eyJ0IjogIngiLCAiaWQiOiAieSJ9"])
+def test_invalid_token(token):
+    with pytest.raises(BadRequest):
+        decode_token(token)
+
+
+def test_keyset_filter():
+    query = {"network": "IV"}
+    assert keyset_filter(query, None) is query
+
+    document = {SORT_FIELD: datetime(2015, 1, 3), "_id": ObjectId()}
+    after = keyset_filter(query, encode_token(document))["$and"][1]["$or"]
+    assert after[0] == {SORT_FIELD: {"$gt": document[SORT_FIELD]}}
+    assert after[1] == {
+        SORT_FIELD: document[SORT_FIELD],
+        "_id": {"$gt": document["_id"]},
+    }
+
+
+def test_pages_walk_every_document_once():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.wf_do
+    start = datetime(2015, 1, 1)
+    # ties on the sort field are broken by _id
+    collection.insert_many(
+        [
+            {"fileId": f"F{i:03d}", SORT_FIELD: start + timedelta(days=i // 3)}
+            for i in range(25)
+        ]
+    )
+
+    seen = []
+    token = None
+    while True:
+        page = KeysetPage(collection, {}, ("fileId",), 10, token)
+        documents = list(page)
+        assert all(set(d) == {"fileId"} for d in documents)
+        seen += [d["fileId"] for d in documents]
+        token = page.next
+        if token is None:
+            break
+
+    assert sorted(seen) == [f"F{i:03d}" for i in range(25)]
+    assert len(seen) == 25
+
+
+def test_with_next_trailer():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.wf_do
+    collection.insert_many(
+        [{"fileId": str(i), SORT_FIELD: datetime(2015, 1, 1)} for i in range(3)]
+    )
+
+    *documents, trailer = KeysetPage(collection, {}, ("fileId",), 2).with_next()
+    assert len(documents) == 2
+    assert trailer["next"] is not None
+
+    *documents, trailer = KeysetPage(collection, {}, ("fileId",), 3).with_next()
+    assert len(documents) == 3
+    assert trailer == {"next": None}
@@ -0,0 +1,126 @@
+"""
+NSCL compiler and time windows of commons/queries.py
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from airods.commons.queries import (
+    OVERLAP_MAX_DAYS,
+    code_condition,
+    day_keys,
+    file_id_pattern,
+    nscl_filter,
+    time_filter,
+)
+
+
+def test_code_condition_literal_and_list():
+    assert code_condition("IV") == "IV"
+    assert code_condition("IV, MN") == {"$in": ["IV", "MN"]}
+
+
+@pytest.mark.parametrize("codes", ["", "*", "IV,*"])
+def test_code_condition_any(codes):
+    assert code_condition(codes) is None
+
+
+def test_code_condition_blank_location():
+    assert code_condition("--") == ""
+    assert code_condition("--,00") == {"$in": ["", "00"]}
+
+
+def test_code_condition_wildcards():
+    prefix = code_condition("AC*")
+    assert prefix.pattern == "^AC"
+
+    single = code_condition("HH?")
+    assert single.pattern == "^HH.$"
+    assert single.match("HHZ") and not single.match("HHZZ")
+
+    inner = code_condition("A*R")
+    assert inner.match("ACER") and not inner.match("ACERX")
+
+
+def test_file_id_pattern_literals_are_a_plain_prefix():
+    pattern = file_id_pattern("IV", "ACER", "--", "HHE")
+    assert pattern.pattern == r"^IV\.ACER\.\.HHE\."
+
+
+@pytest.mark.parametrize(
+    "file_id, matches",
+    [
+        ("IV.ACER..HHE.D.2015.015", True),
+        ("IV.ACER.00.HHZ.D.2015.015", True),
+        ("MN.AQU..HHN.D.2015.015", True),
+        ("IV.BCER..HHE.D.2015.015", False),
+        ("IV.ACER..HHEE.D.2015.015", False),
+        ("IVX.ACER..HHE.D.2015.015", False),
+        ("GU.ACER..HHE.D.2015.015", False),
+    ],
+)
+def test_file_id_pattern_wildcards_and_lists(file_id, matches):
+    pattern = file_id_pattern("IV,MN", "A*", "", "HH?")
+    assert bool(pattern.match(file_id)) is matches
+
+
+def test_file_id_pattern_escapes_codes():
+    assert file_id_pattern("I.", "*", "", "*").match("I..X..HHE.") is not None
+    assert file_id_pattern("I.", "*", "", "*").match("IX.X..HHE.") is None
+
+
+def test_nscl_filter():
+    start, end = datetime(2015, 1, 1), datetime(2015, 1, 2)
+    query = nscl_filter(start, end, "IV", "*", "HH?", "")
+
+    assert query["dc_coverage_t_min"] == {"$gte": start}
+    assert query["dc_coverage_t_max"] == {"$lte": end}
+    parsed, fallback = query["$or"]
+    assert parsed["network"] == "IV"
+    assert parsed["channel"].pattern == "^HH.$"
+    assert "station" not in parsed and "location" not in parsed
+    # the documents without parsed NSCL fields match on fileId
+    assert fallback["network"] is None
+    assert fallback["fileId"].match("IV.ACER..HHZ.D.2015.001")
+
+
+def test_nscl_filter_any_code():
+    query = nscl_filter(datetime(2015, 1, 1), datetime(2015, 1, 2), "*", "*", "*", "")
+    assert query["$or"][0] == {"network": {"$ne": None}}
+
+
+def test_day_keys():
+    keys = day_keys(datetime(2015, 1, 30, 12), datetime(2015, 2, 2))
+    assert keys == ["2015-01-30", "2015-01-31", "2015-02-01", "2015-02-02"]
+    assert day_keys(datetime(2015, 1, 2), datetime(2015, 1, 1)) == []
+
+
+def test_day_keys_are_utc():
+    rome = timezone(timedelta(hours=1))
+    start = datetime(2015, 1, 2, 0, 30, tzinfo=rome)
+    assert day_keys(start, start) == ["2015-01-01"]
+
+
+def test_time_filter_inside():
+    start, end = datetime(2015, 1, 1), datetime(2015, 1, 3)
+    assert time_filter(start, end) == {
+        "dc_coverage_t_min": {"$gte": start},
+        "dc_coverage_t_max": {"$lte": end},
+    }
+
+
+def test_time_filter_overlap():
+    start, end = datetime(2015, 1, 1, 6), datetime(2015, 1, 2, 6)
+    query = time_filter(start, end, overlap=True)
+
+    assert query["dc_coverage_t_min"] == {"$lt": end}
+    assert query["dc_coverage_t_max"] == {"$gt": start}
+    # the documents not bucketed yet carry no days
+    assert query["days"] == {"$in": ["2015-01-01", "2015-01-02", None]}
+
+
+def test_time_filter_overlap_long_window():
+    start = datetime(2000, 1, 1)
+    end = start + timedelta(days=OVERLAP_MAX_DAYS)
+    assert "days" not in time_filter(start, end, overlap=True)
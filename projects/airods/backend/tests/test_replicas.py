@@ -0,0 +1,82 @@
+"""
+Stage catalogue of commons/replicas.py
+"""
+
+import pytest
+
+from airods.commons.replicas import (
+    StageCatalogue,
+    object_versions,
+    stage_copies,
+    stage_failed,
+    stage_pending,
+)
+from airods.commons.staging import StageResult
+from airods.tests.fakes import FakeIrods
+
+REPLICAS = {
+    "/zone/mine": {"owner": "/stage/a", "status": "staging", "stage_path": "/s/1"},
+    "/zone/ready": {"owner": "/stage/b", "status": "ready", "stage_path": "/s/2"},
+    "/zone/copying": {"owner": "/stage/b", "status": "staging", "stage_path": "/s/3"},
+    "/zone/failed": {"owner": None, "status": "failed", "stage_path": "/s/4"},
+}
+
+
+def test_copies_and_pending():
+    assert stage_copies(REPLICAS, "/stage/a") == [("/zone/mine", "/s/1")]
+    assert stage_pending(REPLICAS, "/stage/a") == ["/zone/copying"]
+    assert stage_pending(REPLICAS, "/stage/b") == ["/zone/mine"]
+    # nobody is copying it: never pending
+    assert stage_failed(REPLICAS) == ["/zone/failed"]
+
+
+def test_object_versions_of_the_requested_objects():
+    mongomock = pytest.importorskip("mongomock")
+    catalogue = mongomock.MongoClient().db.wf_do
+    catalogue.insert_many(
+        [{"irods_path": f"/zone/a/{i}", "file_size": i} for i in range(120)]
+    )
+    irods = FakeIrods(latency=0, catalogue=catalogue)
+
+    paths = [f"/zone/a/{i}" for i in range(0, 120, 7)] + ["/zone/a/missing"]
+    versions = object_versions(irods, paths)
+    assert sorted(versions) == sorted(paths[:-1])
+    assert versions["/zone/a/14"].size == 14
+
+
+def test_settle_keeps_the_failed_replicas():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.stage_replica
+    replicas = {}
+    for path in ("/zone/ok", "/zone/ko"):
+        replicas[path] = {
+            "_id": collection.insert_one(
+                {
+                    "irods_path": path,
+                    "owner": "/stage/a",
+                    "status": "staging",
+                    "collections": ["/stage/a", "/stage/b"],
+                }
+            ).inserted_id
+        }
+
+    StageCatalogue(collection).settle(
+        replicas,
+        [
+            StageResult("/zone/ok", "/s/ok", True, ""),
+            StageResult("/zone/ko", "/s/ko", False, "no space left"),
+        ],
+    )
+
+    ok = collection.find_one({"irods_path": "/zone/ok"})
+    ko = collection.find_one({"irods_path": "/zone/ko"})
+    assert ok["status"] == "ready"
+    assert (ko["status"], ko["owner"]) == ("failed", None)
+    # still referenced by the other stage collection
+    assert ko["collections"] == ["/stage/a", "/stage/b"]
+
+    # where the files of a stage collection are, the failed ones included
+    assert StageCatalogue(collection).files("/stage/b") == [
+        {"irods_path": "/zone/ko", "status": "failed"},
+        {"irods_path": "/zone/ok", "status": "ready"},
+    ]
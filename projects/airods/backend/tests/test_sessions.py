@@ -0,0 +1,156 @@
+"""
+iRODS session pool of commons/sessions.py
+"""
+
+import itertools
+import threading
+import time
+
+import pytest
+
+from airods.commons.sessions import SessionPool, unavailable_when_busy
+
+
+class Sessions:
+    """ factory / close / check of numbered fake sessions """
+
+    def __init__(self):
+        self.numbers = itertools.count(1)
+        self.closed = []
+        self.broken = set()
+
+    def factory(self):
+        return next(self.numbers)
+
+    def close(self, session):
+        self.closed.append(session)
+
+    def check(self, session):
+        if session in self.broken:
+            raise OSError("connection reset")
+
+
+def new_pool(sessions, **kwargs):
+    options = {
+        "size": 2,
+        "timeout": 5,
+        "max_idle": 60,
+        "max_lifetime": 60,
+        "check_idle": 60,
+    }
+    options.update(kwargs)
+    return SessionPool(sessions.factory, sessions.close, sessions.check, **options)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def sessions():
+    return Sessions()
+
+
+def test_waiters_are_served_in_arrival_order(sessions):
+    pool = new_pool(sessions, size=1)
+    held = pool.checkout()
+    served = []
+
+    def request(number):
+        session = pool.checkout()
+        served.append(number)
+        pool.checkin(session)
+
+    threads = []
+    for number in range(4):
+        thread = threading.Thread(target=request, args=(number,))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: pool.stats()["waiting"] == number + 1)
+
+    pool.checkin(held)
+    for thread in threads:
+        thread.join(5)
+    assert served == [0, 1, 2, 3]
+    # one session served them all
+    assert sessions.closed == [] and pool.stats()["created"] == 1
+
+
+def test_busy_pool_answers_503(sessions):
+    pool = new_pool(sessions, size=1, timeout=0.01)
+    pool.checkout()
+
+    response = unavailable_when_busy(lambda: pool.checkout())()
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_idle_sessions_are_recycled(sessions):
+    pool = new_pool(sessions, max_idle=0.01)
+    pool.checkin(pool.checkout())
+    time.sleep(0.02)
+
+    assert pool.checkout() == 2
+    assert sessions.closed == [1]
+
+
+def test_old_sessions_are_not_reused(sessions):
+    pool = new_pool(sessions, max_lifetime=0.01)
+    session = pool.checkout()
+    time.sleep(0.02)
+
+    # past its lifetime: closed on checkin, even if nothing went wrong
+    pool.checkin(session)
+    assert sessions.closed == [1]
+    assert pool.stats()["open"] == 0
+
+
+def test_broken_sessions_are_dropped(sessions):
+    pool = new_pool(sessions)
+    pool.checkin(pool.checkout(), broken=True)
+
+    assert sessions.closed == [1]
+    assert pool.stats()["open"] == 0
+    assert pool.checkout() == 2
+
+
+def test_idle_sessions_are_checked_before_reuse(sessions):
+    pool = new_pool(sessions, check_idle=0)
+    pool.checkin(pool.checkout())
+    sessions.broken.add(1)
+
+    assert pool.checkout() == 2
+    assert sessions.closed == [1]
+    assert pool.stats()["check_failures"] == 1
+
+
+def test_checkout_free_does_not_wait(sessions):
+    pool = new_pool(sessions, size=3, timeout=5)
+    pool.checkout()
+
+    started = time.monotonic()
+    assert len(pool.checkout_free(5)) == 2
+    assert pool.checkout_free(1) == []
+    assert time.monotonic() - started < 1
+    # probes are not timeouts
+    assert pool.stats()["timeouts"] == 0
+
+
+def test_stats(sessions):
+    pool = new_pool(sessions, size=4)
+    first = pool.checkout()
+    pool.checkout()
+    pool.checkin(first)
+    assert pool.checkout() == first
+
+    stats = pool.stats()
+    assert stats["checkouts"] == 3
+    assert stats["created"] == 2
+    assert (stats["open"], stats["in_use"], stats["idle"]) == (2, 2, 0)
+    assert stats["utilisation"] == 0.5
+    assert stats["waiting"] == 0
+    assert 0 <= stats["wait_seconds_avg"] <= stats["wait_seconds_max"]
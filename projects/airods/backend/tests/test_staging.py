@@ -0,0 +1,88 @@
+"""
+Batched replication rule and its output parsing, commons/staging.py
+"""
+
+from airods.commons.staging import (
+    PATH_SEPARATOR,
+    parse_batch_output,
+    replicate_batch,
+    stage_objects,
+)
+
+
+class RecordingIrods:
+    """ Answers every rule with the given status lines, records the runs """
+
+    def __init__(self, status="OK"):
+        self.status = status
+        self.runs = []
+
+    def rule(self, name, body, inputs, output=False):
+        self.runs.append((name, inputs))
+        paths = inputs.get("*irods_paths")
+        objects = paths.count(PATH_SEPARATOR) + 1 if paths is not None else 1
+        return "\n".join(f"AIRODS:{i}:{self.status}" for i in range(objects))
+
+
+def test_parse_batch_output():
+    output = "AIRODS:0:OK\nnoise AIRODS:2:KO:no space left\nAIRODS:7:OK"
+    statuses = parse_batch_output(output, 3)
+
+    assert statuses[0] == (True, "AIRODS:0:OK")
+    assert statuses[2] == (False, "AIRODS:2:KO")
+    # no status line: never attempted
+    assert statuses[1][0] is False
+
+
+def test_parse_batch_output_empty():
+    assert parse_batch_output(None, 2) == [(False, "no status in rule output")] * 2
+
+
+def test_replicate_batch_single_rule_run():
+    icom = RecordingIrods()
+    pairs = [(f"/zone/a{i}", f"/stage/a{i}") for i in range(3)]
+
+    assert [ok for ok, _ in replicate_batch(icom, pairs)] == [True] * 3
+    assert len(icom.runs) == 1
+    assert icom.runs[0][1]["*irods_paths"] == '"/zone/a0|/zone/a1|/zone/a2"'
+
+
+def test_replicate_batch_separator_in_path():
+    icom = RecordingIrods()
+    pairs = [
+        ("/zone/a", "/stage/a"),
+        ("/zone/b|c", "/stage/b|c"),
+        ("/zone/d", "/stage/d"),
+    ]
+
+    assert [ok for ok, _ in replicate_batch(icom, pairs)] == [True] * 3
+    names = sorted(name for name, _ in icom.runs)
+    assert names == ["do_stage_batch", "do_stage_single"]
+    single = dict(icom.runs)["do_stage_single"]
+    assert single["*irods_path"] == '"/zone/b|c"'
+
+
+def test_stage_objects_keeps_the_order():
+    icom = RecordingIrods()
+    tasks = [(f"/zone/{i}", f"/stage/{i}") for i in range(7)]
+    done = []
+
+    results = stage_objects(
+        replicate_batch,
+        [icom, RecordingIrods()],
+        tasks,
+        callback=done.append,
+        batch_size=3,
+    )
+    assert [r.irods_path for r in results] == [t[0] for t in tasks]
+    assert all(r.ok for r in results)
+    assert len(done) == 7
+
+
+def test_stage_objects_failed_batch():
+    def copy(session, batch):
+        raise OSError("connection reset")
+
+    results = stage_objects(copy, [object()], [("/zone/a", "/stage/a")])
+    assert results[0].ok is False
+    assert "connection reset" in results[0].output